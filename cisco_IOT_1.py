@@ -1,31 +1,51 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import ConnectTimeoutError
 import json
 import socket
 import pprint
 import sys
+import signal
 import os
 import csv
 import time
 import string
 import re
-from collections import defaultdict
+import argparse
+import atexit
+import copy
+import asyncio
+import functools
+import hashlib
+import math
+import queue
+import random
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import date, datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
 from cryptography.fernet import Fernet
 import logging
 
-# disable the warnings for ignoring Self Signed Certificates
-requests.packages.urllib3.disable_warnings()
+# The logger that every function logs to. It is set up to write to a file by main().
+logger = logging.getLogger()
 
-def build_apn_ids_dict(profile):
+def build_apn_ids_dict(ng1, profile, apn_catalogue):
     apn_ids = {} #Initialize an empty dictionary to hold our APN Name : APN id key-value pairs.
     for apn in profile['APNs'][0]['APN']:
         apn_name = apn['name']
-        apn_config = get_apn_detail(ng1_host, headers, cookies, apn_name)
-        if apn_config != False:
-            apn_ids[apn_name] = apn_config['id']
-        else:
-            print(f'[CRITICAL] Unable to fetch APN ID number for {apn_name}. Exiting...')
-            sys.exit()
+        # The APN catalogue already has the id of every APN, so we only need to ask nG1 about an APN that is...
+        # missing from it, for example one that was created after the inventory cache was saved.
+        if 'id' in apn_catalogue.get(apn_name, {}):
+            apn_ids[apn_name] = apn_catalogue[apn_name]['id']
+            continue
+        # Raises Ng1NotFoundError if the APN does not exist.
+        apn_config = get_apn_detail(ng1, apn_name)
+        apn_ids[apn_name] = apn_config['id']
     return apn_ids
 
 def get_customer_apps_from_file(app_list_filename):
@@ -64,134 +84,420 @@ def get_existing_customers_from_file(current_customers_filename):
     return customer_configs, customer_list
 
 
-def build_device_list(current_datacenters_filename):
+def build_device_list(ng1, current_datacenters_filename, max_workers, cached_device_list=None, cached_fingerprints=None):
     # Initialize an empty device list that we will use later to hold their ip adresses, dict of interfaces...
     # and each interface (gateway) has a list of APNs associated to it
-    device_list = defaultdict(list)
+    # max_workers is the number of API calls we allow in flight at the same time during discovery.
+    # If a cached device_list and its device fingerprints are passed in, only devices that are new or...
+    # whose fingerprint has changed are re-discovered. All other devices are copied from the cache.
+    # Returns the device_list, the datacenter_acronyms and the fingerprint of every device in the device_list.
+    # datacenter_acronyms is a dictionary of {datacenter name: acronym} in the order of the datacenters file.
     datacenter_configs = read_config_from_json(current_datacenters_filename)
     if datacenter_configs != False: # The mapping file was not empty
+        discovery_start_time = time.perf_counter()
         # Fetch the devices that exist in the system
-        devices_data = get_devices(ng1_host, headers, cookies)
-        # For every device in the system, fetch the IP address and list of interfaces.
-        # We will need to pull from this dictionary later to create services.
-        # Loop through each device and add it to our dictionary
+        devices_data = get_devices(ng1)
+        print(f"[INFO] Inventory phase 'devices' took {time.perf_counter() - discovery_start_time:.2f} seconds")
+        # Filter the devices down to just those we will use to create services.
+        probe_devices = []
         for device in devices_data['deviceConfigurations']:
             device_name = device['deviceName']
             device_status = device['status']
             device_type = device['deviceType']
-            device_name = device['deviceName']
             if device_status == 'Active': # Only include Active devices.
                 # Only include devices that are types; Infinistream, vStream or vStream Embedded.
                 if device_type == 'InfiniStream' or device_type == 'vSTREAM' or device_type == 'vSTREAM Embedded':
-                    # We need the ip address of each device to fill in the network service members later.
-                    device_list[device_name].append({'deviceIPAddress': device['deviceIPAddress']})
-                    # Each device will have a list of interfaces, so initialize that empty list.
-                    device_list[device_name].append({'interfaces': []})
-                    # Get all the info for all the interfaces on this device.
-                    device_interfaces = get_device_interfaces(ng1_host, headers, cookies, device_name)
-                    if device_interfaces == False: # Failed to get device interfaces.
-                        print(f'[CRITICAL] Unable to fetch interfaces from {device_name}. Exiting....')
-                        sys.exit()
-                    else: # get device interfaces was successful.
-                        # Pull out the interface list from the device_interfaces data.
-                        device_interfaces = device_interfaces['interfaceConfigurations']
-                        # Initialize a counter for appending APNs to the correct interface in our dictionary.
-                        interface_count = 0
-                    # Loop through each interface and append its attributes to our dictionary.
-                    for device_interface in device_interfaces:
-                        if device_interface['status'] == 'ACT': # Only include Active interfaces.
-                            interface_name = device_interface['interfaceName']
-                            # Initialize the list that will contain the interfaces of this device.
-                            device_list[device_name][1]['interfaces'].append({interface_name: []})
-                            # Initialize the list that will contain the APNs for each interface.
-                            device_list[device_name][1]['interfaces'][interface_count][interface_name].append({'APNs': []})
-                            interface_number = str(device_interface['interfaceNumber'])
-                            # Add the interface number to the device_list to use later when creating network services.
-                            device_list[device_name][1]['interfaces'][interface_count][interface_name][0]['interfaceNumber'] = interface_number
-                            interface_alias = str(device_interface['alias'])
-                            # Add the interface alias to the device_list to use later when creating network services.
-                            device_list[device_name][1]['interfaces'][interface_count][interface_name][0]['alias'] = interface_alias
-                            # Fetch all the APNs associated to this interface.
-                            apn_data = get_apns_on_an_interface(ng1_host, headers, cookies, device_name, interface_number)
-                            if apn_data == {}: # There are no APNs associated to this interface.
-                                print(f'[INFO] There are no APNs associated to interface {interface_number} on Device {device_name}')
-                            else: # There is one or more APNs associated to this interface.
-                                for apn in apn_data['apnAssociations']:
-                                    # Add the APN to the interface attributes in our dictionary.
-                                    device_list[device_name][1]['interfaces'][interface_count][interface_name][0]['APNs'].append(apn)
-                            # Increment the interface count for the next loop in case there is more than one.
-                            interface_count += 1
+                    probe_devices.append(device)
                 else:
                     print(f'[INFO] Device: {device_name} type is: {device_type}. Skipping...')
             else:
                 print(f'[INFO] Device: {device_name} status is: {device_status}. Skipping...')
 
+        # Work out which devices need their interfaces and APNs fetched.
+        device_fingerprints = {}
+        changed_devices = []
+        for device in probe_devices:
+            device_name = device['deviceName']
+            device_fingerprints[device_name] = get_device_fingerprint(device)
+            if cached_device_list == None or device_name not in cached_device_list:
+                changed_devices.append(device)
+            elif cached_fingerprints.get(device_name) != device_fingerprints[device_name]:
+                changed_devices.append(device)
+
+        # For every device in the system, fetch the IP address and list of interfaces.
+        # We will need to pull from this dictionary later to create services.
+        discovered_device_list = discover_device_interfaces(ng1, changed_devices, max_workers)
+        device_list = defaultdict(list)
+        for device in probe_devices:
+            device_name = device['deviceName']
+            if device_name in discovered_device_list:
+                device_list[device_name] = discovered_device_list[device_name]
+            else: # This device is unchanged since the cache was saved.
+                device_list[device_name] = cached_device_list[device_name]
+        if cached_device_list != None:
+            print(f'[INFO] Re-discovered {len(changed_devices)} new or changed devices, reused {len(probe_devices) - len(changed_devices)} devices from the inventory cache')
+        print(f'[INFO] Inventory discovery of {len(device_list)} devices took {time.perf_counter() - discovery_start_time:.2f} seconds')
+
         # Initialize an empty datacenter list that we will use later to verify user input.
-        datacenter_list = []
-        # Build the list of available datacenters for the user to select from in customer_menu.
-        for datacenter in datacenter_configs["Data Centers"]:
-            datacenter_name = datacenter["name"]
-            datacenter_list.append(datacenter_name)
-        return device_list, datacenter_list
+        # Look up the acronym of every datacenter once, rather than every time a service or domain name is built.
+        datacenter_acronyms = build_datacenter_acronyms(datacenter_configs)
+        return device_list, datacenter_acronyms, device_fingerprints
 
     else: # The mapping file was empty or there was some other exception in reading the data in.
         print(f'[CRITICAL] Unable to fetch Datacenters from {current_datacenters_filename} file. Exiting....')
         sys.exit()
 
+def discover_device_interfaces(ng1, devices, max_workers):
+    # Build the device_list entries for the devices passed in.
+    # Every device needs a get_device_interfaces call and every active interface needs a...
+    # get_apns_on_an_interface call. These calls do not depend on each other, so we send them...
+    # from a pool of max_workers threads rather than one at a time.
+    # The device_list is assembled in the same device and interface order as a one at a time walk.
+    device_list = defaultdict(list)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        phase_start_time = time.perf_counter()
+        # Get all the info for all the interfaces on every device.
+        if ng1.transport != None:
+            interface_results = ng1.transport.run_all(async_get_device_interfaces, [(ng1, device['deviceName']) for device in devices])
+        else:
+            interface_results = list(executor.map(lambda device: get_device_interfaces(ng1, device['deviceName']), devices))
+        print(f"[INFO] Inventory phase 'interfaces' took {time.perf_counter() - phase_start_time:.2f} seconds")
+
+        # A list of (device_name, interface_number, interface_attributes) for every active interface.
+        # We use it to fill in the APNs for each interface once they have been fetched.
+        apn_lookups = []
+        for device, device_interfaces in zip(devices, interface_results):
+            device_name = device['deviceName']
+            # We need the ip address of each device to fill in the network service members later.
+            device_list[device_name].append({'deviceIPAddress': device['deviceIPAddress']})
+            # Each device will have a list of interfaces, so initialize that empty list.
+            device_list[device_name].append({'interfaces': []})
+            # Loop through each interface and append its attributes to our dictionary.
+            for device_interface in device_interfaces['interfaceConfigurations']:
+                if device_interface['status'] == 'ACT': # Only include Active interfaces.
+                    interface_name = device_interface['interfaceName']
+                    # Add the interface number and alias to the device_list to use later when creating network services.
+                    # The list of APNs for each interface is filled in below.
+                    interface_number = str(device_interface['interfaceNumber'])
+                    interface_alias = str(device_interface['alias'])
+                    interface_attributes = {'APNs': [], 'interfaceNumber': interface_number, 'alias': interface_alias}
+                    device_list[device_name][1]['interfaces'].append({interface_name: [interface_attributes]})
+                    apn_lookups.append((device_name, interface_number, interface_attributes))
+
+        phase_start_time = time.perf_counter()
+        # Fetch all the APNs associated to every active interface.
+        if ng1.transport != None:
+            apn_results = ng1.transport.run_all(async_get_apns_on_an_interface, [(ng1, apn_lookup[0], apn_lookup[1]) for apn_lookup in apn_lookups])
+        else:
+            apn_results = list(executor.map(lambda apn_lookup: get_apns_on_an_interface(ng1, apn_lookup[0], apn_lookup[1]), apn_lookups))
+        print(f"[INFO] Inventory phase 'APN associations' took {time.perf_counter() - phase_start_time:.2f} seconds")
+
+    for (device_name, interface_number, interface_attributes), apn_data in zip(apn_lookups, apn_results):
+        if apn_data == {}: # There are no APNs associated to this interface.
+            print(f'[INFO] There are no APNs associated to interface {interface_number} on Device {device_name}')
+        else: # There is one or more APNs associated to this interface.
+            for apn in apn_data['apnAssociations']:
+                # Add the APN to the interface attributes in our dictionary.
+                interface_attributes['APNs'].append(apn)
+
+    return device_list
+
+
+def get_device_fingerprint(device):
+    # Reduce the device record returned by get_devices to a short hash.
+    # The record includes the device status and configuration attributes, so if any of them change...
+    # the fingerprint changes and the device's interfaces and APNs are fetched again.
+    device_record = json.dumps(device, sort_keys=True)
+    return hashlib.sha1(device_record.encode()).hexdigest()
+
+def build_apn_catalogue(ng1):
+    # Build the APN catalogue, a dictionary of {APN name: APN detail} for every APN system-wide.
+    # We use it to verify user input and to look up the id of each APN in a customer profile.
+    apn_catalogue = {}
+    # Get info on all APN locations system-wide.
+    apn_configs = get_apns(ng1)
 
-def build_valid_dc_and_gateway_lists(apn_entry_list, datacenter_list, device_list):
+    #print(f'apn_configs["apns"] are: {apn_configs["apns"]}')
+    if apn_configs["apns"] == []: # get_apns was successful, but there were no apns in the system.
+        print('[CRITICAL] There are no APNs configured in this system. Exiting...')
+        sys.exit()
+    else:
+        for apn in apn_configs["apns"]:
+            apn_name = apn["name"]
+            apn_catalogue[apn_name] = apn
+
+    return apn_catalogue
+
+def refresh_apn_catalogue(ng1, apn_names):
+    # The APN catalogue may come from the inventory cache, so an APN created since the cache was saved is missing from it.
+    # If any of apn_names are missing, fetch the catalogue from nG1 once more before deciding that they do not exist.
+    # The catalogue is updated in place, so anything holding ng1.apn_catalogue sees the new APNs.
+    # Returns the list of apn_names that are still missing.
+    missing_apn_names = [apn_name for apn_name in dict.fromkeys(apn_names) if apn_name not in ng1.apn_catalogue]
+    if missing_apn_names != []:
+        print(f'[INFO] APNs {missing_apn_names} are not in the APN catalogue. Fetching the APN catalogue from nG1 again')
+        ng1.apn_catalogue.update(build_apn_catalogue(ng1))
+        missing_apn_names = [apn_name for apn_name in missing_apn_names if apn_name not in ng1.apn_catalogue]
+    return missing_apn_names
+
+def load_inventory(ng1, current_datacenters_filename, inventory_cache_filename, inventory_ttl, refresh_inventory, max_workers):
+    # Return the device_list, datacenter_acronyms, apn_catalogue and device fingerprints, using the inventory cache file where we can.
+    # If the cache is younger than inventory_ttl seconds, it is used as is without any API calls.
+    # If it is older, only the devices that are new or have changed are re-discovered.
+    # If there is no usable cache, or refresh_inventory is True, everything is discovered from scratch.
+    inventory_cache = False
+    if refresh_inventory == True:
+        print('[INFO] Inventory refresh requested, rediscovering all devices, interfaces and APNs')
+    elif os.path.isfile(inventory_cache_filename):
+        inventory_cache = read_config_from_json(inventory_cache_filename)
+        if inventory_cache != False:
+            if inventory_cache.get('version') != inventory_cache_version:
+                print(f'[INFO] Inventory cache {inventory_cache_filename} is from an older version. Rediscovering inventory')
+                inventory_cache = False
+            elif inventory_cache.get('ng1_host') != ng1.host:
+                print(f'[INFO] Inventory cache {inventory_cache_filename} is for a different nG1. Rediscovering inventory')
+                inventory_cache = False
+
+    if inventory_cache != False:
+        cache_age = time.time() - inventory_cache['saved_at']
+        datacenters_changed = os.path.getmtime(current_datacenters_filename) > inventory_cache['saved_at']
+        if cache_age < inventory_ttl and datacenters_changed == False:
+            print(f'[INFO] Using inventory cache {inventory_cache_filename} saved {int(cache_age)} seconds ago')
+            device_list = defaultdict(list, inventory_cache['device_list'])
+            return device_list, inventory_cache['datacenter_acronyms'], inventory_cache['apn_catalogue'], inventory_cache['device_fingerprints']
+        print(f'[INFO] Inventory cache {inventory_cache_filename} is {int(cache_age)} seconds old. Refreshing changed devices')
+        device_list, datacenter_acronyms, device_fingerprints = build_device_list(ng1, current_datacenters_filename, max_workers,
+                                                                              inventory_cache['device_list'], inventory_cache['device_fingerprints'])
+    else:
+        device_list, datacenter_acronyms, device_fingerprints = build_device_list(ng1, current_datacenters_filename, max_workers)
+    apn_catalogue = build_apn_catalogue(ng1)
+    save_inventory_cache(ng1, inventory_cache_filename, device_list, datacenter_acronyms, apn_catalogue, device_fingerprints)
+
+    return device_list, datacenter_acronyms, apn_catalogue, device_fingerprints
+
+def save_inventory_cache(ng1, inventory_cache_filename, device_list, datacenter_acronyms, apn_catalogue, device_fingerprints):
+    inventory_cache = {'version': inventory_cache_version,
+                       'ng1_host': ng1.host,
+                       'saved_at': time.time(),
+                       'device_fingerprints': device_fingerprints,
+                       'device_list': device_list,
+                       'datacenter_acronyms': datacenter_acronyms,
+                       'apn_catalogue': apn_catalogue}
+    if write_config_to_json(inventory_cache_filename, inventory_cache) == False:
+        print(f'[WARNING] Unable to save the inventory cache. The next run will rediscover the inventory')
+
+class InventoryRefresher():
+    # Keeps the inventory of a long running program, such as the --daemon, up to date without rediscovering it all.
+    # Each refresh lists the devices with one get_devices call and compares each device's fingerprint with the...
+    # one from the last refresh. Only new and changed devices have their interfaces and APNs fetched again.
+    # Interface status and APN associations are not in the device record, so each refresh also re-checks a...
+    # rotating slice of the unchanged devices, so that every device is re-checked once every sweep_refreshes refreshes.
+    # A new Inventory is built on the side and swapped in with one assignment, so a reader always sees...
+    # either the old inventory or the new one, never one that is part way through being updated.
+
+    def __init__(self, ng1, device_list, datacenter_acronyms, device_fingerprints, current_datacenters_filename,
+                 inventory_cache_filename, sweep_refreshes=12):
+        self.ng1 = ng1
+        self.device_list = device_list
+        self.datacenter_acronyms = datacenter_acronyms
+        self.device_fingerprints = device_fingerprints
+        self.inventory = Inventory(device_list, datacenter_acronyms)
+        self.current_datacenters_filename = current_datacenters_filename
+        self.inventory_cache_filename = inventory_cache_filename
+        self.sweep_refreshes = sweep_refreshes # Set to 0 to only re-check devices whose fingerprint changed.
+        self.refresh_count = 0
+        self.refreshed_time = time.monotonic()
+        self.lock = threading.Lock() # Only one refresh at a time.
+
+    def get_sweep_device_names(self):
+        # Return the names of the unchanged devices to re-check in this refresh.
+        device_names = list(self.device_list)
+        if self.sweep_refreshes <= 0 or device_names == []:
+            return set()
+        sweep_size = math.ceil(len(device_names) / self.sweep_refreshes)
+        sweep_start = (self.refresh_count * sweep_size) % len(device_names)
+        return set((device_names + device_names)[sweep_start:sweep_start + sweep_size])
+
+    def refresh(self):
+        # Bring the inventory and the APN catalogue up to date. Returns True if the inventory changed.
+        with self.lock:
+            # Record this refresh's calls on their own, so they are not counted against the phase of a job running next to it.
+            refresh_metrics = RunMetrics(self.ng1.metrics.latency_samples)
+            refresh_metrics.start_phase('inventory refresh')
+            refresh_ng1 = self.ng1.with_metrics(refresh_metrics)
+            try:
+                sweep_device_names = self.get_sweep_device_names()
+                # Leaving a device's fingerprint out makes build_device_list fetch its interfaces and APNs again.
+                known_fingerprints = {device_name: device_fingerprint for device_name, device_fingerprint in self.device_fingerprints.items()
+                                      if device_name not in sweep_device_names}
+                device_list, datacenter_acronyms, device_fingerprints = build_device_list(refresh_ng1, self.current_datacenters_filename,
+                                                                                      self.ng1.discovery_workers, self.device_list,
+                                                                                      known_fingerprints)
+                apn_catalogue = build_apn_catalogue(refresh_ng1)
+            finally:
+                self.ng1.metrics.merge(refresh_metrics)
+            self.refresh_count += 1
+            inventory_changed = device_list != self.device_list or datacenter_acronyms != self.datacenter_acronyms
+            if inventory_changed == True:
+                self.inventory = Inventory(device_list, datacenter_acronyms)
+                print(f'[INFO] Inventory changed, {len(device_list)} devices indexed')
+            if apn_catalogue != self.ng1.apn_catalogue:
+                self.ng1.apn_catalogue = apn_catalogue
+                print(f'[INFO] APN catalogue changed, {len(apn_catalogue)} APNs')
+            self.device_list = device_list
+            self.datacenter_acronyms = datacenter_acronyms
+            self.device_fingerprints = device_fingerprints
+            self.refreshed_time = time.monotonic()
+            # Save what we found so that the next program start only has to refresh what changes after this.
+            save_inventory_cache(self.ng1, self.inventory_cache_filename, device_list, datacenter_acronyms, apn_catalogue, device_fingerprints)
+            return inventory_changed
+
+    def run(self, refresh_seconds):
+        # The loop of the background refresh thread. A refresh that fails keeps the inventory it had.
+        while True:
+            time.sleep(refresh_seconds)
+            try:
+                self.refresh()
+            # build_device_list exits when it cannot carry on. Here that only skips this refresh.
+            except (Exception, SystemExit) as error:
+                print(f'[WARNING] Unable to refresh the inventory, carrying on with the one loaded before: {error}')
+                logger.warning(f'Unable to refresh the inventory: {error}')
+
+    def start(self, refresh_seconds):
+        threading.Thread(target=self.run, args=(refresh_seconds,), name='inventory-refresh', daemon=True).start()
+
+@dataclass(slots=True)
+class InterfaceRecord():
+    # One active interface (gateway) on a device, along with the names of the APNs associated to it.
+    # position is the order of this interface in the device_list, used to keep service members in a stable order.
+    device_name: str
+    device_ip_address: str
+    interface_name: str
+    interface_number: str
+    alias: str
+    apns: list
+    position: int
+
+@dataclass(slots=True)
+class DeviceRecord():
+    # One active InfiniStream or vSTREAM device and its list of active InterfaceRecords.
+    device_name: str
+    device_ip_address: str
+    interfaces: list
+
+class Inventory():
+    # An indexed, in memory view of the device_list.
+    # The device_list is what we discover and cache, but finding "the interfaces in datacenter X that carry APN Y"...
+    # in it means walking every device and every interface. Here those questions are dictionary lookups.
+
+    def __init__(self, device_list, datacenter_acronyms):
+        self.datacenter_acronyms = datacenter_acronyms # Datacenter name : acronym.
+        # Devices are named starting with the acronym of the datacenter they are in, in any case.
+        # Index the datacenters by that device name prefix, so finding a device's datacenter is a lookup.
+        self.datacenters_by_device_prefix = {} # Lower case acronym : datacenter name.
+        for datacenter, dc_acronym in datacenter_acronyms.items():
+            self.datacenters_by_device_prefix[dc_acronym.lower()] = datacenter
+        self.device_prefix_lengths = sorted(set(len(device_prefix) for device_prefix in self.datacenters_by_device_prefix), reverse=True)
+        self.devices = {} # Device name : DeviceRecord.
+        self.interfaces = [] # Every InterfaceRecord in device_list order.
+        self.interfaces_by_datacenter = defaultdict(list) # Datacenter acronym : list of InterfaceRecords.
+        self.interfaces_by_gateway = defaultdict(list) # Gateway (interface alias) : list of InterfaceRecords.
+        self.interfaces_by_apn = defaultdict(list) # APN name : list of InterfaceRecords.
+        self.interfaces_by_datacenter_and_apn = defaultdict(list) # (Datacenter acronym, APN name) : list of InterfaceRecords.
+        for device_name in device_list:
+            device = DeviceRecord(device_name, device_list[device_name][0]['deviceIPAddress'], [])
+            self.devices[device_name] = device
+            datacenter = self.get_device_datacenter(device_name)
+            dc_acronym = datacenter_acronyms.get(datacenter) # None if the device is not in a known datacenter.
+            for device_interface_data in device_list[device_name][1]['interfaces']:
+                for interface_name in device_interface_data:
+                    interface_attributes = device_interface_data[interface_name][0]
+                    interface = InterfaceRecord(device_name, device.device_ip_address, interface_name,
+                                                interface_attributes['interfaceNumber'], interface_attributes['alias'],
+                                                interface_attributes['APNs'], len(self.interfaces))
+                    device.interfaces.append(interface)
+                    self.interfaces.append(interface)
+                    if dc_acronym != None:
+                        self.interfaces_by_datacenter[dc_acronym].append(interface)
+                    self.interfaces_by_gateway[interface.alias].append(interface)
+                    for apn_name in dict.fromkeys(interface.apns): # Skip any APN listed twice on the same interface.
+                        self.interfaces_by_apn[apn_name].append(interface)
+                        if dc_acronym != None:
+                            self.interfaces_by_datacenter_and_apn[(dc_acronym, apn_name)].append(interface)
+
+        # A gateway whose name does not include its datacenter's acronym can not be selected for any customer.
+        unmatched_gateways = {}
+        for dc_acronym in self.interfaces_by_datacenter:
+            for interface in self.interfaces_by_datacenter[dc_acronym]:
+                if not has_datacenter_acronym(interface.alias, dc_acronym):
+                    unmatched_gateways[interface.alias] = dc_acronym
+        for gateway_name, dc_acronym in unmatched_gateways.items():
+            print(f"[WARNING] Gateway: {gateway_name} does not include the acronym {dc_acronym} of its datacenter as a '-' "
+                  "separated part of its name, so it can not be selected")
+
+        # Build an inverted index of APN name : the datacenters and the gateways where the APN is associated.
+        # We use dictionaries with no values as sets, because they also remember the order that entries were added.
+        # Datacenters are added in datacenters file order and gateways in datacenters file then device_list order,...
+        # which is the order we show them to the user in the customer menu.
+        self.apn_datacenters = defaultdict(dict) # APN name : {datacenter name: None}.
+        self.apn_gateways = defaultdict(dict) # APN name : {gateway: None}.
+        for datacenter, dc_acronym in datacenter_acronyms.items():
+            for interface in self.interfaces_by_datacenter.get(dc_acronym, []):
+                for apn_name in interface.apns:
+                    self.apn_datacenters[apn_name][datacenter] = None
+                    self.apn_gateways[apn_name][interface.alias] = None
+
+    def get_device_datacenter(self, device_name):
+        # Return the name of the datacenter the device is in, or None if its name does not start with a known acronym.
+        for device_prefix_length in self.device_prefix_lengths:
+            datacenter = self.datacenters_by_device_prefix.get(device_name[:device_prefix_length].lower())
+            if datacenter != None:
+                return datacenter
+        return None
+
+    def get_datacenter_interfaces_for_apn(self, dc_acronym, apn_name):
+        # Return the interfaces on devices in this datacenter that have this APN associated to them.
+        return self.interfaces_by_datacenter_and_apn.get((dc_acronym, apn_name), [])
+
+    def get_gateway_interfaces(self, gateway_names, dc_acronym):
+        # Return the interfaces whose gateway (alias) is in gateway_names and includes the datacenter acronym.
+        # The interfaces are returned in device_list order.
+        gateway_interfaces = []
+        for gateway_name in set(gateway_names):
+            if has_datacenter_acronym(gateway_name, dc_acronym):
+                gateway_interfaces.extend(self.interfaces_by_gateway.get(gateway_name, []))
+        gateway_interfaces.sort(key=lambda interface: interface.position)
+        return gateway_interfaces
+
+def build_valid_dc_and_gateway_lists(apn_entry_list, inventory):
     # Build up a list of valid datatcenters where each entered APN is associated to one or more interfaces.
     # Build up a list of valid gateways where each entered APN is associated to one or more interfaces.
-    apn_loop_counter = 0
+    # Both come straight from the inventory's APN index, so this does not depend on the size of the estate.
     valid_datacenters = []
     valid_gateways = []
     for apn_entry in apn_entry_list:
-        valid_datacenters.append({apn_entry:[]})
-        valid_gateways.append({apn_entry:[]})
-        for datacenter in datacenter_list:
-            for device_name in device_list:
-                dc_acronym = translate_dc_name_to_acronym(datacenter) # Get the 3 letter acronym for this DC.
-                if dc_acronym == device_name[:3].upper(): # Only include devices within this DC.
-                    # Loop through all the interfaces for this device.
-                    for interface in device_list[device_name][1]['interfaces']:
-                        # Pull out just the interface dictionary values for each interface in the loop.
-                        interface_values = list(interface.values())[0][0]
-                        # The gateway name is really the assigned 'alias' attribute.
-                        gateway = interface_values['alias']
-                        # Get the list of APNs associated to this interface.
-                        gateway_apns = interface_values['APNs']
-                        # Check if this APN is in this list of APNs for this gateway.
-                        if apn_entry in gateway_apns:
-                            # We have a match, include this gateway into the list of valid gateways...
-                            # for this APN. We will show them this list in the user menu later.
-                            valid_gateways[apn_loop_counter][apn_entry].append(gateway)
-                            # If we have not already added this datacenter to the list of valid datacenters...
-                            # then add it now. We will show them this list in the user menu later.
-                            if datacenter not in valid_datacenters[apn_loop_counter][apn_entry]:
-                                valid_datacenters[apn_loop_counter][apn_entry].append(datacenter)
-                        else:
-                            apn_entry_in_gateway = False
-
-        apn_loop_counter += 1 # Needed to walk to the next APN in the list of APN dictionaries.
+        # We will show them these lists in the user menu later.
+        valid_datacenters.append({apn_entry: list(inventory.apn_datacenters.get(apn_entry, {}))})
+        valid_gateways.append({apn_entry: list(inventory.apn_gateways.get(apn_entry, {}))})
     return valid_datacenters, valid_gateways
 
 def save_cust_config_to_file(customer_configs, new_customers_filename, current_customers_filename, old_customers_filename):
     # write to a json file
     try:
-        with open(config_filename,"w") as f:
+        with open(new_customers_filename,"w") as f:
             json.dump(customer_configs, f)
-            print(f'[INFO] Writing customer config to JSON file:', config_filename)
+            print(f'[INFO] Writing customer config to JSON file:', new_customers_filename)
     except IOError as e:
-        print(f'[ERROR] Unable to write to the customer JSON config file:', config_filename)
+        print(f'[ERROR] Unable to write to the customer JSON config file:', new_customers_filename)
         print("I/O error({0}): {1}".format(e.errno, e.strerror))
         return False
     except: #handle other exceptions such as attribute errors
-        print(f'[ERROR] Unable to write to the customer JSON config file:', config_filename)
+        print(f'[ERROR] Unable to write to the customer JSON config file:', new_customers_filename)
         print("Unexpected error:", sys.exc_info()[0])
         return False
     # if old exists read, rename and cp new to old then return ....  else rename new to old for future iterations, retun.
     if os.path.isfile(current_customers_filename):
-        os.rename(current_customers_filename, old_customers_filename + '_' + str(date_time) + '.json')
+        os.rename(current_customers_filename, old_customers_filename + '_' + datetime.now().strftime("%Y_%m_%d_%H%M%S") + '.json')
         print(f"[INFO] Backing up file {current_customers_filename} to {old_customers_filename}")
         os.rename(new_customers_filename, current_customers_filename)
         print(f"[INFO] Renaming file {new_customers_filename} to {current_customers_filename}")
@@ -220,13 +526,16 @@ def check_splcharacter(test, no_comma):
 
     return False
 
-def domain_exists(domain_name, domain_tree_data):
-    for domain in domain_tree_data['domain']:
-        if domain_name == domain['serviceName']: # if True, the domain already exists, skip creating it
+def domain_exists(domain_name, domain_index):
+    # Search the domain index rather than the domain tree we downloaded at the start, so that domains...
+    # created for an earlier customer in the same run are found too.
+    skip = False
+    for existing_domain_name, existing_parent_id in domain_index:
+        if domain_name == existing_domain_name: # if True, the domain already exists, skip creating it
             skip = True
             print(f'[INFO] Domain: {domain_name} already exists, skipping')
             # Set the id for this existing domain as the parent_domain_id for the next domain child to use.
-            parent_domain_id = domain['id']
+            parent_domain_id = domain_index[(existing_domain_name, existing_parent_id)]
             return skip, parent_domain_id
         else:
             skip = False
@@ -271,97 +580,108 @@ def validate_cust_domains_exist(customer_configs, domain_tree_data):
 
     return customer_domains_missing
 
-def translate_dc_name_to_acronym(datacenter_name):
-    # Translate the datacenter name into the 3 letter acronym that we need to match up to the app service name.
-    if datacenter_name.startswith('Atl'):
-        dc_acronym = 'ATL'
-    elif datacenter_name.startswith('Pho'):
-        dc_acronym = 'PHX'
-    elif datacenter_name.startswith('San'):
-        dc_acronym = 'SJC'
-    elif datacenter_name.startswith('Tor'):
-        dc_acronym = 'TOR'
-    elif datacenter_name.startswith('Van'):
-        dc_acronym = 'VAN'
-    else:
-        print('[ERROR] Unable to match datacenter name to its 3 letter acronym')
-        return False
-    return dc_acronym
-
-def create_app_services(ng1_host, headers, cookies, apn_ids, app_data, net_service_ids, dc_entry_list, GTP_Baseline_profile_id):
-    # Create create the application services the apps passed in on the app_data dictionary.
-    # Create app service definitions for each APN on each valid gateway on each datacenter entered.
-    # Initialize an empty dictionary to hold the app service ID numbers. Add to this dict as we create app services.
-    app_service_ids = {}
+def build_datacenter_acronyms(datacenter_configs):
+    # Build a dictionary of {datacenter name: acronym} from the datacenters json file, in the order of the file.
+    # The acronym starts the names of the services in the datacenter and of the devices in it, and is one of the...
+    # '-' separated parts of the names of its gateways (see has_datacenter_acronym for the legacy acronyms).
+    # Each datacenter in the file can set its own, for example:
+    # {"Data Centers": [{"name": "Dallas", "acronym": "DFW"}]}
+    # Datacenters that do not set one are matched on the start of their name against legacy_datacenter_acronyms.
+    # A datacenter with no acronym, or with a '-' in its acronym, is left out, as no services can be named for it.
+    datacenter_acronyms = {}
+    for datacenter in datacenter_configs["Data Centers"]:
+        datacenter_name = datacenter["name"]
+        dc_acronym = datacenter.get("acronym")
+        if dc_acronym == None:
+            for datacenter_name_start in legacy_datacenter_acronyms:
+                if datacenter_name.startswith(datacenter_name_start):
+                    dc_acronym = legacy_datacenter_acronyms[datacenter_name_start]
+                    break
+        if dc_acronym == None:
+            print(f'[ERROR] Unable to match datacenter name {datacenter_name} to its acronym. Skipping...')
+            continue
+        if dc_acronym == '' or '-' in dc_acronym:
+            print(f"[ERROR] The acronym {dc_acronym} of datacenter {datacenter_name} must not be empty or contain a '-'. Skipping...")
+            continue
+        datacenter_acronyms[datacenter_name] = dc_acronym.upper()
+    return datacenter_acronyms
+
+def has_datacenter_acronym(name, dc_acronym):
+    # Return True if the gateway (or other) name includes dc_acronym.
+    # An acronym from the datacenters json file must be one of the '-' separated parts of the name, such as DFW...
+    # in DFW-GGSN0001. Acronyms can be any length, so a plain substring test would find SY in SYR-GGSN0001.
+    # The legacy acronyms are matched anywhere in the name as they always were, so gateways named like...
+    # ATLGGSN01 or ATL_GGSN01 keep working.
+    if dc_acronym in name.split('-'):
+        return True
+    return dc_acronym in legacy_datacenter_acronyms.values() and dc_acronym in name
+
+def get_app_settings(app):
+    # Return the settings for an app in the app list json file, filling in the defaults for any that are not set.
+    # Each app may set:
+    # 'alertProfile': the name of the service alert profile for its application services (default 'GTP-Baseline').
+    # 'protocolOrGroupCode': the protocol or group code of its service members (default the app name limited to 10 chars).
+    # 'isProtocolGroup': True if protocolOrGroupCode is a protocol group (default False).
+    # A 'single' app with a 'message' such as 'GTPv1:16' is message based, and a 'multi_member' app has a...
+    # service member for each protocol in its 'member_list'.
+    # The Web, DNS and GTPv0 apps get the settings they have always had, so older app list files still work.
+    app_settings = {'alertProfile': 'GTP-Baseline', 'protocolOrGroupCode': app['name'][:10], 'isProtocolGroup': False}
+    app_settings.update(legacy_app_settings.get(app['name'], {}))
+    app_settings.update(app)
+    return app_settings
+
+def build_app_service_configs(apn_ids, app_data, net_service_ids, apn_datacenters, alert_profile_ids, datacenter_acronyms):
+    # Build the application service definitions for the apps passed in on the app_data dictionary.
+    # Build app service definitions for each APN on each valid gateway on each datacenter entered for that APN.
+    # apn_datacenters is a dictionary of {APN name: list of datacenters}, see get_apn_datacenters.
+    # The network services in net_service_ids must already exist, as their id numbers are used as service members.
+    # alert_profile_ids is a dictionary of {service alert profile name: id} that includes every app's alert profile.
+    # Returns a dictionary of {application service name: application service config data}.
+    app_service_configs = {}
     for apn_name in apn_ids: # Loop through each APN the user entered.
         for app in app_data['Applications']: # Loop through each app dictionary.
-            app_name = app['name']
-            if app['type'] == 'multi_member': #This is a list of app members, for example DNS.
-                protocol_or_group_code_list = app['member_list'] # Get the list of apps to place as service members.
+            app_settings = get_app_settings(app)
+            app_name = app_settings['name']
+            # The protocol or group codes for the service members of this app.
+            if app_settings['type'] == 'multi_member': #This is a list of app members, for example DNS.
+                protocol_or_group_code_list = app_settings['member_list'] # Get the list of apps to place as service members.
+                is_message_type = False
+                message_id = 0
+            elif 'message' in app_settings: # This is a message-based app.
+                protocol_or_group_code_list = [app_settings['message']]
+                is_message_type = True
+                message_id = app_settings['message'].partition(':')[2]# Scrape off the message id after the ':'.
+            else:
+                protocol_or_group_code_list = [app_settings['protocolOrGroupCode']]
+                is_message_type = False
+                message_id = 0
+            is_protocol_group = app_settings['isProtocolGroup'] and is_message_type == False
 
-            for dc_entry in dc_entry_list: # Loop through each datacenter the user entered.
-                dc_acronym = translate_dc_name_to_acronym(dc_entry)
+            for dc_entry in apn_datacenters[apn_name]: # Loop through each datacenter the user entered for this APN.
+                dc_acronym = datacenter_acronyms[dc_entry]
                 application_service_name = dc_acronym + '-AS-' + app_name + '-' + apn_name.replace(" ","_")
 #                application_service_name = dc_acronym + '-AS-' + app_name + '-' + apn_name
 
                 # Initialize the dictionary that we will use to build up our application service definition.
-                app_srv_config_data = {'serviceDetail': [{'alertProfileID': 2,
+                app_srv_config_data = {'serviceDetail': [{'alertProfileID': alert_profile_ids[app_settings['alertProfile']],
                 'exclusionListID': -1,
                 'id': -1,
                 'isAlarmEnabled': True,
-                'serviceDefMonitorType': app['serviceDefMonitorType'],
+                'serviceDefMonitorType': app_settings['serviceDefMonitorType'],
                 'serviceName': application_service_name,
                 'serviceType': 1}]}
 
                 # Add members to the service that is each valid gateway for each datacenter.
                 app_srv_config_data['serviceDetail'][0]['serviceMembers'] = []
-                # The protocol or group code for each service member is the app name limited to 10 chars.
-                if app_name == 'Web':
-                    protocol_or_group_code = 'WEB'
-                    is_message_type = False
-                    is_protocol_group = True
-                    is_message_type = False
-                    message_id = 0
-                    app_srv_config_data['serviceDetail'][0]['alertProfileID'] = Web_Group_Baseline_profile_id
-                elif app_name == 'DNS':
-                    is_message_type = False
-                    is_protocol_group = False
-                    is_message_type = False
-                    message_id = 0
-                    app_srv_config_data['serviceDetail'][0]['alertProfileID'] = DNS_Baseline_profile_id
-                elif app_name == 'GTPv0':
-                    protocol_or_group_code = 'GTP'
-                    is_message_type = False
-                    message_id = 0
-                    is_protocol_group = False
-                    app_srv_config_data['serviceDetail'][0]['alertProfileID'] =  GTP_Baseline_profile_id
-                else:
-                    is_message_type = True
-                    protocol_or_group_code = app['message'] # This is a message-based app.
-                    message_id = app['message'].partition(':')[2]# Scrape off the message id after the ':'.
-                    is_protocol_group = False
-                    app_srv_config_data['serviceDetail'][0]['alertProfileID'] =  GTP_Baseline_profile_id
-
                 for network_service in net_service_ids:
                     # Filter down the list of network_service_ids to just the gateways for the current datacenter.
                     # loop and just those interfaces for the current APN loop. The goal is to create an app service...
                     # that is specific to an APN + datacenter combination and add the related interface network...
                     # services as members of this app service.
-                    if 'All-' not in network_service and apn_name.replace(" ","_") in network_service and network_service.startswith(application_service_name[:3]):
+                    if 'All-' not in network_service and apn_name.replace(" ","_") in network_service and network_service.startswith(dc_acronym + '-'):
                         net_srv_id = net_service_ids[network_service]
-                        if app['type'] == 'multi_member': # We need to append a service member for each app listed.
-                            for protocol_or_group_code in protocol_or_group_code_list: # Loop through the list of apps.
-                                app_srv_config_data['serviceDetail'][0]['serviceMembers'].append({'enableAlert': True,
-                                                    'interfaceNumber': -1,
-                                                    'isNetworkDomain': True,
-                                                    'isMessageType': is_message_type,
-                                                    'messageID': message_id,
-                                                    'isProtocolGroup': is_protocol_group,
-                                                    'melID': -1,
-                                                    'networkDomainID': net_srv_id,
-                                                    'networkDomainName': network_service,
-                                                    'protocolOrGroupCode': protocol_or_group_code})
-                        else: # This is not a list of apps, so we only need one service member.
+                        # Append a service member for each protocol or group code of this app.
+                        for protocol_or_group_code in protocol_or_group_code_list:
                             app_srv_config_data['serviceDetail'][0]['serviceMembers'].append({'enableAlert': True,
                                                 'interfaceNumber': -1,
                                                 'isNetworkDomain': True,
@@ -372,20 +692,205 @@ def create_app_services(ng1_host, headers, cookies, apn_ids, app_data, net_servi
                                                 'networkDomainID': net_srv_id,
                                                 'networkDomainName': network_service,
                                                 'protocolOrGroupCode': protocol_or_group_code})
-                # Create the new application service.
-                create_service(ng1_host, headers, cookies, application_service_name, app_srv_config_data, False)
-                # We need to know the id number that was assigned to this new app service, so we get_service_detail on it.
-                app_srv_config_data = get_service_detail(ng1_host, application_service_name, headers, cookies)
-                #print(f'\nApp service config data is: {app_srv_config_data}')
-                app_srv_id = app_srv_config_data['serviceDetail'][0]['id']
-                # Add this application service id to our dictionary so we can use it later to assign domain members.
-                app_service_ids[application_service_name] = app_srv_id
-
-    return app_service_ids
-
-def create_gateway_net_services(ng1_host, headers, cookies, apn_ids, apn_name, device_list, profile, net_service_ids, dc_entry_list, ThroughPut_Baseline_profile_id):
-    # Now create a network service for each interface (gateway) that the user specified.
+                # Add this application service to the list of services to create.
+                app_service_configs[application_service_name] = app_srv_config_data
+
+    return app_service_configs
+
+def get_app_alert_profile_names(app_data):
+    # Return the names of the service alert profiles that the apps in the app list use.
+    profile_names = []
+    for app in app_data['Applications']:
+        profile_name = get_app_settings(app)['alertProfile']
+        if profile_name not in profile_names:
+            profile_names.append(profile_name)
+    return profile_names
+
+def resolve_alert_profile_ids(ng1, profile_names, max_workers):
+    # Return a dictionary of {service alert profile name: id} for every name in profile_names.
+    # All of the profiles are listed in one call. If that fails, or a profile is not in the list, the...
+    # profiles that are still missing are looked up by name, max_workers at a time.
+    # Raises Ng1NotFoundError if any of the profiles cannot be found, as services cannot be created without them.
+    alert_profile_ids = {}
+    try:
+        alert_profiles_data = get_service_alert_profiles(ng1)
+        for alert_profile in alert_profiles_data.get('serviceAlertProfiles', []):
+            if alert_profile.get('name') in profile_names:
+                alert_profile_ids[alert_profile['name']] = alert_profile['Id']
+    except (Ng1NotFoundError, Ng1TransientError) as error:
+        print(f'[WARNING] Unable to list the service alert profiles, looking them up one at a time: {error}')
+    missing_profile_names = [profile_name for profile_name in profile_names if profile_name not in alert_profile_ids]
+    if missing_profile_names != []:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            alert_profiles = list(executor.map(lambda profile_name: get_service_alert_profile(ng1, profile_name),
+                                               missing_profile_names))
+        for profile_name, alert_profile in zip(missing_profile_names, alert_profiles):
+            alert_profile_ids[profile_name] = alert_profile['Id']
+    print(f'[INFO] Resolved {len(alert_profile_ids)} service alert profiles: {alert_profile_ids}')
+    return alert_profile_ids
+
+class ServiceRegistry():
+    # The name : id of every service known to exist in nG1. Network services are named after the datacenter,...
+    # APN and gateway, and application services after the datacenter, app and APN, so customers that share an...
+    # APN share those services. Every customer in a batch uses the one registry and only creates the services...
+    # that are not in it yet. The registry is saved to the service cache file, which a later --plan run starts with.
+    # When customers are provisioned at the same time, as in the daemon, a service being created for one...
+    # customer is claimed, and the others wait for its id rather than create it again.
+
+    def __init__(self, ng1_host):
+        self.ng1_host = ng1_host
+        self.service_ids = {} # Service name : id.
+        self.claimed_service_names = set() # Services that are being created.
+        self.lock = threading.Condition()
+
+    def get_service_ids(self):
+        with self.lock:
+            return dict(self.service_ids)
+
+    def update(self, service_ids):
+        with self.lock:
+            self.service_ids.update(service_ids)
+
+    def claim(self, service_names):
+        # Claim the services in service_names that are not known or already claimed. Returns the claimed names,...
+        # which the caller must create and then release.
+        with self.lock:
+            claimed_service_names = [service_name for service_name in service_names
+                                     if service_name not in self.service_ids and service_name not in self.claimed_service_names]
+            self.claimed_service_names.update(claimed_service_names)
+            return claimed_service_names
+
+    def release(self, service_names, created_service_ids):
+        # Release claimed services once they are created, or could not be, and wake anyone waiting for them.
+        with self.lock:
+            self.service_ids.update(created_service_ids)
+            self.claimed_service_names.difference_update(service_names)
+            self.lock.notify_all()
+
+    def wait_for(self, service_names):
+        # Wait until none of service_names are claimed, then return the ids of the ones that were created.
+        with self.lock:
+            self.lock.wait_for(lambda: self.claimed_service_names.isdisjoint(service_names))
+            return {service_name: self.service_ids[service_name] for service_name in service_names if service_name in self.service_ids}
+
+    def seed(self, ng1):
+        # Replace the registry with every service in nG1, listed with one get_services call.
+        services_data = get_services(ng1)
+        with self.lock:
+            self.service_ids = {service['serviceName']: service['id'] for service in services_data['serviceDetail']}
+        print(f'[INFO] Service registry loaded {len(self.service_ids)} services from nG1')
+
+    def load(self, service_cache_filename, max_age):
+        # Load the registry from the service cache file if it is for this nG1 and younger than max_age seconds.
+        # Returns False if there is no such cache.
+        if not os.path.isfile(service_cache_filename):
+            return False
+        service_cache = read_config_from_json(service_cache_filename)
+        if service_cache == False or service_cache.get('version') != service_cache_version or service_cache.get('ng1_host') != self.ng1_host:
+            return False
+        cache_age = time.time() - service_cache['saved_at']
+        if cache_age >= max_age:
+            return False
+        with self.lock:
+            self.service_ids = service_cache['service_ids']
+        print(f'[INFO] Service registry loaded {len(self.service_ids)} services from {service_cache_filename} saved {int(cache_age)} seconds ago')
+        return True
+
+    def save(self, service_cache_filename):
+        with self.lock:
+            service_cache = {'version': service_cache_version, 'ng1_host': self.ng1_host, 'saved_at': time.time(),
+                             'service_ids': dict(self.service_ids)}
+        if write_config_to_json(service_cache_filename, service_cache) == False:
+            print(f'[WARNING] Unable to save the service cache. The next run will list the services in nG1 again')
+
+def resolve_service_ids(ng1, service_names, service_ids):
+    # Find the id number of every service in service_names that is not already in the service_ids dictionary.
+    # A single get_services call lists every service, so a whole batch of creates costs one GET...
+    # rather than one get_service_detail per service.
+    # Any service that cannot be found is left out of the service_ids dictionary.
+    missing_service_names = [service_name for service_name in service_names if service_name not in service_ids]
+    if missing_service_names == []: # nG1 returned the ids for all of the services as we created them.
+        return service_ids
+    try:
+        services_data = get_services(ng1)
+        missing_service_name_set = set(missing_service_names)
+        for service in services_data['serviceDetail']:
+            if service['serviceName'] in missing_service_name_set:
+                service_ids[service['serviceName']] = service['id']
+        # The listing has every service in nG1, so bring the service registry up to date with it while we have it.
+        if ng1.service_registry != None:
+            ng1.service_registry.update({service['serviceName']: service['id'] for service in services_data['serviceDetail']})
+    except Ng1TransientError as error:
+        print(f'[WARNING] Unable to list the services, looking them up one at a time: {error}')
+    # Fall back to looking up any service that was not in the list one at a time.
+    for service_name in missing_service_names:
+        if service_name not in service_ids:
+            try:
+                service_config_data = get_service_detail(ng1, service_name)
+                service_ids[service_name] = service_config_data['serviceDetail'][0]['id']
+            except Ng1NotFoundError:
+                pass # The service was not created.
+
+    return service_ids
+
+def create_services_batch(ng1, service_configs, max_workers, batch_name):
+    # Create every service in the service_configs dictionary of {service name: service config data}.
+    # The services in one batch must not depend on each other, as up to max_workers of them are created at the same time.
+    # Returns a dictionary of {service name: service id} in the same order as service_configs, and a batch report...
+    # that lists which services were created, which already existed and which failed.
+    batch_start_time = time.perf_counter()
+    created_service_ids = {}
+    if ng1.transport != None:
+        create_results = ng1.transport.run_all(async_create_service_or_error, [(ng1, service_name, service_configs[service_name], False, created_service_ids)
+                                                                               for service_name in service_configs])
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            create_results = list(executor.map(lambda service_name: create_service_or_error(ng1, service_name,
+                                                                                            service_configs[service_name], False, created_service_ids),
+                                               service_configs))
+    # We need to know the id number that was assigned to each new service.
+    created_service_ids = resolve_service_ids(ng1, list(service_configs), created_service_ids)
+
+    service_ids = {}
+    batch_report = {'created': [], 'existing': [], 'failed': []}
+    for service_name, create_result in zip(service_configs, create_results):
+        if service_name not in created_service_ids: # The create failed and the service does not exist.
+            batch_report['failed'].append(service_name)
+            if isinstance(create_result, Ng1Error):
+                print(f'[ERROR] {create_result}')
+            continue
+        if create_result == True:
+            batch_report['created'].append(service_name)
+        else: # The service already exists, which is fine. Or the create failed but a retry of it had worked.
+            batch_report['existing'].append(service_name)
+        # Add this service id to our dictionary so we can use it later to assign members.
+        service_ids[service_name] = created_service_ids[service_name]
+    if ng1.journal != None and service_ids != {}:
+        ng1.journal.record({'type': 'services', 'ids': service_ids})
+
+    print(f"[INFO] {batch_name}: {len(batch_report['created'])} created, {len(batch_report['existing'])} already existed, "
+          f"{len(batch_report['failed'])} failed in {time.perf_counter() - batch_start_time:.2f} seconds")
+    for service_name in batch_report['failed']:
+        print(f'[ERROR] {batch_name}: unable to create {service_name}')
+
+    return service_ids, batch_report
+
+def create_service_or_error(ng1, service_name, config_data, save, service_ids=None):
+    # Call create_service, but return the Ng1Error instead of raising it, so that one failed service...
+    # does not stop the rest of a batch. Only an auth error is raised, as every other call would fail too.
+    try:
+        return create_service(ng1, service_name, config_data, save, service_ids)
+    except Ng1AuthError:
+        raise
+    except Ng1Error as error:
+        return error
+
+def build_gateway_net_service_configs(apn_ids, inventory, profile, apn_datacenters, ThroughPut_Baseline_profile_id):
+    # Build a network service definition for each interface (gateway) that the user specified.
+    # apn_datacenters is a dictionary of {APN name: list of datacenters}, see get_apn_datacenters.
     # The network service name is in the form of {datacenter_abbreviation}-NWS-{apn_name}-{gateway}.
+    # Returns a dictionary of {network service name: network service config data}.
+    net_service_configs = {}
     # We will use a counter to index each APN in the customer profile.
     # The valid gateways can be different for each APN.
     apn_loop_counter = 0
@@ -394,63 +899,54 @@ def create_gateway_net_services(ng1_host, headers, cookies, apn_ids, apn_name, d
         valid_gateway_list_for_this_APN = []
         for gateway_name in profile['APNs'][0]['APN'][apn_loop_counter]['gateways'][0]['gateway']:
             valid_gateway_list_for_this_APN.append(gateway_name['name'])
-        for dc_entry in dc_entry_list:
-            dc_acronym = translate_dc_name_to_acronym(dc_entry)
-            for device in device_list: # Go through all the available devices
-                # We need to pull interface details from the device list to populate service member attributes.
-                for device_interface_data in device_list[device][1]['interfaces']: # For each interface on each device.
-                    for device_interface in device_interface_data:
-                        # The gateway is really the interface 'alias' attribute, so pull that out of device_interface_data.
-                        device_interface_gateway = device_interface_data[device_interface][0]['alias']
-                        # Filter the global list of interfaces down to just those that are both associated...
-                        # to the APN we are looping on and the datacenter name we are looping on.
-                        # In other words, any interface in this datacenter that is also associated to this APN.
-                        if device_interface_gateway in valid_gateway_list_for_this_APN and dc_acronym in device_interface_gateway:
-                            interface_number = device_interface_data[device_interface][0]['interfaceNumber']
-                            interface_alias = device_interface_data[device_interface][0]['alias']
-                            gateway = device_interface_gateway
-                            network_service_name = dc_acronym + '-NWS-' + apn_name.replace(" ","_") + '-' + gateway
-#                            network_service_name = dc_acronym + '-NWS-' + apn_name + '-' + gateway
-
-                            # Initialize the dictionary that we will use to build up our network service definition.
-                            net_srv_config_data = {'serviceDetail': [{'alertProfileID': 2,
-                            'exclusionListID': -1,
-                            'id': -1,
-                            'isAlarmEnabled': True,
-                            'alertProfileID': ThroughPut_Baseline_profile_id,
-                            'serviceName': network_service_name,
-                            'serviceType': 6}]}
-
-                            # Create a network service definition for each apn for each valid gateway selected
-                            # Each network service is the combination of a single device interface and the APN location.
-                            net_srv_config_data['serviceDetail'][0]['serviceMembers'] = []
-
-                            net_srv_config_data['serviceDetail'][0]['serviceMembers'].append({'enableAlert': True,
-                            'interfaceNumber': interface_number,
-                            'ipAddress': device_list[device][0],
-                            'locationKeyInfo': [{'asi1xType': '',
-                            'isLocationKey': True,
-                            'keyAttr': apn_ids[apn_name],
-                            'keyType': 4}],
-                            'meAlias': interface_alias,
-                            'meName': device_interface})
-
-                            # Create the new network service.
-                            create_service(ng1_host, headers, cookies, network_service_name, net_srv_config_data, False)
-                            # We need to know the id number that was assigned to this new network service, so we get_service_detail on it.
-                            net_srv_config_data = get_service_detail(ng1_host, network_service_name, headers, cookies)
-                            net_srv_id = net_srv_config_data['serviceDetail'][0]['id']
-                            # Add this network service id to our dictionary so we can use it later to assign domain members.
-                            net_service_ids[network_service_name] = net_srv_id
+        for dc_entry in apn_datacenters[apn_name]:
+            dc_acronym = inventory.datacenter_acronyms[dc_entry]
+            # Look up the interfaces in this datacenter whose gateway the user selected for this APN.
+            # The gateway is really the interface 'alias' attribute.
+            for interface in inventory.get_gateway_interfaces(valid_gateway_list_for_this_APN, dc_acronym):
+                network_service_name = dc_acronym + '-NWS-' + apn_name.replace(" ","_") + '-' + interface.alias
+#                network_service_name = dc_acronym + '-NWS-' + apn_name + '-' + interface.alias
+                if network_service_name in net_service_configs:
+                    # Another interface has the same gateway alias. Only the first one is created.
+                    continue
+
+                # Initialize the dictionary that we will use to build up our network service definition.
+                net_srv_config_data = {'serviceDetail': [{'alertProfileID': 2,
+                'exclusionListID': -1,
+                'id': -1,
+                'isAlarmEnabled': True,
+                'alertProfileID': ThroughPut_Baseline_profile_id,
+                'serviceName': network_service_name,
+                'serviceType': 6}]}
+
+                # Create a network service definition for each apn for each valid gateway selected
+                # Each network service is the combination of a single device interface and the APN location.
+                net_srv_config_data['serviceDetail'][0]['serviceMembers'] = []
+
+                net_srv_config_data['serviceDetail'][0]['serviceMembers'].append({'enableAlert': True,
+                'interfaceNumber': interface.interface_number,
+                'ipAddress': {'deviceIPAddress': interface.device_ip_address},
+                'locationKeyInfo': [{'asi1xType': '',
+                'isLocationKey': True,
+                'keyAttr': apn_ids[apn_name],
+                'keyType': 4}],
+                'meAlias': interface.alias,
+                'meName': interface.interface_name})
+
+                # Add this network service to the list of services to create.
+                net_service_configs[network_service_name] = net_srv_config_data
         apn_loop_counter += 1
 
-    return net_service_ids
+    return net_service_configs
 
 
-def create_all_ggsns_net_service(ng1_host, headers, cookies, apn_ids, device_list, profile, net_service_ids, dc_entry_list, ThroughPut_Baseline_profile_id):
+def build_all_ggsns_net_service_configs(apn_ids, inventory, profile, apn_datacenters, ThroughPut_Baseline_profile_id):
     # This function will build network services that include all GGSNs (interfaces) for each APN on...
     # every valid datacenter. Datacenters are validated using the gateway_list as a filter.
+    # apn_datacenters is a dictionary of {APN name: list of datacenters}, see get_apn_datacenters.
     # The format for naming each network service is {datacenter_abbreviation}-NWS-{apn_name}-All-GGSNs.
+    # Returns a dictionary of {network service name: network service config data}.
+    net_service_configs = {}
 
     # We will use a counter to index each APN in the customer profile.
     # The valid gateways can be different for each APN.
@@ -462,8 +958,8 @@ def create_all_ggsns_net_service(ng1_host, headers, cookies, apn_ids, device_lis
         for gateway_name in profile['APNs'][0]['APN'][apn_loop_counter]['gateways'][0]['gateway']:
             valid_gateway_list_for_this_APN.append(gateway_name['name'])
 
-        for dc_entry in dc_entry_list:
-            dc_acronym = translate_dc_name_to_acronym(dc_entry)
+        for dc_entry in apn_datacenters[apn_name]:
+            dc_acronym = inventory.datacenter_acronyms[dc_entry]
             network_service_name = dc_acronym + '-NWS-' + apn_name.replace(" ","_") + '-All-GGSNs'
 #            network_service_name = dc_acronym + '-NWS-' + apn_name + '-All-GGSNs'
 
@@ -478,41 +974,381 @@ def create_all_ggsns_net_service(ng1_host, headers, cookies, apn_ids, device_lis
             # Initialize an empty service members list to put all the gateways (interfaces) in.
             net_srv_config_data['serviceDetail'][0]['serviceMembers'] = []
             # Add service members to the All-GGSNs service definition.
-            for device in device_list:
-                # We need to pull interface details from the device list to populate service member attributes.
-                for device_interface_data in device_list[device][1]['interfaces']: # For each interface on each device.
-                    for device_interface in device_interface_data:
-                        # The gateway is really the interface 'alias' attribute, so pull that out of device_interface_data.
-                        device_interface_gateway = device_interface_data[device_interface][0]['alias']
-                        # Filter the global list of interfaces down to just those that are both associated...
-                        # to the APN we are looping on and the datacenter name we are looping on.
-                        # In other words, any interface in this datacenter that is also associated to this APN.
-
-                        if device_interface_gateway in valid_gateway_list_for_this_APN and dc_acronym in device_interface_gateway:
-                            interface_number = device_interface_data[device_interface][0]['interfaceNumber']
-                            interface_alias = device_interface_data[device_interface][0]['alias']
-                            net_srv_config_data['serviceDetail'][0]['serviceMembers'].append({'enableAlert': True,
-                            'interfaceNumber': interface_number,
-                            'ipAddress': device_list[device][0],
-                            'locationKeyInfo': [{'asi1xType': '',
-                            'isLocationKey': True,
-                            'keyAttr': apn_ids[apn_name],
-                            'keyType': 4}],
-                            'meAlias': interface_alias,
-                            'meName': device_interface})
-            # Create the new network service.
-            create_service(ng1_host, headers, cookies, network_service_name, net_srv_config_data, False)
-            # We need to know the id number that was assigned to this new network service.
-            net_srv_config_data = get_service_detail(ng1_host, network_service_name, headers, cookies)
-            net_srv_id = net_srv_config_data['serviceDetail'][0]['id']
-            # Add this network service id to our dictionary so we can use it later to assign domain members.
-            net_service_ids[network_service_name] = net_srv_id
+            # Look up the interfaces in this datacenter whose gateway the user selected for this APN.
+            # The gateway is really the interface 'alias' attribute.
+            for interface in inventory.get_gateway_interfaces(valid_gateway_list_for_this_APN, dc_acronym):
+                net_srv_config_data['serviceDetail'][0]['serviceMembers'].append({'enableAlert': True,
+                'interfaceNumber': interface.interface_number,
+                'ipAddress': {'deviceIPAddress': interface.device_ip_address},
+                'locationKeyInfo': [{'asi1xType': '',
+                'isLocationKey': True,
+                'keyAttr': apn_ids[apn_name],
+                'keyType': 4}],
+                'meAlias': interface.alias,
+                'meName': interface.interface_name})
+            # Add this network service to the list of services to create.
+            net_service_configs[network_service_name] = net_srv_config_data
         apn_loop_counter += 1
 
-    return net_service_ids
+    return net_service_configs
 
 
-def customer_menu(ng1_host, headers, cookies, apn_list, datacenter_list, customer_list, device_list):
+def get_apn_datacenters(profile, dc_entry_list):
+    # Return a dictionary of {APN name: list of datacenters} of the datacenters to create each APN's services in.
+    # An APN in a profile built from a manifest lists its own datacenters. Any other APN uses the customer's dc_entry_list.
+    apn_datacenters = {}
+    for apn in profile['APNs'][0]['APN']:
+        if 'datacenters' in apn:
+            apn_datacenters[apn['name']] = [datacenter for datacenter in dc_entry_list if datacenter in apn['datacenters']]
+        else:
+            apn_datacenters[apn['name']] = dc_entry_list
+    return apn_datacenters
+
+def provision_customer(ng1, profile, dc_entry_list, inventory, app_data, domain_index, known_service_ids=None, known_domain_ids=None):
+    # Create all of the network services, application services and dashboard domains for one customer profile.
+    # dc_entry_list is the list of datacenters to create services in for this customer, unless an APN lists its own.
+    # domain_index is updated with every domain we create, so that a batch of customers can share it.
+    # When resuming a run, known_service_ids is a dictionary of {service name: id} and known_domain_ids is...
+    # a dictionary of {domain path: id} of what the journal shows was already created. Those are not created again.
+    if known_service_ids == None:
+        known_service_ids = {}
+
+    # Fetch the APN id number that matches with each APN in the customer profile.
+    ng1.metrics.start_phase('APN lookup')
+    apn_ids = build_apn_ids_dict(ng1, profile, ng1.apn_catalogue)
+    apn_datacenters = get_apn_datacenters(profile, dc_entry_list)
+
+    # Build the definitions for all of the network services first.
+    # There is a network service for each interface (gateway) that the user specified, plus network services...
+    # that include all GGSNs (interfaces) for each APN on every valid datacenter.
+    net_service_configs = build_gateway_net_service_configs(apn_ids, inventory, profile, apn_datacenters, ng1.alert_profile_ids['ThroughPut-Baseline'])
+    net_service_configs.update(build_all_ggsns_net_service_configs(apn_ids, inventory, profile, apn_datacenters, ng1.alert_profile_ids['ThroughPut-Baseline']))
+    ng1.metrics.start_phase('network services')
+    # Create the network services. We will use the name:id key, value pairs for each network service...
+    # later to add members to the app services and to the dashboard domains that we create.
+    net_service_ids = create_missing_services(ng1, net_service_configs, known_service_ids, 'Network services')
+    if net_service_ids == False:
+        print('[CRITICAL] Unable to create all of the network services. No application services or domains will be created. Exiting...')
+        sys.exit()
+
+    ng1.metrics.start_phase('application services')
+    # Now build the application services for all apps defined in the app_data for each APN the user entered.
+    # Use the network services we already created as members for the app service definitions.
+    app_service_configs = build_app_service_configs(apn_ids, app_data, net_service_ids, apn_datacenters, ng1.alert_profile_ids,
+                                                    inventory.datacenter_acronyms)
+    # The app_service_ids list that is returned will become members of domains as we create them.
+    # Therefore we need the id numbers to do that assignment.
+    app_service_ids = create_missing_services(ng1, app_service_configs, known_service_ids, 'Application services')
+    if app_service_ids == False:
+        print('[CRITICAL] Unable to create all of the application services. No domains will be created. Exiting...')
+        sys.exit()
+
+    ng1.metrics.start_phase('domains')
+    # Build the definitions for the whole dashboard domain tree for this customer, then create the domains...
+    # in order, so that each parent domain exists before its children.
+    domain_configs = build_domain_configs(profile, apn_datacenters, list(apn_ids), list(net_service_ids), list(app_service_ids),
+                                          inventory.datacenter_acronyms)
+    service_ids = dict(net_service_ids)
+    service_ids.update(app_service_ids)
+    # When resuming, a domain may have been created just before the run stopped and not made it into the journal.
+    # Reuse any such domain from the domain tree rather than creating it twice.
+    with ng1.domain_lock:
+        create_domains(ng1, domain_configs, service_ids, domain_index,
+                       skip_existing=known_domain_ids != None, known_domain_ids=known_domain_ids)
+
+def create_missing_services(ng1, service_configs, known_service_ids, batch_name):
+    # Create the services in service_configs that are not in known_service_ids or in the service registry.
+    # Returns a dictionary of {service name: id} of every service in service_configs, in the same order,...
+    # or False if any of them could not be created.
+    if ng1.service_registry != None:
+        registry_service_ids = ng1.service_registry.get_service_ids()
+        registry_service_ids.update(known_service_ids)
+        known_service_ids = registry_service_ids
+    missing_service_names = [service_name for service_name in service_configs if service_name not in known_service_ids]
+    if len(missing_service_names) < len(service_configs):
+        print(f'[INFO] {batch_name}: {len(service_configs) - len(missing_service_names)} already exist, not created again')
+    created_service_ids = {}
+    if ng1.service_registry != None and missing_service_names != []:
+        # Leave the services that another customer is creating right now to them, and wait for their ids.
+        claimed_service_names = ng1.service_registry.claim(missing_service_names)
+        waiting_service_names = [service_name for service_name in missing_service_names if service_name not in claimed_service_names]
+        try:
+            if claimed_service_names != []:
+                created_service_ids, batch_report = create_services_batch(ng1, {service_name: service_configs[service_name] for service_name in claimed_service_names},
+                                                                          ng1.service_workers, batch_name)
+                if batch_report['failed'] != []:
+                    return False
+        finally:
+            ng1.service_registry.release(claimed_service_names, created_service_ids)
+        if waiting_service_names != []:
+            print(f'[INFO] {batch_name}: waiting for {len(waiting_service_names)} being created for another customer')
+            created_service_ids.update(ng1.service_registry.wait_for(waiting_service_names))
+        # Create any that the other customer could not.
+        missing_service_names = [service_name for service_name in waiting_service_names if service_name not in created_service_ids]
+    if missing_service_names != []:
+        batch_service_ids, batch_report = create_services_batch(ng1, {service_name: service_configs[service_name] for service_name in missing_service_names},
+                                                                ng1.service_workers, batch_name)
+        created_service_ids.update(batch_service_ids)
+        if ng1.service_registry != None:
+            ng1.service_registry.update(batch_service_ids)
+        if batch_report['failed'] != []:
+            return False
+    service_ids = {}
+    for service_name in service_configs:
+        if service_name in created_service_ids:
+            service_ids[service_name] = created_service_ids[service_name]
+        else:
+            service_ids[service_name] = known_service_ids[service_name]
+    return service_ids
+
+def build_domain_configs(profile, apn_datacenters, apn_names, net_service_names, app_service_names, datacenter_acronyms):
+    # Build the definitions for every dashboard domain for this customer, parents before children.
+    # apn_datacenters is a dictionary of {APN name: list of datacenters}, see get_apn_datacenters.
+    # Each definition is a dictionary of the domain name, the path of domain names to its parent...
+    # (not including the top 'Enterprise' domain), the names of the services that are its members and...
+    # whether it is a layer shared by all customers, which is only created if it does not already exist.
+    domain_configs = []
+    def add_domain(domain_name, parent_path, member_names, shared=False):
+        domain_configs.append({'name': domain_name, 'parent': parent_path, 'members': member_names, 'shared': shared})
+        return parent_path + (domain_name,)
+
+    # These are domain layers that are common to all customers. If they exist, don't overwrite them.
+    parent_path = add_domain('Cisco IOT', (), [], True)
+    parent_path = add_domain('APNs', parent_path, [], True)
+    if profile['type'] == 'Connected Cars':
+        parent_path = add_domain('Connected Car APNs', parent_path, [], True)
+    else:
+        parent_path = add_domain('IOT APNs', parent_path, [], True)
+
+    # Create the customer named domain. Note it is allowed that the customer named domain can be...
+    # the same as APN named domains below it. We have already checked in customer menu for duplicate...
+    # entries of the customer name. So this should create a unique customer name at this domain level.
+    # If there is only one APN, then add all datacenter interfaces for this one APN as members...
+    # of the customer domain. Otherwise, these will be added to the APN named domains.
+    member_names = []
+    if len(apn_names) == 1: # There is only one user entered APN name.
+        for network_service_name in net_service_names:
+            if apn_names[0].replace(" ","_") + '-All-GGSNs' in network_service_name:
+                member_names.append(network_service_name)
+    # Make the customer domain a child domain of either IOT APNs or Connected Car APNs.
+    customer_path = add_domain(profile['name'], parent_path, member_names)
+
+    for apn_name in apn_names:
+        if len(apn_names) > 1: # There are more than one user entered APN name
+            # Create a domain for each named APN including the All GGSNs network services for this APN as domain members.
+            member_names = [network_service_name for network_service_name in net_service_names
+                            if apn_name.replace(" ","_") + '-All-GGSNs' in network_service_name]
+            apn_path = add_domain(apn_name, customer_path, member_names)
+        else: # There is only one user entered APN name.
+            apn_path = customer_path
+
+        # Create a child domain 'Control' under the customer name domain or under each APN if more than one.
+        control_path = add_domain('Control', apn_path, [])
+        # Create a child domain under 'Control' for each datacenter name that the user entered.
+        for datacenter in apn_datacenters[apn_name]:
+            dc_path = add_domain(datacenter, control_path, [])
+            dc_acronym = datacenter_acronyms[datacenter]
+            # Add the GTPvx domains including the application services that include the GTP app name,...
+            # the APN name and the datacenter acronym. The domain names are the same list of apps for all customers.
+            for app_name in ['GTPv0', 'GTPv1', 'GTPv2']:
+                member_names = [application_service_name for application_service_name in app_service_names
+                                if app_name in application_service_name and application_service_name.startswith(dc_acronym + '-') and apn_name.replace(" ","_") in application_service_name]
+                add_domain(app_name, dc_path, member_names)
+
+        # Add the User and DNS domains as children to the customer domain if only one APN.
+        # If more than one APN, they are children of each APN named domain.
+        for domain_name, app_name in [('User', 'Web'), ('DNS', 'DNS')]:
+            member_names = []
+            for datacenter in apn_datacenters[apn_name]:
+                dc_acronym = datacenter_acronyms[datacenter]
+                for application_service_name in app_service_names:
+                    if app_name in application_service_name and application_service_name.startswith(dc_acronym + '-') and apn_name.replace(" ","_") in application_service_name:
+                        if application_service_name not in member_names:
+                            member_names.append(application_service_name)
+            add_domain(domain_name, apn_path, member_names)
+
+    return domain_configs
+
+def create_domains(ng1, domain_configs, service_ids, domain_index, skip_existing=False, known_domain_ids=None):
+    # Create the domains in domain_configs in order, using the service_ids dictionary to look up the id of each member.
+    # Members that are not in service_ids (because they could not be created) are left out.
+    # If skip_existing is True, any domain already in the domain index under the same parent is used as is.
+    # known_domain_ids is a dictionary of {domain path: id} of domains that are already created, such as from a journal.
+    domain_ids = {(): 1} # The path to a domain : its id. The parentID of the default 'Enterprise' domain at the top is 1.
+    for domain_config in domain_configs:
+        domain_name = domain_config['name']
+        domain_path = domain_config['parent'] + (domain_name,)
+        if known_domain_ids != None and domain_path in known_domain_ids:
+            domain_ids[domain_path] = known_domain_ids[domain_path]
+            continue
+        domain_key = (domain_name, str(domain_ids[domain_config['parent']]))
+        if skip_existing == True and domain_key in domain_index:
+            domain_ids[domain_path] = domain_index[domain_key]
+            continue
+        if domain_config['shared'] == True:
+            skip, existing_domain_id = domain_exists(domain_name, domain_index)
+            if skip == True: # The domain already exists, use it as the parent for the next domain.
+                domain_ids[domain_path] = existing_domain_id
+                continue
+        domain_member_ids = {}
+        for member_name in domain_config['members']:
+            if member_name in service_ids:
+                domain_member_ids[member_name] = service_ids[member_name]
+        domain_ids[domain_path] = build_domain_tree(ng1, domain_name, domain_ids[domain_config['parent']], domain_member_ids, domain_index)
+        if ng1.journal != None:
+            ng1.journal.record({'type': 'domain', 'path': list(domain_path), 'id': domain_ids[domain_path]})
+
+    return domain_ids
+
+def get_customer_datacenters(profile, datacenter_acronyms):
+    # Customer profiles from the customer menu do not include the list of datacenters that were selected for the customer.
+    # Work it out from the gateways in the profile, as every gateway name includes its datacenter acronym, and...
+    # from the datacenters listed by any APN that came from a manifest.
+    # Returns the datacenters in datacenter_acronyms order.
+    gateway_names = []
+    apn_datacenters = set()
+    for apn in profile['APNs'][0]['APN']:
+        apn_datacenters.update(apn.get('datacenters', []))
+        for apn_gateway in apn['gateways'][0]['gateway']:
+            gateway_names.append(apn_gateway['name'])
+    dc_entry_list = []
+    for datacenter, dc_acronym in datacenter_acronyms.items():
+        if datacenter in apn_datacenters or any(has_datacenter_acronym(gateway_name, dc_acronym) for gateway_name in gateway_names):
+            dc_entry_list.append(datacenter)
+    return dc_entry_list
+
+def reconcile_customer(ng1, profile, dc_entry_list, inventory, app_data, service_ids, domain_index):
+    # Compare the services and domains this customer should have against what is in nG1 and create only...
+    # the ones that are missing. service_ids is a dictionary of {service name: id} of every service in nG1...
+    # and domain_index is the index of every domain in nG1. Both are updated with what we create.
+    # Existing services and domains are not changed, even if their members are different.
+    # Returns the number of services and the number of domains that were created.
+    ng1.metrics.start_phase('APN lookup')
+    apn_ids = build_apn_ids_dict(ng1, profile, ng1.apn_catalogue)
+    apn_datacenters = get_apn_datacenters(profile, dc_entry_list)
+    ng1.metrics.start_phase('network services')
+
+    net_service_configs = build_gateway_net_service_configs(apn_ids, inventory, profile, apn_datacenters, ng1.alert_profile_ids['ThroughPut-Baseline'])
+    net_service_configs.update(build_all_ggsns_net_service_configs(apn_ids, inventory, profile, apn_datacenters, ng1.alert_profile_ids['ThroughPut-Baseline']))
+    services_before = len(service_ids) # Every service we create is added to service_ids.
+    net_service_ids = create_missing_services(ng1, net_service_configs, service_ids, 'Network services')
+    if net_service_ids == False:
+        print('[CRITICAL] Unable to create all of the network services. No application services or domains will be created. Exiting...')
+        sys.exit()
+    service_ids.update(net_service_ids)
+
+    ng1.metrics.start_phase('application services')
+    app_service_configs = build_app_service_configs(apn_ids, app_data, net_service_ids, apn_datacenters, ng1.alert_profile_ids,
+                                                    inventory.datacenter_acronyms)
+    app_service_ids = create_missing_services(ng1, app_service_configs, service_ids, 'Application services')
+    if app_service_ids == False:
+        print('[CRITICAL] Unable to create all of the application services. No domains will be created. Exiting...')
+        sys.exit()
+    service_ids.update(app_service_ids)
+    services_created = len(service_ids) - services_before
+
+    ng1.metrics.start_phase('domains')
+    domain_configs = build_domain_configs(profile, apn_datacenters, list(apn_ids), list(net_service_configs), list(app_service_configs),
+                                          inventory.datacenter_acronyms)
+    domains_before = len(domain_index) # Every domain we create is added to the domain index.
+    create_domains(ng1, domain_configs, service_ids, domain_index, skip_existing=True)
+
+    return services_created, len(domain_index) - domains_before
+
+def build_customer_plan(ng1, profile, dc_entry_list, inventory, app_data, domain_index, planned_shared_domains, known_service_names):
+    # Work out everything that provision_customer would create for this customer without making any changes to nG1.
+    # Only the lookups of APNs missing from the APN catalogue are sent to nG1, and they are read only.
+    # planned_shared_domains is a set of the shared domain layers that an earlier customer in the same plan creates.
+    # known_service_names is a set of the services that exist or that an earlier customer in the same plan creates.
+    # Returns the plan for this customer, including the number of each kind of API call that creating it would take.
+    apn_ids = build_apn_ids_dict(ng1, profile, ng1.apn_catalogue)
+    apn_datacenters = get_apn_datacenters(profile, dc_entry_list)
+    net_service_configs = build_gateway_net_service_configs(apn_ids, inventory, profile, apn_datacenters, ng1.alert_profile_ids['ThroughPut-Baseline'])
+    net_service_configs.update(build_all_ggsns_net_service_configs(apn_ids, inventory, profile, apn_datacenters, ng1.alert_profile_ids['ThroughPut-Baseline']))
+    # The network services have no id numbers yet. Their names are in each application service member.
+    planned_net_service_ids = dict.fromkeys(net_service_configs)
+    app_service_configs = build_app_service_configs(apn_ids, app_data, planned_net_service_ids, apn_datacenters, ng1.alert_profile_ids,
+                                                    inventory.datacenter_acronyms)
+    domain_configs = build_domain_configs(profile, apn_datacenters, list(apn_ids), list(net_service_configs), list(app_service_configs),
+                                          inventory.datacenter_acronyms)
+
+    customer_plan = {'name': profile['name'], 'type': profile['type'], 'datacenters': dc_entry_list,
+                     'network_services': [], 'application_services': [], 'domains': []}
+    for service_name in net_service_configs:
+        service_members = net_service_configs[service_name]['serviceDetail'][0]['serviceMembers']
+        customer_plan['network_services'].append({'name': service_name, 'members': [member['meAlias'] for member in service_members],
+                                                  'exists': service_name in known_service_names})
+    for service_name in app_service_configs:
+        service_members = app_service_configs[service_name]['serviceDetail'][0]['serviceMembers']
+        customer_plan['application_services'].append({'name': service_name,
+                                                      'members': list(dict.fromkeys(member['networkDomainName'] for member in service_members)),
+                                                      'exists': service_name in known_service_names})
+    net_services_to_create = len([service for service in customer_plan['network_services'] if service['exists'] == False])
+    app_services_to_create = len([service for service in customer_plan['application_services'] if service['exists'] == False])
+    known_service_names.update(net_service_configs)
+    known_service_names.update(app_service_configs)
+    domains_to_create = 0
+    for domain_config in domain_configs:
+        domain_exists_already = False
+        if domain_config['shared'] == True:
+            domain_exists_already = domain_config['name'] in planned_shared_domains or \
+                any(domain_config['name'] == existing_domain_name for existing_domain_name, existing_parent_id in domain_index)
+            planned_shared_domains.add(domain_config['name'])
+        if domain_exists_already == False:
+            domains_to_create += 1
+        customer_plan['domains'].append({'name': domain_config['name'], 'parent': '/'.join(('Enterprise',) + domain_config['parent']),
+                                         'members': domain_config['members'], 'exists': domain_exists_already})
+
+    # Count the API calls it takes to create all of this. The counts assume nG1 does not return the new ids...
+    # when a service or domain is created, so they are the most calls it can take.
+    # One listing to find the new service ids after each tier that has services to create.
+    service_listings = (net_services_to_create > 0) + (app_services_to_create > 0)
+    # build_apn_ids_dict only looks up the APNs that are missing from the APN catalogue.
+    apn_lookups = len([apn_name for apn_name in apn_ids if 'id' not in ng1.apn_catalogue.get(apn_name, {})])
+    customer_plan['api_calls'] = {'GET /apns/{name}': apn_lookups,
+                                  'POST /services': net_services_to_create + app_services_to_create,
+                                  'GET /services': service_listings,
+                                  'POST /domains': domains_to_create,
+                                  'GET /domains/{name}': domains_to_create}
+    # The services in each tier are created ng1.service_workers at a time, everything else is one call after another.
+    customer_plan['api_call_rounds'] = (apn_lookups + math.ceil(net_services_to_create / ng1.service_workers)
+                                        + math.ceil(app_services_to_create / ng1.service_workers) + service_listings + 2 * domains_to_create)
+    return customer_plan
+
+def build_plan(ng1, customer_batch, inventory, app_data, domain_index):
+    # Build the plan for a batch of customers, with the totals and an estimate of how long creating it will take.
+    # The estimate uses the average latency of the API calls that this run has made to nG1 so far.
+    plan = {'ng1_host': ng1.host, 'created': datetime.now().isoformat(timespec='seconds'), 'customers': []}
+    planned_shared_domains = set()
+    known_service_names = set()
+    if ng1.service_registry != None:
+        known_service_names.update(ng1.service_registry.get_service_ids())
+    for profile, dc_entry_list in customer_batch:
+        plan['customers'].append(build_customer_plan(ng1, profile, dc_entry_list, inventory, app_data, domain_index,
+                                                     planned_shared_domains, known_service_names))
+
+    api_calls = defaultdict(int)
+    api_call_rounds = 0
+    for customer_plan in plan['customers']:
+        for api_call in customer_plan['api_calls']:
+            api_calls[api_call] += customer_plan['api_calls'][api_call]
+        api_call_rounds += customer_plan['api_call_rounds']
+    seconds_per_call = ng1.metrics.average_request_seconds()
+    if seconds_per_call == None:
+        seconds_per_call = plan_default_request_seconds
+    plan['totals'] = {'customers': len(plan['customers']),
+                      'network_services': sum(len([service for service in customer_plan['network_services'] if service['exists'] == False])
+                                              for customer_plan in plan['customers']),
+                      'application_services': sum(len([service for service in customer_plan['application_services'] if service['exists'] == False])
+                                                  for customer_plan in plan['customers']),
+                      'domains': sum(len([domain for domain in customer_plan['domains'] if domain['exists'] == False]) for customer_plan in plan['customers']),
+                      'api_calls': dict(api_calls),
+                      'total_api_calls': sum(api_calls.values()),
+                      'seconds_per_api_call': round(seconds_per_call, 4),
+                      'estimated_seconds': round(api_call_rounds * seconds_per_call, 1)}
+    return plan
+
+def customer_menu(ng1, apn_catalogue, customer_list, inventory):
     # This function is an entry menu for entering new customer information.
     # It takes in a customer name, a list of APNs, the customer type and a list of valid datacenters.
     # It returns the user's entries as a profile dictionary.
@@ -571,7 +1407,7 @@ def customer_menu(ng1_host, headers, cookies, apn_list, datacenter_list, custome
             continue
 
     print("\nCurrent APNs available are: ")
-    print(sorted(apn_list), '\n')
+    print(sorted(apn_catalogue), '\n')
 
     # Initialize an empty list to hold user entered APNs.
     apn_entry_list = []
@@ -598,8 +1434,9 @@ def customer_menu(ng1_host, headers, cookies, apn_list, datacenter_list, custome
             i += 1
 
     # Check to see if the entered APNs are in the list of available system-wide APNs.
+    refresh_apn_catalogue(ng1, apn_entry_list)
     for apn_entry in apn_entry_list:
-        if apn_entry not in apn_list: # These are case sensitive. only allow perfect matches.
+        if apn_entry not in apn_catalogue: # These are case sensitive. only allow perfect matches.
             # We have checked every APN entry against every system-wide APN. Not found.
             print(f"[CRITICAL] APN: {apn_entry} does not yet exist")
             print(f"Please create APN: {apn_entry} first and then run this program again")
@@ -608,7 +1445,7 @@ def customer_menu(ng1_host, headers, cookies, apn_list, datacenter_list, custome
 
     # Build up a list of valid datatcenters where each entered APN is associated to one or more interfaces.
     # Build up a list of valid gateways where each entered APN is associated to one or more interfaces.
-    valid_datacenters, valid_gateways = build_valid_dc_and_gateway_lists(apn_entry_list, datacenter_list, device_list)
+    valid_datacenters, valid_gateways = build_valid_dc_and_gateway_lists(apn_entry_list, inventory)
 
     # Add the user entered APNs to the customer profile dictionary.
     for apn_entry in apn_entry_list:
@@ -621,6 +1458,9 @@ def customer_menu(ng1_host, headers, cookies, apn_list, datacenter_list, custome
         valid_gateways_list = valid_gateways[apn_loop_counter][apn_entry]
 
         print(f"\nDatacenters associated to APN {apn_entry} are: {valid_datacenters_list}")
+        if valid_datacenters_list == []:
+            print(f"[WARNING] APN: {apn_entry} is not associated to any gateways in the inventory")
+            print("If it was associated after the inventory cache was saved, run this program again with --refresh-inventory")
 
         # Initialize an empty list to hold user entered datacenters
         dc_entry_list = []
@@ -649,7 +1489,7 @@ def customer_menu(ng1_host, headers, cookies, apn_list, datacenter_list, custome
 
         # Check to see if the entered datacenters are in the list of available system-wide datacenters.
         for dc_entry in dc_entry_list:
-            if dc_entry not in valid_datacenters_list: # You must capitalize the dc entry or we will not allow it.
+            if dc_entry not in inventory.apn_datacenters[apn_entry]: # You must capitalize the dc entry or we will not allow it.
                 # We have checked every Datacenter entry against every valid datacenter. Not found.
                 print(f"[CRITICAL] Datacenter: {dc_entry} is not in the list of valid datacenters {valid_datacenters_list}")
                 print(f"Please create Datacenter: {dc_entry} first and then run this program again")
@@ -660,9 +1500,9 @@ def customer_menu(ng1_host, headers, cookies, apn_list, datacenter_list, custome
         # Only list those APN associated gateways (interfaces) for the user entered datacenters.
         for dc_entry in dc_entry_list:
             filtered_gateways_list = []
+            dc_acronym = inventory.datacenter_acronyms[dc_entry]
             for valid_gateway in valid_gateways_list:
-                dc_acronym = translate_dc_name_to_acronym(dc_entry)
-                if dc_acronym in valid_gateway:
+                if has_datacenter_acronym(valid_gateway, dc_acronym):
                     filtered_gateways_list.append(valid_gateway)
             print(f"\nGateways associated to APN {apn_entry} in {dc_entry} are: {filtered_gateways_list}")
             while True:
@@ -689,7 +1529,7 @@ def customer_menu(ng1_host, headers, cookies, apn_list, datacenter_list, custome
                     i += 1
             # Check to make sure that what the user entered is in the list of valid gateways.
             for gateway_entry in gateway_entry_list:
-                if gateway_entry not in valid_gateways_list: # Check if this gateway has this APN associated with it.
+                if gateway_entry not in inventory.apn_gateways[apn_entry]: # Check if this gateway has this APN associated with it.
                     print(f"[CRITICAL] Gateway: {gateway_entry} is not in the list of valid gateways {valid_gateways_list}")
                     print(f"Please create Gateway: {gateway_entry} first and then run this program again")
                     print("No nG1 modifications will be made. Exiting...")
@@ -728,66 +1568,1090 @@ def customer_menu(ng1_host, headers, cookies, apn_list, datacenter_list, custome
             print("Invalid entry, please enter 'y' or 'n'")
             continue
 
-def open_session(ng1_host, headers, cookies, credentials):
-    open_session_uri = "/ng1api/rest-sessions"
-    open_session_url = ng1_host + open_session_uri
+def read_customer_manifest(manifest_filename):
+    # Read a batch of new customers from a manifest file instead of the customer menu.
+    # A .csv manifest has one row per customer APN and datacenter with the columns:
+    # customer,type,apn,datacenter,gateway. Leave datacenter or gateway empty (or enter all) for all of them.
+    # Gateways may be separated by a space or a semicolon.
+    # Any other manifest is read as json in the form:
+    # {"Customers": [{"name": "", "type": "IOT", "APNs": [{"name": "", "datacenters": "all", "gateways": "all"}]}]}
+    # where datacenters and gateways are either a list of names or 'all'.
+    # Returns the list of manifest customers in the json form.
+    if not os.path.isfile(manifest_filename):
+        print(f'[CRITICAL] Customer manifest file: {manifest_filename} not found. Exiting...')
+        sys.exit()
 
-    # perform the HTTPS API call to open the session with nG1 and return a session cookie
-    try:
-        if credentials == 'Null':
-            # Null credentials tells us to use the token. We will use this post and pass in the cookies as the token.
-            post = requests.request("POST", open_session_url, headers=headers, verify=False, cookies=cookies)
-        elif cookies == 'Null':
-            # Null cookies tells us to use the credentials string. We will use this post and pass in the credentials string.
-            #split the credentials string into two parts; username and password
-            ng1username = credentials.split(':')[0]
-            ng1password_pl = credentials.split(':')[1]
-            post = requests.request("POST", open_session_url, headers=headers, verify=False, auth=(ng1username, ng1password_pl))
-        else:
-            print(f'[CRITICAL] opening session to URL: {open_session_url} failed')
-            print('Unable to determine authentication by credentials or token')
-            print('Exiting the program now...')
+    if manifest_filename.lower().endswith('.csv'):
+        manifest_customers = {} # Customer name : manifest customer, in the order they appear in the file.
+        try:
+            with open(manifest_filename, newline='') as f:
+                for row in csv.DictReader(f):
+                    customer_name = (row.get('customer') or '').strip()
+                    apn_name = (row.get('apn') or '').strip()
+                    datacenter = (row.get('datacenter') or '').strip()
+                    gateways = (row.get('gateway') or '').replace(';', ' ').upper().split()
+                    if customer_name not in manifest_customers:
+                        manifest_customers[customer_name] = {'name': customer_name, 'type': (row.get('type') or '').strip(), 'APNs': []}
+                    manifest_apns = {apn['name']: apn for apn in manifest_customers[customer_name]['APNs']}
+                    if apn_name not in manifest_apns:
+                        manifest_apns[apn_name] = {'name': apn_name, 'datacenters': [], 'gateways': []}
+                        manifest_customers[customer_name]['APNs'].append(manifest_apns[apn_name])
+                    manifest_apn = manifest_apns[apn_name]
+                    # An empty datacenter or gateway column means all of them.
+                    if datacenter == '' or datacenter.lower() == 'all':
+                        manifest_apn['datacenters'] = 'all'
+                    elif manifest_apn['datacenters'] != 'all' and datacenter not in manifest_apn['datacenters']:
+                        manifest_apn['datacenters'].append(datacenter)
+                    if gateways == [] or gateways == ['ALL']:
+                        manifest_apn['gateways'] = 'all'
+                    elif manifest_apn['gateways'] != 'all':
+                        manifest_apn['gateways'].extend(gateway for gateway in gateways if gateway not in manifest_apn['gateways'])
+        except (OSError, csv.Error) as e:
+            print(f'[CRITICAL] Unable to read the customer manifest file: {manifest_filename}: {e}. Exiting...')
             sys.exit()
-        if post.status_code == 200:
-            # success
-            print('[INFO] Opened Session Successfully')
+        return list(manifest_customers.values())
+
+    manifest_data = read_config_from_json(manifest_filename)
+    if manifest_data == False or not isinstance(manifest_data, dict) or not isinstance(manifest_data.get('Customers'), list):
+        print(f'[CRITICAL] Unable to fetch Customers from the customer manifest file: {manifest_filename}. Exiting...')
+        sys.exit()
+    return manifest_data['Customers']
+
+def build_manifest_profiles(ng1, manifest_customers, customer_list, inventory, datacenter_acronyms):
+    # Validate every customer in the manifest against the one inventory we loaded, the same way the...
+    # customer menu validates what the user types in, and build a customer profile for each.
+    # Nothing is created in nG1 unless every customer in the manifest is valid.
+    # Returns a list of (profile, dc_entry_list) tuples and a list of every error that was found.
+    batch = []
+    errors = []
+    # The manifest is json from outside the program, so check the type of every customer and APN entry first.
+    typed_manifest_customers = []
+    for customer_number, manifest_customer in enumerate(manifest_customers, 1):
+        if not isinstance(manifest_customer, dict):
+            errors.append(f'Customer number {customer_number} in the manifest must be an object with a name, type and APNs')
+            continue
+        customer_label = str(manifest_customer.get('name', f'number {customer_number}')).strip()
+        if not isinstance(manifest_customer.get('APNs', []), list):
+            errors.append(f'Customer: {customer_label} APNs must be a list')
+            continue
+        if not all(isinstance(manifest_apn, dict) for manifest_apn in manifest_customer.get('APNs', [])):
+            errors.append(f'Customer: {customer_label} every APN must be an object with a name')
+            continue
+        typed_manifest_customers.append(manifest_customer)
+    manifest_customers = typed_manifest_customers
+    manifest_apn_names = []
+    for manifest_customer in manifest_customers:
+        for manifest_apn in manifest_customer.get('APNs', []):
+            manifest_apn_names.append(str(manifest_apn.get('name', '')).strip())
+    refresh_apn_catalogue(ng1, manifest_apn_names)
+    apn_catalogue = ng1.apn_catalogue
+    existing_customers = set(customer_name.lower() for customer_name in customer_list)
+    manifest_customer_names = set()
+    customer_types = {'iot': 'IOT', 'connected cars': 'Connected Cars'}
+    for manifest_customer in manifest_customers:
+        customer_name = str(manifest_customer.get('name', '')).strip()
+        if customer_name == '':
+            errors.append('A customer in the manifest has no name')
+            continue
+        if customer_name.lower() in existing_customers:
+            errors.append(f'Customer: {customer_name} already exists')
+        elif customer_name.lower() in manifest_customer_names:
+            errors.append(f'Customer: {customer_name} is listed in the manifest more than once')
+        manifest_customer_names.add(customer_name.lower())
+        if check_splcharacter(customer_name, True) == True:
+            errors.append(f'Customer: {customer_name} contains special characters')
+        customer_type = customer_types.get(str(manifest_customer.get('type', '')).strip().lower())
+        if customer_type == None:
+            errors.append(f"Customer: {customer_name} type must be either 'IOT' or 'Connected Cars'")
+
+        profile = {'name':customer_name, 'type':customer_type, 'APNs':[{'APN':[]}]}
+        customer_datacenters = {} # Every datacenter selected for any of this customer's APNs, used as a set.
+        if manifest_customer.get('APNs', []) == []:
+            errors.append(f'Customer: {customer_name} has no APNs')
+        for manifest_apn in manifest_customer.get('APNs', []):
+            apn_entry = str(manifest_apn.get('name', '')).strip()
+            if apn_entry not in apn_catalogue: # These are case sensitive. only allow perfect matches.
+                errors.append(f'Customer: {customer_name} APN: {apn_entry} does not yet exist')
+                continue
+            valid_datacenters_list = list(inventory.apn_datacenters[apn_entry])
+            valid_gateways_list = list(inventory.apn_gateways[apn_entry])
+            if valid_datacenters_list == []:
+                errors.append(f'Customer: {customer_name} APN: {apn_entry} is not associated to any gateways in the inventory. '
+                              'If it was associated after the inventory cache was saved, run again with --refresh-inventory')
+                continue
+
+            dc_entry_list = manifest_apn.get('datacenters', 'all')
+            gateway_entry_list = manifest_apn.get('gateways', 'all')
+            invalid_fields = [field for field, value in [('datacenters', dc_entry_list), ('gateways', gateway_entry_list)]
+                              if value != 'all' and not (isinstance(value, list) and all(isinstance(entry, str) for entry in value))]
+            for field in invalid_fields:
+                errors.append(f"Customer: {customer_name} APN: {apn_entry} {field} must be 'all' or a list of names")
+            if invalid_fields != []:
+                continue
+            if dc_entry_list == 'all' or dc_entry_list == []:
+                dc_entry_list = valid_datacenters_list
+            for dc_entry in dc_entry_list:
+                if dc_entry not in inventory.apn_datacenters[apn_entry]:
+                    errors.append(f'Customer: {customer_name} Datacenter: {dc_entry} is not in the list of valid datacenters {valid_datacenters_list} for APN {apn_entry}')
 
-            # utilize the returned cookie for future authentication
-            cookies = post.cookies
-            # print ('Cookie : ', cookies)
-            return cookies
+            # Only the APN associated gateways (interfaces) in the selected datacenters are valid.
+            filtered_gateways_list = []
+            for dc_entry in dc_entry_list:
+                if dc_entry not in inventory.apn_datacenters[apn_entry]:
+                    continue # Already reported above.
+                dc_acronym = inventory.datacenter_acronyms[dc_entry]
+                for valid_gateway in valid_gateways_list:
+                    if has_datacenter_acronym(valid_gateway, dc_acronym) and valid_gateway not in filtered_gateways_list:
+                        filtered_gateways_list.append(valid_gateway)
+            if gateway_entry_list == 'all' or gateway_entry_list == []:
+                gateway_entry_list = filtered_gateways_list
+            else:
+                gateway_entry_list = [str(gateway_entry).strip().upper() for gateway_entry in gateway_entry_list]
+            for gateway_entry in gateway_entry_list:
+                if gateway_entry not in filtered_gateways_list:
+                    errors.append(f'Customer: {customer_name} Gateway: {gateway_entry} is not in the list of valid gateways {filtered_gateways_list} for APN {apn_entry}')
 
+            # Each APN keeps its own datacenters, so that its services are only created in those. See get_apn_datacenters.
+            profile['APNs'][0]['APN'].append({'name':apn_entry, 'datacenters':list(dc_entry_list),
+                                              'gateways':[{'gateway':[{'name':gateway_entry} for gateway_entry in gateway_entry_list]}]})
+            for dc_entry in dc_entry_list:
+                customer_datacenters[dc_entry] = None
+
+        # Every datacenter selected for any of the customer's APNs, in datacenter_acronyms order.
+        dc_entry_list = [datacenter for datacenter in datacenter_acronyms if datacenter in customer_datacenters]
+        batch.append((profile, dc_entry_list))
+
+    return batch, errors
+
+class ProvisioningDaemon():
+    # Runs the program as a long running service that adds customers sent to it over a local HTTP API.
+    # The session, the alert profile ids, the APN catalogue, the inventory and the domain index are loaded once...
+    # and kept in memory, so a new customer costs only the calls that create its services and domains.
+    # The inventory is kept up to date by an InventoryRefresher. The alert profile ids, the service registry and the...
+    # domain index are reloaded in the background every refresh_seconds, and the nG1 session is re-opened as it ages.
+    # Each job is a batch of customers in the same form as a json manifest. Jobs are validated when they are...
+    # submitted and then run, in the order they were submitted, by a pool of job_workers threads.
+    # The API listens on 127.0.0.1 only:
+    #     POST /jobs           Submit {"Customers": [...]}. Returns 202 and the job, or 400 and the errors.
+    #     GET  /jobs           Every job since the daemon started.
+    #     GET  /jobs/<id>      One job. Its status is queued, running, done or failed.
+    #     GET  /status         The age of the session and inventory, and the number of queued and running jobs.
+
+    def __init__(self, ng1, app_data, inventory_refresher, domain_index, customer_configs, customer_list, customer_filenames,
+                 service_cache_filename, job_workers=2, refresh_seconds=900, inventory_refresh_seconds=300):
+        # customer_filenames is the (new, current, old) customers filenames passed to save_cust_config_to_file.
+        # The ng1 context must have a service registry, which is saved to service_cache_filename after every job.
+        self.ng1 = ng1
+        self.app_data = app_data
+        # The refresher's inventory is replaced, not changed, by a refresh, so a running job keeps the one it started with.
+        self.inventory_refresher = inventory_refresher
+        self.domain_index = domain_index # Only changed while holding ng1.domain_lock.
+        self.customer_configs = customer_configs
+        self.customer_list = customer_list
+        self.customer_filenames = customer_filenames
+        self.service_cache_filename = service_cache_filename
+        self.job_workers = job_workers
+        self.refresh_seconds = refresh_seconds
+        self.inventory_refresh_seconds = inventory_refresh_seconds
+        self.refreshed_time = time.monotonic()
+        self.lock = threading.Lock() # Guards jobs, reserved_customers and the customers file.
+        self.jobs = {} # Job id : job.
+        self.next_job_id = 0
+        self.job_queue = queue.Queue()
+        # The lower case names of the customers in queued or running jobs, so the same customer cannot be...
+        # submitted twice before the first job has saved it to the customers file.
+        self.reserved_customers = set()
+
+    def submit_job(self, manifest_customers):
+        # Validate a batch of customers and queue it. Returns the job, or None and the list of errors.
+        with self.lock:
+            customer_list = self.customer_list + list(self.reserved_customers)
+            customer_batch, errors = build_manifest_profiles(self.ng1, manifest_customers, customer_list,
+                                                             self.inventory_refresher.inventory, self.inventory_refresher.datacenter_acronyms)
+            if errors == [] and customer_batch == []:
+                errors = ['There are no customers in the job']
+            if errors != []:
+                return None, errors
+            self.next_job_id += 1
+            job = {'id': self.next_job_id,
+                   'status': 'queued',
+                   'customers': [profile['name'] for profile, dc_entry_list in customer_batch],
+                   'customers_done': [],
+                   'submitted': datetime.now().isoformat(timespec='seconds'),
+                   'started': None,
+                   'finished': None,
+                   'error': None}
+            self.jobs[job['id']] = job
+            self.reserved_customers.update(customer_name.lower() for customer_name in job['customers'])
+        print(f"[INFO] Job {job['id']} queued: {job['customers']}")
+        logger.info(f"Job {job['id']} queued: {job['customers']}")
+        self.job_queue.put((job, customer_batch))
+        return job, []
+
+    def run_jobs(self):
+        # The loop of each job worker thread.
+        while True:
+            job, customer_batch = self.job_queue.get()
+            self.run_job(job, customer_batch)
+            self.job_queue.task_done()
+
+    def run_job(self, job, customer_batch):
+        job['status'] = 'running'
+        job['started'] = datetime.now().isoformat(timespec='seconds')
+        inventory = self.inventory_refresher.inventory
+        # Jobs run at the same time as each other and the refreshes, so each records its phases and calls on its own.
+        job_metrics = RunMetrics(self.ng1.metrics.latency_samples)
+        job_ng1 = self.ng1.with_metrics(job_metrics)
+        try:
+            for profile, dc_entry_list in customer_batch:
+                print(f"[INFO] Job {job['id']}: creating the nG1 configuration for customer: {profile['name']}")
+                provision_customer(job_ng1, profile, dc_entry_list, inventory, self.app_data, self.domain_index)
+                with self.lock:
+                    self.customer_configs['Customers'].append(profile)
+                    self.customer_list.append(profile['name'])
+                    save_cust_config_to_file(self.customer_configs, *self.customer_filenames)
+                job['customers_done'].append(profile['name'])
+            job['status'] = 'done'
+        # provision_customer exits when it cannot carry on. Here that ends the job rather than the daemon.
+        except (Exception, SystemExit) as error:
+            job['status'] = 'failed'
+            job['error'] = str(error) if not isinstance(error, SystemExit) else 'Unable to create all of the services, see the daemon output'
+            print(f"[ERROR] Job {job['id']} failed after {len(job['customers_done'])} of {len(job['customers'])} customers: {job['error']}")
+            logger.error(f"Job {job['id']} failed: {job['error']}")
+        job['finished'] = datetime.now().isoformat(timespec='seconds')
+        job_api_calls = job_metrics.api_call_count()
+        self.ng1.metrics.merge(job_metrics)
+        self.ng1.service_registry.save(self.service_cache_filename)
+        with self.lock:
+            self.reserved_customers.difference_update(customer_name.lower() for customer_name in job['customers'])
+        if job['status'] == 'done':
+            print(f"[INFO] Job {job['id']} done with {job_api_calls} API calls: {job['customers']}")
+            logger.info(f"Job {job['id']} done with {job_api_calls} API calls: {job['customers']}")
+
+    def refresh(self):
+        # Reload the alert profile ids, the service registry and the domain index from nG1. What could not be...
+        # reloaded is kept as it was.
+        refresh_metrics = RunMetrics(self.ng1.metrics.latency_samples)
+        refresh_metrics.start_phase('daemon refresh')
+        refresh_ng1 = self.ng1.with_metrics(refresh_metrics)
+        try:
+            self.ng1.alert_profile_ids = resolve_alert_profile_ids(refresh_ng1, ['ThroughPut-Baseline'] + get_app_alert_profile_names(self.app_data),
+                                                                   self.ng1.discovery_workers)
+            self.ng1.service_registry.seed(refresh_ng1)
+            self.ng1.service_registry.save(self.service_cache_filename)
+            domain_tree_data = get_domains(refresh_ng1)
+            with self.ng1.domain_lock:
+                self.domain_index.clear()
+                self.domain_index.update(build_domain_index(domain_tree_data))
+            self.refreshed_time = time.monotonic()
+        except (Exception, SystemExit) as error:
+            print(f'[WARNING] Unable to refresh the alert profiles, services and domain tree, carrying on with the ones loaded before: {error}')
+            logger.warning(f'Unable to refresh the alert profiles, services and domain tree: {error}')
+        self.ng1.metrics.merge(refresh_metrics)
+
+    def run_refresh(self):
+        # The loop of the background refresh thread.
+        while True:
+            time.sleep(self.refresh_seconds)
+            self.refresh()
+
+    def get_status(self):
+        with self.lock:
+            job_statuses = [job['status'] for job in self.jobs.values()]
+            status = {'ng1_host': self.ng1.host,
+                      'inventory_age_seconds': round(time.monotonic() - self.inventory_refresher.refreshed_time),
+                      'inventory_refreshes': self.inventory_refresher.refresh_count,
+                      'domain_tree_age_seconds': round(time.monotonic() - self.refreshed_time),
+                      'devices': len(self.inventory_refresher.inventory.devices),
+                      'apns': len(self.ng1.apn_catalogue),
+                      'jobs_queued': job_statuses.count('queued'),
+                      'jobs_running': job_statuses.count('running'),
+                      'jobs_done': job_statuses.count('done'),
+                      'jobs_failed': job_statuses.count('failed')}
+        if self.ng1.session != None:
+            status['session_age_seconds'] = round(time.monotonic() - self.ng1.session.opened_time)
+        return status
+
+    def serve(self, port):
+        # Start the job workers and the refresh thread, then answer API requests until the program is stopped.
+        for worker_number in range(self.job_workers):
+            threading.Thread(target=self.run_jobs, name=f'job-worker-{worker_number}', daemon=True).start()
+        if self.refresh_seconds > 0:
+            threading.Thread(target=self.run_refresh, name='refresh', daemon=True).start()
+        if self.inventory_refresh_seconds > 0:
+            self.inventory_refresher.start(self.inventory_refresh_seconds)
+        server = ThreadingHTTPServer(('127.0.0.1', port), DaemonRequestHandler)
+        server.provisioning_daemon = self
+        print(f'[INFO] Provisioning daemon listening on http://127.0.0.1:{port} with {self.job_workers} job workers')
+        logger.info(f'Provisioning daemon listening on http://127.0.0.1:{port}')
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+class DaemonRequestHandler(BaseHTTPRequestHandler):
+    # The HTTP API of the ProvisioningDaemon. Every request and response body is json.
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.info(f'Daemon API: {self.address_string()} {format % args}')
+
+    def reply(self, status_code, body):
+        response_data = json.dumps(body).encode()
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response_data)))
+        self.end_headers()
+        self.wfile.write(response_data)
+
+    def do_GET(self):
+        provisioning_daemon = self.server.provisioning_daemon
+        path_parts = [part for part in urlparse(self.path).path.split('/') if part != '']
+        if path_parts == ['status']:
+            return self.reply(200, provisioning_daemon.get_status())
+        if path_parts == ['jobs']:
+            with provisioning_daemon.lock:
+                return self.reply(200, {'jobs': list(provisioning_daemon.jobs.values())})
+        if len(path_parts) == 2 and path_parts[0] == 'jobs' and path_parts[1].isdigit():
+            job = provisioning_daemon.jobs.get(int(path_parts[1]))
+            if job == None:
+                return self.reply(404, {'errors': [f'There is no job {path_parts[1]}']})
+            return self.reply(200, job)
+        self.reply(404, {'errors': [f'Unknown path {self.path}']})
+
+    def do_POST(self):
+        provisioning_daemon = self.server.provisioning_daemon
+        request_data = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if urlparse(self.path).path.rstrip('/') != '/jobs':
+            return self.reply(404, {'errors': [f'Unknown path {self.path}']})
+        try:
+            manifest_data = json.loads(request_data)
+        except ValueError:
+            return self.reply(400, {'errors': ['The job is not valid json']})
+        if not isinstance(manifest_data, dict) or not isinstance(manifest_data.get('Customers'), list):
+            return self.reply(400, {'errors': ['The job must be in the form {"Customers": [...]}']})
+        job, errors = provisioning_daemon.submit_job(manifest_data['Customers'])
+        if job == None:
+            return self.reply(400, {'errors': errors})
+        self.reply(202, job)
+
+class Journal():
+    # A write-ahead journal of the services and domains created during a run, so that a run that stops part way...
+    # through can be resumed with --resume instead of starting again from zero.
+    # Each entry is one line of json. Every entry is flushed and fsynced to disk before the run carries on.
+    # The first entry describes the run, including the batch of customers, and the last entry marks the run done.
+
+    def __init__(self, journal_filename):
+        self.journal_filename = journal_filename
+        self.journal_file = None
+        self.lock = threading.Lock()
+
+    def open(self, append):
+        # Open the journal to start a new run, or with append set to True, to continue a resumed run.
+        self.journal_file = open(self.journal_filename, 'a' if append == True else 'w')
+
+    def record(self, entry):
+        with self.lock:
+            self.journal_file.write(json.dumps(entry) + '\n')
+            self.journal_file.flush()
+            os.fsync(self.journal_file.fileno())
+
+    def close(self):
+        if self.journal_file != None:
+            self.journal_file.close()
+            self.journal_file = None
+
+def read_journal(journal_filename):
+    # Read a journal and return what the run it describes had done, or False if there is no journal to read.
+    # Returns a dictionary of the run entry, the service ids and domain ids that were created, the names...
+    # of the customers that were finished and whether the whole run was done.
+    if not os.path.isfile(journal_filename):
+        return False
+    journal_state = {'run': None, 'service_ids': {}, 'domain_ids': {}, 'customers_done': [], 'run_done': False}
+    with open(journal_filename, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # The last line can be cut short if the run stopped while writing it.
+                print(f'[WARNING] Skipping an incomplete entry in the journal {journal_filename}')
+                continue
+            if entry['type'] == 'run':
+                journal_state['run'] = entry
+            elif entry['type'] == 'services':
+                journal_state['service_ids'].update(entry['ids'])
+            elif entry['type'] == 'domain':
+                journal_state['domain_ids'][tuple(entry['path'])] = entry['id']
+            elif entry['type'] == 'customer_done':
+                journal_state['customers_done'].append(entry['name'])
+            elif entry['type'] == 'run_done':
+                journal_state['run_done'] = True
+    if journal_state['run'] == None:
+        return False
+    return journal_state
+
+def report_ng1_error(ng1, exception_type, exception, exception_traceback):
+    # Installed as sys.excepthook by main(). An Ng1Error that nothing could recover from, even after its retries,...
+    # ends the run with a one line message instead of a traceback. Any other exception is shown as usual.
+    if not issubclass(exception_type, Ng1Error):
+        sys.__excepthook__(exception_type, exception, exception_traceback)
+        return
+    print(f'[CRITICAL] {exception}')
+    logger.critical(str(exception))
+    if isinstance(exception, Ng1TransientError) and exception.status_code == None:
+        print('[CRITICAL] Cannot reach nG1. Check your connection')
+    if ng1.journal != None and ng1.journal.journal_file != None:
+        print('[INFO] Run the program again with --resume to continue from where this run stopped')
+    print('Exiting the program now...')
+
+def get_endpoint_name(method, url):
+    # Turn an API call URL into an endpoint name without the names and numbers in it, so that calls can be...
+    # grouped by endpoint. For example /ng1api/ncm/devices/atl-is01/interfaces becomes GET /ncm/devices/{}/interfaces.
+    resource_names = {'ncm', 'rest-sessions', 'close', 'devices', 'interfaces', 'associateapns', 'apns',
+                      'services', 'domains', 'servicealertprofiles'}
+    path = url.split('://', 1)[-1].partition('/')[2].split('?')[0] # Drop the protocol, host and query string.
+    endpoint_parts = []
+    for path_part in path.split('/'):
+        if path_part == '' or path_part == 'ng1api':
+            continue
+        if path_part in resource_names:
+            endpoint_parts.append(path_part)
         else:
-            # We reached the nG1, but request has failed
-            print(f'[CRITICAL] opening session to URL: {open_session_url} failed')
-            print('Response Code:', post.status_code)
-            print('Response Body:', post.text)
-            print('Exiting the program now...')
-            sys.exit()
-    except:
-        # This means we likely did not reach the nG1 at all. Check your VPN connection.
-        print('[CRITICAL] opening session failed')
-        print(f'Cannot reach URL: {open_session_url}')
-        print('Check your connection')
-        print('Exiting the program now...')
-        sys.exit()
+            endpoint_parts.append('{}')
+    return method + ' /' + '/'.join(endpoint_parts)
+
+def get_percentile(sorted_values, percentile):
+    # Return the nearest rank percentile of a sorted list of values.
+    if sorted_values == []:
+        return None
+    rank = max(math.ceil(percentile / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+class EndpointStats():
+    # The running totals of the API calls to one endpoint. Only the latest latency_samples latencies are kept...
+    # for the percentiles, so the memory used does not grow with the number of calls in a long running program.
+
+    def __init__(self, latency_samples):
+        self.calls = 0
+        self.status_codes = defaultdict(int) # Status code as a string : number of calls.
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latencies = deque(maxlen=latency_samples)
+
+    def add(self, seconds, status_code, bytes_sent, bytes_received):
+        self.calls += 1
+        self.status_codes[str(status_code)] += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.bytes_sent += bytes_sent
+        self.bytes_received += bytes_received
+        self.latencies.append(seconds)
+
+    def merge(self, other):
+        self.calls += other.calls
+        for status_code in other.status_codes:
+            self.status_codes[status_code] += other.status_codes[status_code]
+        self.total_seconds += other.total_seconds
+        self.max_seconds = max(self.max_seconds, other.max_seconds)
+        self.bytes_sent += other.bytes_sent
+        self.bytes_received += other.bytes_received
+        self.latencies.extend(other.latencies)
+
+class RunMetrics():
+    # Records the latency, status code and payload size of every API call to nG1 and the wall time of each...
+    # phase of the run, and reports them at the end of the run.
+    # Phases are marked with start_phase(). A phase runs until the next one starts, and a phase that runs...
+    # more than once (for example once per customer) adds up. Every API call is counted against the current phase.
+    # The calls are kept as running totals per endpoint (see EndpointStats), so the p50 and p95 are of the...
+    # latest latency_samples calls to each endpoint while the other figures cover every call.
+    # Work that runs alongside other work, such as a daemon job or refresh, records into a RunMetrics of its own...
+    # (see Ng1Context.with_metrics) that is merged into the run's one when it is done, so that its phases...
+    # do not end or get counted against the phases of the work running next to it.
+
+    def __init__(self, latency_samples=1000):
+        self.lock = threading.Lock()
+        self.run_start_time = time.perf_counter()
+        self.latency_samples = latency_samples
+        self.endpoint_stats = {} # Endpoint name : EndpointStats.
+        self.phase_seconds = {} # Phase name : seconds, in the order the phases first ran.
+        self.phase_api_calls = defaultdict(int) # Phase name : number of API calls.
+        self.current_phase = None
+        self.phase_start_time = None
+
+    def start_phase(self, phase_name):
+        # End the current phase and start timing the next one.
+        with self.lock:
+            self._end_current_phase()
+            self.current_phase = phase_name
+            self.phase_start_time = time.perf_counter()
+
+    def end_phase(self):
+        with self.lock:
+            self._end_current_phase()
+
+    def _end_current_phase(self):
+        if self.current_phase != None:
+            self.phase_seconds[self.current_phase] = self.phase_seconds.get(self.current_phase, 0.0) + time.perf_counter() - self.phase_start_time
+            self.current_phase = None
+
+    def record_api_call(self, method, url, status_code, seconds, bytes_sent, bytes_received):
+        endpoint_name = get_endpoint_name(method, url)
+        with self.lock:
+            if endpoint_name not in self.endpoint_stats:
+                self.endpoint_stats[endpoint_name] = EndpointStats(self.latency_samples)
+            self.endpoint_stats[endpoint_name].add(seconds, status_code, bytes_sent, bytes_received)
+            self.phase_api_calls[self.current_phase] += 1
+
+    def merge(self, other):
+        # Add the phases and API calls recorded in another RunMetrics, after its work is done, to this one.
+        other.end_phase()
+        with other.lock, self.lock:
+            for phase_name in other.phase_seconds:
+                self.phase_seconds[phase_name] = self.phase_seconds.get(phase_name, 0.0) + other.phase_seconds[phase_name]
+            for phase_name in other.phase_api_calls:
+                self.phase_api_calls[phase_name] += other.phase_api_calls[phase_name]
+            for endpoint_name in other.endpoint_stats:
+                if endpoint_name not in self.endpoint_stats:
+                    self.endpoint_stats[endpoint_name] = EndpointStats(self.latency_samples)
+                self.endpoint_stats[endpoint_name].merge(other.endpoint_stats[endpoint_name])
+
+    def api_call_count(self):
+        with self.lock:
+            return sum(stats.calls for stats in self.endpoint_stats.values())
+
+    def average_request_seconds(self):
+        # Return the average time an API call to nG1 has taken so far, or None if no calls have been made.
+        with self.lock:
+            call_count = sum(stats.calls for stats in self.endpoint_stats.values())
+            if call_count == 0:
+                return None
+            return sum(stats.total_seconds for stats in self.endpoint_stats.values()) / call_count
+
+    def build_report(self):
+        # Return the run report as a dictionary that can be written to json.
+        with self.lock:
+            report = {'run_seconds': round(time.perf_counter() - self.run_start_time, 3), 'phases': [], 'endpoints': []}
+            phase_seconds = dict(self.phase_seconds)
+            if self.current_phase != None: # Include the time so far of a phase that is still running.
+                phase_seconds[self.current_phase] = phase_seconds.get(self.current_phase, 0.0) + time.perf_counter() - self.phase_start_time
+            for phase_name in phase_seconds:
+                report['phases'].append({'phase': phase_name, 'seconds': round(phase_seconds[phase_name], 3),
+                                         'api_calls': self.phase_api_calls.get(phase_name, 0)})
+            for endpoint_name in sorted(self.endpoint_stats):
+                stats = self.endpoint_stats[endpoint_name]
+                latencies = sorted(stats.latencies)
+                report['endpoints'].append({'endpoint': endpoint_name,
+                                            'calls': stats.calls,
+                                            'status_codes': dict(stats.status_codes),
+                                            'p50_ms': round(get_percentile(latencies, 50) * 1000, 1),
+                                            'p95_ms': round(get_percentile(latencies, 95) * 1000, 1),
+                                            'max_ms': round(stats.max_seconds * 1000, 1),
+                                            'total_seconds': round(stats.total_seconds, 3),
+                                            'bytes_sent': stats.bytes_sent,
+                                            'bytes_received': stats.bytes_received})
+        return report
+
+    def print_summary(self, report):
+        print('[INFO] Run summary by phase:')
+        print(f"    {'phase':<32} {'seconds':>9} {'API calls':>10}")
+        for phase in report['phases']:
+            print(f"    {phase['phase']:<32} {phase['seconds']:>9.2f} {phase['api_calls']:>10}")
+        print('[INFO] Run summary by API endpoint:')
+        print(f"    {'endpoint':<52} {'calls':>6} {'errors':>6} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8} {'KB in':>8}")
+        for endpoint in report['endpoints']:
+            # Anything other than a 200 response counts as an error, including an 'already exists' response.
+            errors = endpoint['calls'] - endpoint['status_codes'].get('200', 0)
+            print(f"    {endpoint['endpoint']:<52} {endpoint['calls']:>6} {errors:>6} {endpoint['p50_ms']:>8.1f} "
+                  f"{endpoint['p95_ms']:>8.1f} {endpoint['max_ms']:>8.1f} {endpoint['bytes_received'] / 1024:>8.1f}")
+        print(f"[INFO] Total run time {report['run_seconds']:.2f} seconds")
+
+    def finish(self, report_filename):
+        # End the last phase, print the summary tables and write the json report.
+        self.end_phase()
+        report = self.build_report()
+        self.print_summary(report)
+        write_config_to_json(report_filename, report)
+        logger.info(f"Run report written to {report_filename}: {report['run_seconds']} seconds, "
+                    f"{sum(endpoint['calls'] for endpoint in report['endpoints'])} API calls")
+
+class Ng1Error(Exception):
+    # An nG1 API call failed. The subclasses below tell the caller what kind of failure it was, so that...
+    # it can decide whether to retry, carry on or stop the run.
+    # status_code is None if the call failed without a response, for example a connection error.
+
+    def __init__(self, method, url, status_code=None, body=''):
+        self.method = method
+        self.url = url
+        self.status_code = status_code
+        self.body = body
+        if status_code == None:
+            message = f'{method} {url} failed: {body}'
+        else:
+            message = f'{method} {url} failed. Response Code: {status_code} Response Body: {body[:500]}'
+        super().__init__(message)
+
+class Ng1AuthError(Ng1Error):
+    # The session or credentials were refused (401 or 403).
+    pass
+
+class Ng1NotFoundError(Ng1Error):
+    # The object asked for does not exist (404).
+    pass
+
+class Ng1ConflictError(Ng1Error):
+    # The object we tried to create already exists (409, or a 400 that says it exists).
+    pass
+
+class Ng1ThrottledError(Ng1Error):
+    # nG1 is limiting the rate of API calls (429). The call was not processed, so it is always safe to retry.
+    # retry_after is the number of seconds nG1 asked us to wait, or None.
+    def __init__(self, method, url, status_code=None, body='', retry_after=None):
+        super().__init__(method, url, status_code, body)
+        self.retry_after = retry_after
+
+class Ng1TransientError(Ng1Error):
+    # A failure that is likely to clear up by itself, such as a 5xx response, a timeout or a dropped connection.
+    # request_sent is False if the connection could not be made at all, so nG1 never saw the request.
+    def __init__(self, method, url, status_code=None, body='', request_sent=True):
+        super().__init__(method, url, status_code, body)
+        self.request_sent = request_sent
+
+def raise_for_ng1_status(method, url, response):
+    # Raise the Ng1Error subclass that matches a failed response. Responses in the 2xx range are returned as is.
+    if 200 <= response.status_code < 300:
+        return response
+    status_code = response.status_code
+    body = response.text
+    if status_code in (401, 403):
+        raise Ng1AuthError(method, url, status_code, body)
+    if status_code == 429:
+        try:
+            retry_after = float(response.headers.get('Retry-After'))
+        except (TypeError, ValueError):
+            retry_after = None
+        raise Ng1ThrottledError(method, url, status_code, body, retry_after)
+    if status_code >= 500:
+        raise Ng1TransientError(method, url, status_code, body)
+    if status_code == 404 or 'Not found' in body:
+        raise Ng1NotFoundError(method, url, status_code, body)
+    if status_code == 409 or (status_code == 400 and 'exists' in body):
+        raise Ng1ConflictError(method, url, status_code, body)
+    raise Ng1Error(method, url, status_code, body)
+
+class Ng1Client():
+    # A single HTTP(S) client shared by every nG1 API helper in this program.
+    # It owns one requests.Session with a pool of keep-alive connections, so each API call after
+    # the first reuses an already open TCP+TLS connection to nG1 instead of doing a new handshake.
+
+    def __init__(self, pool_size=10, keep_alive=True, max_retries=3, backoff_factor=0.5, timeout=(10, 120), metrics=None, max_backoff=30):
+        # pool_size is the max number of connections kept open to nG1 at the same time.
+        # max_retries, backoff_factor and max_backoff control the retries on throttled and transient failures.
+        # timeout is a (connect, read) tuple in seconds that is applied to every request.
+        # If a RunMetrics is passed in as metrics, every request is recorded in it.
+        self.timeout = timeout
+        self.metrics = metrics
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.ng1_session = None # The Ng1Session that re-opens the session if nG1 refuses it, once one is opened.
+        self.session = requests.Session()
+        self.session.verify = False # nG1 commonly uses a self signed certificate.
+        # disable the warnings for ignoring Self Signed Certificates
+        requests.packages.urllib3.disable_warnings()
+        if keep_alive == False:
+            # Ask nG1 to close the connection after every response.
+            self.session.headers['Connection'] = 'close'
+        # Every retry is made by request() below, so the connection pool itself does not retry.
+        retry_policy = Retry(total=0, raise_on_status=False)
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry_policy)
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+
+    def request(self, method, url, idempotent=False, **kwargs):
+        # Send the request over the pooled session, using the default timeout unless one was passed in.
+        # Returns the response if it was successful, otherwise raises the matching Ng1Error.
+        # Throttled calls and calls that could not connect are always retried, as nG1 did not process them.
+        # Other transient failures are retried for GET and DELETE, and for a POST only if the caller says...
+        # it is idempotent, as the first try may have been processed before it failed.
+        # Each retry waits a random time of up to backoff_factor * 2 ** retry seconds (see get_backoff_seconds),...
+        # so that many workers that failed together do not all retry at the same moment.
+        # If nG1 refuses the session with a 401, the Ng1Session is re-opened and the request is sent once more.
+        kwargs.setdefault('timeout', self.timeout)
+        retry = 0
+        reauthenticated = False
+        # The calls that open and close the session must not try to re-open it.
+        can_reopen_session = self.ng1_session != None and '/rest-sessions' not in url
+        while True:
+            if can_reopen_session == True:
+                self.ng1_session.refresh_if_old()
+                session_generation = self.ng1_session.generation
+            try:
+                return raise_for_ng1_status(method, url, self.send(method, url, **kwargs))
+            except Ng1AuthError:
+                if can_reopen_session == False or reauthenticated == True:
+                    raise
+                reauthenticated = True
+                print(f'[WARNING] {get_endpoint_name(method, url)} was refused by nG1, re-opening the session')
+                logger.warning(f'{method} {url} was refused by nG1, re-opening the session')
+                self.ng1_session.reopen(session_generation)
+            except (Ng1ThrottledError, Ng1TransientError) as error:
+                if retry >= self.max_retries:
+                    raise
+                if isinstance(error, Ng1TransientError) and error.request_sent == True:
+                    if method not in ('GET', 'DELETE') and idempotent == False:
+                        raise
+                retry_seconds = self.get_backoff_seconds(retry)
+                if isinstance(error, Ng1ThrottledError) and error.retry_after != None:
+                    retry_seconds = max(retry_seconds, error.retry_after)
+                retry += 1
+                print(f"[WARNING] {get_endpoint_name(method, url)} failed with {error.status_code or 'no response'}, "
+                      f"retry {retry} of {self.max_retries} in {retry_seconds:.2f} seconds")
+                logger.warning(f'{error}. Retry {retry} of {self.max_retries} in {retry_seconds:.2f} seconds')
+                time.sleep(retry_seconds)
+
+    def get_backoff_seconds(self, retry):
+        # The time to wait before retry number retry + 1, with full jitter.
+        return random.uniform(0, min(self.max_backoff, self.backoff_factor * 2 ** retry))
+
+    def send(self, method, url, **kwargs):
+        # Send one try of the request and return the response, whatever its status code.
+        try:
+            if self.metrics == None:
+                return self.session.request(method, url, **kwargs)
+            return self.send_and_record(method, url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as error:
+            # requests wraps the urllib3 error, which tells us whether the connection was made.
+            reason = getattr(error.args[0], 'reason', None) if error.args else None
+            request_sent = not (isinstance(error, requests.exceptions.ConnectTimeout) or isinstance(reason, ConnectTimeoutError))
+            raise Ng1TransientError(method, url, None, str(error), request_sent)
+
+    def send_and_record(self, method, url, **kwargs):
+        request_start_time = time.perf_counter()
+        response = None
+        try:
+            response = self.session.request(method, url, **kwargs)
+            return response
+        finally:
+            request_seconds = time.perf_counter() - request_start_time
+            if response != None:
+                self.metrics.record_api_call(method, url, response.status_code, request_seconds,
+                                             len(kwargs.get('data') or ''), len(response.content))
+            else: # The request failed without a response, for example a connection error.
+                self.metrics.record_api_call(method, url, 'error', request_seconds, len(kwargs.get('data') or ''), 0)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, idempotent=False, **kwargs):
+        return self.request('POST', url, idempotent, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def connection_stats(self):
+        # Add up the connections opened and requests sent across the connection pools for this session.
+        # Every request that did not need a new connection reused one that was already open.
+        connections_opened = 0
+        requests_sent = 0
+        pools = self.adapter.poolmanager.pools
+        for pool_key in pools.keys():
+            pool = pools[pool_key]
+            connections_opened += pool.num_connections
+            requests_sent += pool.num_requests
+        connections_reused = max(requests_sent - connections_opened, 0)
+        return {'requests': requests_sent, 'opened': connections_opened, 'reused': connections_reused}
+
+    def print_connection_summary(self):
+        stats = self.connection_stats()
+        summary = f"nG1 connection summary: {stats['requests']} requests sent, {stats['opened']} connections opened, {stats['reused']} connections reused"
+        print(f'[INFO] {summary}')
+        logger.info(summary)
+
+    def with_metrics(self, metrics):
+        # Return a client that shares this one's connection pool and nG1 session, but records its calls in metrics.
+        client = copy.copy(self)
+        client.metrics = metrics
+        return client
+
+    def close(self):
+        # Release all of the pooled connections.
+        self.session.close()
+
+class Ng1Context():
+    # Everything the helpers need to work with one nG1, passed to them as their first argument, ng1.
+    # It holds the client that sends the API calls, the session cookies, and the state that is loaded once...
+    # and shared by every customer: the alert profile ids and the APN catalogue.
+    # Nothing is sent to nG1 until a helper is called, so a context can be built in a test or another program...
+    # without logging in. Open a session for it with Ng1Session.
+
+    def __init__(self, client, ng1_host, headers, cookies=None, transport=None, metrics=None,
+                 discovery_workers=8, service_workers=8):
+        self.client = client
+        self.host = ng1_host
+        self.headers = headers
+        self.cookies = cookies
+        self.session = None # Set by Ng1Session.
+        self.transport = transport # An AsyncNg1Transport, or None to send calls from a thread pool.
+        if metrics == None:
+            metrics = RunMetrics()
+        self.metrics = metrics
+        self.journal = None # The Journal of the provisioning run in progress, if there is one.
+        self.discovery_workers = discovery_workers
+        self.service_workers = service_workers
+        self.alert_profile_ids = {} # Service alert profile name : id.
+        self.apn_catalogue = {} # APN name : APN detail.
+        self.service_registry = None # The ServiceRegistry shared by every customer, or None to create every service.
+        # Held while creating domains, so that customers provisioned at the same time do not both create...
+        # a shared domain that is missing from the domain index.
+        self.domain_lock = threading.Lock()
+
+    def with_metrics(self, metrics):
+        # Return a context that shares this one's client, session and state, but records its phases and API...
+        # calls in metrics. Merge metrics into this context's metrics once the work using it is done.
+        # The state is shared as it is now, so a value that this context later replaces, such as the APN...
+        # catalogue after an inventory refresh, is not seen by the returned context.
+        ng1 = copy.copy(self)
+        ng1.client = self.client.with_metrics(metrics)
+        ng1.metrics = metrics
+        return ng1
+
+    def close(self):
+        # Close the session, then the transport and the client.
+        if self.session != None:
+            self.session.close()
+        if self.transport != None:
+            self.transport.close()
+        self.client.close()
+
+class Ng1Session():
+    # The one nG1 session that every API helper shares, used as a context manager:
+    #     with Ng1Session(ng1, cookies, credentials, max_age) as ng1_session:
+    # The session cookie is kept in the cookies jar, which becomes ng1.cookies, the cookies every helper sends.
+    # When the session is re-opened the new cookie is put in the same jar, so every helper picks it up.
+    # The session is re-opened when nG1 refuses it with a 401, or before it is max_age seconds old so...
+    # that a long run does not outlive it. close() is safe to call more than once, and is also called...
+    # at exit so that a run that stops early does not leave a session open on nG1.
+
+    def __init__(self, ng1, login_cookies, credentials, max_age=0):
+        # ng1 is the Ng1Context to open the session for. login_cookies and credentials are passed to...
+        # open_session. max_age of 0 means never refresh.
+        self.ng1 = ng1
+        self.login_cookies = login_cookies
+        self.credentials = credentials
+        self.max_age = max_age
+        self.cookies = requests.cookies.RequestsCookieJar()
+        self.is_open = False
+        self.opened_time = None
+        self.generation = 0 # Counts the times the session has been opened, so a 401 only causes one re-open.
+        self.lock = threading.RLock()
+        ng1.cookies = self.cookies
+        ng1.session = self
+        ng1.client.ng1_session = self
+
+    def open(self):
+        with self.lock:
+            session_cookies = open_session(self.ng1, self.login_cookies, self.credentials)
+            self.cookies.update(session_cookies)
+            self.is_open = True
+            self.opened_time = time.monotonic()
+            self.generation += 1
+
+    def reopen(self, failed_generation=None):
+        # Open a new session and close the old one. If failed_generation is passed in and the session has...
+        # already been re-opened since then, for example by another worker that got the same 401, do nothing.
+        with self.lock:
+            if failed_generation != None and failed_generation != self.generation:
+                return
+            old_cookies = requests.cookies.RequestsCookieJar()
+            old_cookies.update(self.cookies)
+            was_open = self.is_open
+            self.open()
+            if was_open == True:
+                close_session(self.ng1, old_cookies)
+
+    def refresh_if_old(self):
+        if self.max_age > 0 and self.is_open == True and time.monotonic() - self.opened_time > self.max_age:
+            with self.lock:
+                if time.monotonic() - self.opened_time > self.max_age: # Another worker may have just refreshed it.
+                    print(f'[INFO] The nG1 session is more than {self.max_age} seconds old, opening a new one')
+                    self.reopen()
+
+    def close(self):
+        with self.lock:
+            if self.is_open == True:
+                self.is_open = False
+                close_session(self.ng1)
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exception_type, exception, exception_traceback):
+        self.close()
+        return False
 
-def close_session(ng1_host, headers, cookies):
-    close_session_uri = "/ng1api/rest-sessions/close"
-    close_session_url = ng1_host + close_session_uri
-    # perform the HTTPS API call
-    close = requests.request("POST", close_session_url, headers=headers, verify=False, cookies=cookies)
+def exit_on_signal(ng1, signal_number, frame):
+    # Turn SIGTERM and SIGHUP into a normal exit, so that the nG1 session is closed and the run report and...
+    # journal are written as they are when the run ends any other way.
+    print(f'[WARNING] Received {signal.Signals(signal_number).name}, exiting')
+    logger.warning(f'Received {signal.Signals(signal_number).name}, exiting')
+    if ng1.journal != None and ng1.journal.journal_file != None:
+        print('[INFO] Run the program again with --resume to continue from where this run stopped')
+    sys.exit(128 + signal_number)
+
+class TokenBucket():
+    # A token bucket rate limiter for the calls to one nG1 API endpoint.
+    # It allows rate calls per second on average, with bursts of up to capacity calls.
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        if capacity == None:
+            capacity = max(1, rate)
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        # Wait until there is a token to take for the next call.
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class AsyncNg1Transport():
+    # An asyncio transport for the nG1 API helpers.
+    # Coroutines are limited by one semaphore to max_concurrency calls in flight at the same time, and by a...
+    # token bucket per endpoint so that bursts of calls to one endpoint do not trip nG1's API throttling.
+    # The calls themselves are sent by the pooled Ng1Client from a pool of worker threads, so the helpers...
+    # behave exactly as they do when they are called one at a time.
+    # The transport runs one event loop in a background thread for its whole life, and the semaphore and...
+    # token buckets belong to that loop. Every thread that calls run_all shares the same limits, so the...
+    # daemon's job workers and inventory refresher together stay within them.
+
+    def __init__(self, max_concurrency=32, endpoint_rate_limits=None):
+        # endpoint_rate_limits is a dictionary of {endpoint: max calls per second}, for example {'POST /services': 20}.
+        # Endpoints that are not listed are only limited by max_concurrency.
+        self.max_concurrency = max_concurrency
+        self.endpoint_rate_limits = endpoint_rate_limits or {}
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, name='ng1-async-transport', daemon=True)
+        self.loop_thread.start()
+        self.buckets, self.semaphore = asyncio.run_coroutine_threadsafe(self.create_limits(), self.loop).result()
+
+    async def create_limits(self):
+        # Create the token buckets and the semaphore on the transport's event loop.
+        buckets = {}
+        for endpoint, rate in self.endpoint_rate_limits.items():
+            buckets[endpoint] = TokenBucket(rate)
+        return buckets, asyncio.Semaphore(self.max_concurrency)
+
+    async def call(self, endpoint, function, *args):
+        # Run function(*args) once there is a token for this endpoint and a free slot.
+        if endpoint in self.buckets:
+            await self.buckets[endpoint].acquire()
+        async with self.semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(function, *args))
+
+    def run_all(self, coroutine_function, arg_lists):
+        # Run coroutine_function(self, *args) for every args in arg_lists at the same time from synchronous code.
+        # Returns the results in the same order as arg_lists. Safe to call from several threads at once.
+        async def run_one(args):
+            # A helper that exits the program must not stop the shared event loop, so hand the SystemExit...
+            # back to the calling thread to raise there.
+            try:
+                return await coroutine_function(self, *args), None
+            except SystemExit as system_exit:
+                return None, system_exit
+        async def gather_all():
+            return await asyncio.gather(*[run_one(args) for args in arg_lists])
+        results = asyncio.run_coroutine_threadsafe(gather_all(), self.loop).result()
+        for result, system_exit in results:
+            if system_exit != None:
+                raise system_exit
+        return [result for result, system_exit in results]
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.loop.close()
+        self.executor.shutdown(wait=True)
+
+# Coroutine versions of the nG1 API helpers. Each one takes the AsyncNg1Transport as its first argument.
+async def async_get_devices(transport, ng1):
+    return await transport.call('GET /devices', get_devices, ng1)
+
+async def async_get_device_interfaces(transport, ng1, device_name):
+    return await transport.call('GET /devices/interfaces', get_device_interfaces, ng1, device_name)
+
+async def async_get_apns_on_an_interface(transport, ng1, device_name, interface_number):
+    return await transport.call('GET /devices/interfaces/associateapns', get_apns_on_an_interface, ng1, device_name, interface_number)
+
+async def async_create_service(transport, ng1, service_name, config_data, save, service_ids=None):
+    return await transport.call('POST /services', create_service, ng1, service_name, config_data, save, service_ids)
+
+async def async_create_service_or_error(transport, ng1, service_name, config_data, save, service_ids=None):
+    return await transport.call('POST /services', create_service_or_error, ng1, service_name, config_data, save, service_ids)
+
+async def async_create_domain(transport, ng1, domain_name, parent_config_data, domain_index=None):
+    return await transport.call('POST /domains', create_domain, ng1, domain_name, parent_config_data, domain_index)
+
+async def async_get_service_detail(transport, ng1, service_name):
+    return await transport.call('GET /services/name', get_service_detail, ng1, service_name)
+
+def open_session(ng1, cookies, credentials):
+    open_session_uri = "/ng1api/rest-sessions"
+    open_session_url = ng1.host + open_session_uri
 
-    if close.status_code == 200:
-        # success
-        print('[INFO] Closed Session Successfully')
-        return True
+    # perform the HTTPS API call to open the session with nG1 and return a session cookie
+    # Opening a session is safe to retry, as a failed open leaves nothing behind to clean up.
+    # Raises Ng1AuthError if nG1 refuses the credentials or token, and Ng1TransientError if we cannot...
+    # reach nG1 at all. Check your VPN connection in that case.
+    if credentials == 'Null':
+        # Null credentials tells us to use the token. We will use this post and pass in the cookies as the token.
+        post = ng1.client.post(open_session_url, idempotent=True, headers=ng1.headers, cookies=cookies)
+    elif cookies == 'Null':
+        # Null cookies tells us to use the credentials string. We will use this post and pass in the credentials string.
+        #split the credentials string into two parts; username and password
+        ng1username = credentials.split(':')[0]
+        ng1password_pl = credentials.split(':')[1]
+        post = ng1.client.post(open_session_url, idempotent=True, headers=ng1.headers, auth=(ng1username, ng1password_pl))
     else:
+        raise Ng1AuthError('POST', open_session_url, None, 'Unable to determine authentication by credentials or token')
+    print('[INFO] Opened Session Successfully')
+
+    # utilize the returned cookie for future authentication
+    cookies = post.cookies
+    # print ('Cookie : ', cookies)
+    return cookies
+
+def close_session(ng1, cookies=None):
+    # Close the session in cookies, or the current session if cookies is None.
+    if cookies == None:
+        cookies = ng1.cookies
+    close_session_uri = "/ng1api/rest-sessions/close"
+    close_session_url = ng1.host + close_session_uri
+    # perform the HTTPS API call
+    # A failure to close is reported but does not stop the program, as the session will time out on nG1.
+    try:
+        close = ng1.client.post(close_session_url, idempotent=True, headers=ng1.headers, cookies=cookies)
+    except Ng1Error as error:
         print('[ERROR] closing session')
-        print('Response Code:', close.status_code)
-        print('Response Body:', close.text)
+        print(error)
         return False
 
+    print('[INFO] Closed Session Successfully')
+    return True
+
 def write_config_to_json(config_filename, config_data):
     # The config_data that is passed in is converted to a string (serialized) and written to the json file
 
@@ -823,79 +2687,49 @@ def read_config_from_json(config_filename):
         print("Unexpected error:", sys.exc_info()[0])
         return False
 
-def get_apns(ng1_host, headers, cookies):
+def get_apns(ng1):
     uri = "/ng1api/ncm/apns/"
-    url = ng1_host + uri
+    url = ng1.host + uri
 
     # perform the HTTPS API call to get the All APNs information
-    get = requests.get(url, headers=headers, verify=False, cookies=cookies)
+    get = ng1.client.get(url, headers=ng1.headers, cookies=ng1.cookies)
 
-    if get.status_code == 200:
-        # success
-        print('[INFO] get_apns Successful')
+    print('[INFO] get_apns Successful')
 
-        # return the json object that contains the All APNs information
-        return get.json()
-
-    else:
-        print('[ERROR] get_apns Failed')
-        print('URL:', url)
-        print('Response Code:', get.status_code)
-        print('Response Body:', get.text)
-
-        return False
+    # return the json object that contains the All APNs information
+    return get.json()
 
-def get_apn_detail(ng1_host, headers, cookies, apn_name):
+def get_apn_detail(ng1, apn_name):
     uri = "/ng1api/ncm/apns/"
-    url = ng1_host + uri + apn_name
+    url = ng1.host + uri + apn_name
 
     # perform the HTTPS API call to get the APN detail information
-    get = requests.get(url, headers=headers, verify=False, cookies=cookies)
+    get = ng1.client.get(url, headers=ng1.headers, cookies=ng1.cookies)
 
-    if get.status_code == 200:
-        # success
-        print('[INFO] get_apn_detail for', apn_name, 'Successful')
+    print('[INFO] get_apn_detail for', apn_name, 'Successful')
 
-        # return the json object that contains the APN detail information
-        return get.json()
+    # return the json object that contains the APN detail information
+    return get.json()
 
-    else:
-        print('[ERROR] get_apn_detail for', apn_name, 'Failed')
-        print('URL:', url)
-        print('Response Code:', get.status_code)
-        print('Response Body:', get.text)
-
-        return False
-
-def get_apns_on_an_interface(ng1_host, headers, cookies, device_name, interface_number):
+def get_apns_on_an_interface(ng1, device_name, interface_number):
     uri = "/ng1api/ncm/devices/"
-    url = ng1_host + uri + device_name + "/interfaces/" + interface_number + "/associateapns"
+    url = ng1.host + uri + device_name + "/interfaces/" + interface_number + "/associateapns"
 
     # perform the HTTPS API call to get the APN detail information
-    get = requests.get(url, headers=headers, verify=False, cookies=cookies)
+    get = ng1.client.get(url, headers=ng1.headers, cookies=ng1.cookies)
 
-    if get.status_code == 200:
-        # success
-        print(f"[INFO] get_apns_on_an_interface for device: {device_name} interface number: {interface_number} Successful")
+    print(f"[INFO] get_apns_on_an_interface for device: {device_name} interface number: {interface_number} Successful")
 
-        # return the json object that contains the APN detail information
-        return get.json()
+    # return the json object that contains the APN detail information
+    return get.json()
 
-    else:
-        print(f"[ERROR] get_apns_on_an_interface for device: {device_name} interface number: {interface_number} Failed")
-        print('URL:', url)
-        print('Response Code:', get.status_code)
-        print('Response Body:', get.text)
-
-        return False
-
-def set_apns(ng1_host, headers, cookies):
+def set_apns(ng1):
     # Add a list of APN groups to nG1 based on an existing json file definition
     service_uri = "/ng1api/ncm/apns/"
 
     # Read in the json file to get all the service attributes
     service_data = read_config_from_json('set_apns.json')
-    url = ng1_host + service_uri
+    url = ng1.host + service_uri
 
     # use json.dumps to provide a serialized json object (a string actually)
     # this json_string will become our new configuration for this service_name
@@ -905,23 +2739,14 @@ def set_apns(ng1_host, headers, cookies):
 
     # perform the HTTPS API Post call with the serialized json object service_data
     # this will create the apn group configuration in nG1 for this apn_filename (the new service_name)
-    post = requests.post(url, headers=headers, data=json_string, verify=False, cookies=cookies)
+    post = ng1.client.post(url, headers=ng1.headers, data=json_string, cookies=ng1.cookies)
 
-    if post.status_code == 200:
-        # success
-        print('[INFO] set_apns Successful')
-        return True
-
-    else:
-        print('[ERROR] set_apns Failed')
-        print('URL:', url)
-        print('Response Code:', post.status_code)
-        print('Response Body:', post.text)
-
-        return False
+    print('[INFO] set_apns Successful')
+    return True
 
-def build_domain_tree(ng1_host, headers, cookies, domain_name, parent_domain_id, domain_member_ids):
+def build_domain_tree(ng1, domain_name, parent_domain_id, domain_member_ids, domain_index):
     # Create one layer of a domain hierarchy
+    # Returns the id of the new domain so that it can be used as the parent of the next layer.
     parent_config_data = {"domainDetail": [{
                                           "domainName": domain_name,
                                           "id": "-1",
@@ -938,78 +2763,88 @@ def build_domain_tree(ng1_host, headers, cookies, domain_name, parent_domain_id,
                                                   'serviceType': 1})
 
     # Create the parent domain.
-    if create_domain(ng1_host, domain_name, headers, cookies, parent_config_data) == True:
-        # Fetch the id of the domain we just created so that we can use it to add child domains.
-        #parent_config_data = get_domain_detail(ng1_host, domain_name, headers, cookies)
-        domain_tree_data = get_domains(ng1_host, headers, cookies)
-        for domain in domain_tree_data['domain']:
-            # Skip the Enterprise domain as it has no parent id number.
-            if domain['serviceName'] != 'Enterprise':
-                if domain['serviceName'] == domain_name and str(parent_domain_id) in str(domain['parent']):
-                    #if domain_name == 'Onstar03':
-                        #print(f'domain_tree_data is: {domain_tree_data}')
-                        #print(f"domain['serviceName'] is {domain['serviceName']}")
-                        #print(f"str(parent_domain_id) is {str(parent_domain_id)}")
-                        #print(f"str(domain['parent'] is {str(domain['parent'])}")
-
-                    parent_domain_id = domain['id']
-    else:
-        print(f'[CRITICAL] Unable to create domain: {domain_name} Exiting...')
-        sys.exit()
+    # nG1 will happily create a second domain with the same name and parent, so a create that failed part way is...
+    # not simply sent again. We first check whether the failed create made the domain after all.
+    retry = 0
+    while True:
+        try:
+            create_domain(ng1, domain_name, parent_config_data, domain_index)
+            break
+        except Ng1TransientError:
+            if retry >= ng1.client.max_retries:
+                raise
+            retry_seconds = ng1.client.get_backoff_seconds(retry)
+            retry += 1
+            time.sleep(retry_seconds)
+            if find_domain_id(ng1, domain_name, parent_domain_id, domain_index) != False:
+                break
+            print(f'[WARNING] create_domain: {domain_name} failed, retry {retry} of {ng1.client.max_retries}')
+    # Fetch the id of the domain we just created so that we can use it to add child domains.
+    new_domain_id = find_domain_id(ng1, domain_name, parent_domain_id, domain_index)
+    if new_domain_id == False:
+        raise Ng1NotFoundError('GET', f'{ng1.host}/ng1api/ncm/domains/{domain_name}', None,
+                               f'the new domain {domain_name} is not under parent {parent_domain_id}')
+
+    return new_domain_id
+
+def build_domain_index(domain_tree_data):
+    # Index the domain tree by (domain name, parent id) so that we can find the id of any domain...
+    # without downloading and scanning the whole domain tree again.
+    # Domain names such as 'Control' or 'GTPv0' repeat under every customer, so the parent id is part of the key.
+    domain_index = {}
+    for domain in domain_tree_data['domain']:
+        # Skip the Enterprise domain as it has no parent id number.
+        if domain['serviceName'] != 'Enterprise':
+            domain_index[(domain['serviceName'], str(domain['parent']))] = domain['id']
+    return domain_index
+
+def find_domain_id(ng1, domain_name, parent_domain_id, domain_index):
+    # Return the id of the domain named domain_name under parent_domain_id, or False if it is not found.
+    # Try our local domain index first, and only download the whole domain tree again if it is not there.
+    # The tree lists every domain with its parent id, so one fetch also indexes any other domains that...
+    # were added since the index was built.
+    domain_key = (domain_name, str(parent_domain_id))
+    if domain_key in domain_index:
+        return domain_index[domain_key]
+
+    # The index is keyed on the exact parent id, so a parent id of 1 does not match a domain under 10 or 100.
+    domain_tree_data = get_domains(ng1)
+    domain_index.update(build_domain_index(domain_tree_data))
+    if domain_key in domain_index:
+        return domain_index[domain_key]
 
-    return parent_domain_id
+    return False
 
-def get_domains(ng1_host, headers, cookies):
+def get_domains(ng1):
     service_uri = "/ng1api/ncm/domains/"
-    url = ng1_host + service_uri
+    url = ng1.host + service_uri
 
     # perform the HTTPS API call to get the Domains information
-    get = requests.get(url, headers=headers, verify=False, cookies=cookies)
+    get = ng1.client.get(url, headers=ng1.headers, cookies=ng1.cookies)
 
-    if get.status_code == 200:
-        # success
-        print('[INFO] get_domains Successful')
+    print('[INFO] get_domains Successful')
 
-        # return the json object that contains the Domains information
-        return get.json()
-
-    else:
-        print('[ERROR] get_domains Failed')
-        print('URL:', url)
-        print('Response Code:', get.status_code)
-        print('Response Body:', get.text)
-
-        return False
+    # return the json object that contains the Domains information
+    return get.json()
 
-def get_domain_detail(ng1_host, domain_name, headers, cookies):
+def get_domain_detail(ng1, domain_name):
     service_uri = "/ng1api/ncm/domains/"
-    url = ng1_host + service_uri + domain_name
+    url = ng1.host + service_uri + domain_name
 
     # perform the HTTPS API call to get the Service information
-    get = requests.get(url, headers=headers, verify=False, cookies=cookies)
+    get = ng1.client.get(url, headers=ng1.headers, cookies=ng1.cookies)
 
-    if get.status_code == 200:
-        # success
-        print('[INFO] get_domain_detail for', domain_name, 'Successful')
+    print('[INFO] get_domain_detail for', domain_name, 'Successful')
 
-        # return the json object that contains the Domain information
-        return get.json()
+    # return the json object that contains the Domain information
+    return get.json()
 
-    else:
-        if 'Not found domain' in get.text: # Don't print fail if the domain does not yet exist
-            print(f'[INFO] Domain {domain_name} does not yet exist')
-        else:
-            print('[ERROR] get_domain_detail for', domain_name, 'Failed')
-            print('URL:', url)
-            print('Response Code:', get.status_code)
-            print('Response Body:', get.text)
-
-        return False
-
-def create_domain(ng1_host, domain_name, headers, cookies, parent_config_data):
+def create_domain(ng1, domain_name, parent_config_data, domain_index=None):
     # Create a new dashboard domain using parent_config_data that contain all the attributes.
+    # Optionally pass in a domain_index dictionary. If nG1 returns the id of the new domain in its...
+    # response, the id is added to domain_index under the key (domain_name, parent id).
     service_uri = "/ng1api/ncm/domains/"
-    url = ng1_host + service_uri
+    url = ng1.host + service_uri
     # use json.dumps to provide a serialized json object (a string actually).
     # This json_string will become our new configuration for this domain_name.
     json_string = json.dumps(parent_config_data)
@@ -1018,112 +2853,82 @@ def create_domain(ng1_host, domain_name, headers, cookies, parent_config_data):
 
     # perform the HTTPS API Post call with the serialized json object service_data
     # this will create the domain configuration in nG1 for this domain_name)
-    post = requests.post(url, headers=headers, data=json_string, verify=False, cookies=cookies)
-
-    if post.status_code == 200:
-        # success
-        print('[INFO] create_domain: ', domain_name, 'Successful')
-        return True
-
-    else:
-        print('[ERROR] create_domain: ', domain_name, 'Failed')
-        print('URL:', url)
-        print('Response Code:', post.status_code)
-        print('Response Body:', post.text)
-
-        return False
+    post = ng1.client.post(url, headers=ng1.headers, data=json_string, cookies=ng1.cookies)
+
+    print('[INFO] create_domain: ', domain_name, 'Successful')
+    if domain_index != None:
+        parent_domain_id = parent_config_data['domainDetail'][0]['parentID']
+        try:
+            domain_index[(domain_name, str(parent_domain_id))] = post.json()['domainDetail'][0]['id']
+        except (ValueError, KeyError, IndexError, TypeError):
+            pass # nG1 did not return the new domain definition, the id will be looked up later.
+    return True
 
-def delete_domain(ng1_host, domain_name, headers, cookies):
+def delete_domain(ng1, domain_name):
     service_uri = "/ng1api/ncm/domains/"
-    url = ng1_host + service_uri + domain_name
+    url = ng1.host + service_uri + domain_name
     # Perform the HTTPS API Delete call by passing the service_name.
     # This will delete the specific service configuration for this service_name.
-    delete = requests.delete(url, headers=headers, verify=False, cookies=cookies)
+    delete = ng1.client.delete(url, headers=ng1.headers, cookies=ng1.cookies)
 
-    if delete.status_code == 200:
-        # success
-        print('[INFO] delete_domain', domain_name, 'Successful')
-        return True
-
-    else:
-        print('[ERROR] delete_service', domain_name, 'Failed')
-        print('URL:', url)
-        print('Response Code:', delete.status_code)
-        print('Response Body:', delete.text)
-
-        return False
+    print('[INFO] delete_domain', domain_name, 'Successful')
+    return True
 
-def get_devices(ng1_host, headers, cookies):
+def get_devices(ng1):
     device_uri = "/ng1api/ncm/devices/"
-    url = ng1_host + device_uri
+    url = ng1.host + device_uri
     # perform the HTTPS API call to get the device information
-    get = requests.get(url, headers=headers, verify=False, cookies=cookies)
-
-    if get.status_code == 200:
-        # success
-        print('[INFO] get_devices request Successful')
+    get = ng1.client.get(url, headers=ng1.headers, cookies=ng1.cookies)
 
-        # return the json object that contains the device information
-        return get.json()
-
-    else:
-        print('[ERROR] get_devices request failed')
-        print('URL:', url)
-        print('Response Code:', get.status_code)
-        print('Response Body:', get.text)
+    print('[INFO] get_devices request Successful')
 
-        return False
+    # return the json object that contains the device information
+    return get.json()
 
-def get_device_detail(ng1_host, headers, cookies, device_name):
+def get_device_detail(ng1, device_name):
     uri = "/ng1api/ncm/devices/"
-    url = ng1_host + uri + device_name
+    url = ng1.host + uri + device_name
     # perform the HTTPS API call to get the device information
-    get = requests.get(url, headers=headers, verify=False, cookies=cookies)
+    get = ng1.client.get(url, headers=ng1.headers, cookies=ng1.cookies)
 
-    if get.status_code == 200:
-        # success
-        print('[INFO] get_device_detail request for', device_name, 'Successful')
+    print('[INFO] get_device_detail request for', device_name, 'Successful')
 
-        # return the json object that contains the device information
-        return get.json()
+    # return the json object that contains the device information
+    return get.json()
 
-    else:
-        print('[ERROR] get_device_detail request for', device_name, 'failed')
-        print('URL:', url)
-        print('Response Code:', get.status_code)
-        print('Response Body:', get.text)
+def get_services(ng1):
+    service_uri = "/ng1api/ncm/services/"
+    url = ng1.host + service_uri
 
-        return False
+    # perform the HTTPS API call to get the Services information
+    get = ng1.client.get(url, headers=ng1.headers, cookies=ng1.cookies)
+
+    print('[INFO] get_services Successful')
+
+    # return the json object that contains the Services information
+    return get.json()
 
-def get_service_detail(ng1_host, service_name, headers, cookies):
+def get_service_detail(ng1, service_name):
     service_uri = "/ng1api/ncm/services/"
-    url = ng1_host + service_uri + service_name
+    url = ng1.host + service_uri + service_name
 
     # perform the HTTPS API call to get the Service information
-    get = requests.get(url, headers=headers, verify=False, cookies=cookies)
+    get = ng1.client.get(url, headers=ng1.headers, cookies=ng1.cookies)
 
-    if get.status_code == 200:
-        # success
-        print('[INFO] get_service_detail for', service_name, 'Successful')
+    print('[INFO] get_service_detail for', service_name, 'Successful')
 
-        # return the json object that contains the Service information
-        return get.json()
-
-    else:
-        print('[ERROR] get_service_detail for', service_name, 'Failed')
-        print('URL:', url)
-        print('Response Code:', get.status_code)
-        print('Response Body:', get.text)
+    # return the json object that contains the Service information
+    return get.json()
 
-        return False
-
-def create_service(ng1_host, headers, cookies, service_name, config_data, save):
+def create_service(ng1, service_name, config_data, save, service_ids=None):
     # Create a new service using the config_data attributes passed into the function.
     # Optionally write a copy of the config to a json file if 'save' is equal to True.
+    # Optionally pass in a service_ids dictionary. If nG1 returns the id of the new service in its...
+    # response, the id is added to service_ids so that we do not need to look it up later.
 
     service_uri = "/ng1api/ncm/services/"
 
-    url = ng1_host + service_uri
+    url = ng1.host + service_uri
 
     # if the save option is True, then save a copy of this configuration to a json file.
     if save == True:
@@ -1134,306 +2939,155 @@ def create_service(ng1_host, headers, cookies, service_name, config_data, save):
 
     # perform the HTTPS API Post call with the serialized json object service_data.
     # This will create the service configuration in nG1 for this service_name.
-    post = requests.post(url, headers=headers, data=json_string, verify=False, cookies=cookies)
-
-    if post.status_code == 200: # Create Service was successful.
-        print(f'[INFO] create_service: {service_name} Successful')
-        return True
-
-    else: # Create Service has failed.
+    # Creating a service is safe to retry, as a second create of the same service only says it already exists.
+    try:
+        post = ng1.client.post(url, idempotent=True, headers=ng1.headers, data=json_string, cookies=ng1.cookies)
+    except Ng1ConflictError:
         # If the service exists, don't post an error message, just show as info.
         # These services can be used by many customers without creating user specific services.
-        if 'exists' in post.text:
-            print(f'[INFO] create_service: {service_name}. Service already exists')
-        else:
-            print('[ERROR] create_service', service_name, 'Failed')
-            print('URL:', url)
-            print('Response Code:', post.status_code)
-            print('Response Body:', post.text)
-            print('JSON string', json_string)
-
+        print(f'[INFO] create_service: {service_name}. Service already exists')
         return False
 
-def get_devices(ng1_host, headers, cookies):
+    # Create Service was successful.
+    print(f'[INFO] create_service: {service_name} Successful')
+    if service_ids != None:
+        try:
+            service_ids[service_name] = post.json()['serviceDetail'][0]['id']
+        except (ValueError, KeyError, IndexError, TypeError):
+            pass # nG1 did not return the new service definition, the id will be looked up later.
+    return True
+
+def get_devices(ng1):
     device_uri = "/ng1api/ncm/devices/"
-    url = ng1_host + device_uri
+    url = ng1.host + device_uri
     # perform the HTTPS API call to get the device information
-    get = requests.get(url, headers=headers, verify=False, cookies=cookies)
-
-    if get.status_code == 200:
-        # success
-        print('[INFO] get_devices request Successful')
-
-        # return the json object that contains the device information
-        return get.json()
+    get = ng1.client.get(url, headers=ng1.headers, cookies=ng1.cookies)
 
-    else:
-        print('[ERROR] get_devices request failed')
-        print('URL:', url)
-        print('Response Code:', get.status_code)
-        print('Response Body:', get.text)
+    print('[INFO] get_devices request Successful')
 
-        return False
+    # return the json object that contains the device information
+    return get.json()
 
-def get_device(ng1_host, device_name, headers, cookies):
+def get_device(ng1, device_name):
     device_uri = "/ng1api/ncm/device/"
-    url = ng1_host + device_uri
+    url = ng1.host + device_uri
     # perform the HTTPS API call to get the device information
-    get = requests.get(url, headers=headers, verify=False, cookies=cookies)
+    get = ng1.client.get(url, headers=ng1.headers, cookies=ng1.cookies)
 
-    if get.status_code == 200:
-        # success
-        print('[INFO] get_device for', device_name, 'Successful')
+    print('[INFO] get_device for', device_name, 'Successful')
 
-        # return the json object that contains the device information
-        return get.json()
+    # return the json object that contains the device information
+    return get.json()
 
-    else:
-        print('[ERROR] get_device for', device_name, 'Failed')
-        print('URL:', url)
-        print('Response Code:', get.status_code)
-        print('Response Body:', get.text)
-
-        return False
-
-def get_device_interfaces(ng1_host, headers, cookies, device_name):
+def get_device_interfaces(ng1, device_name):
     device_uri = "/ng1api/ncm/devices/" + device_name + "/interfaces"
-    url = ng1_host + device_uri
+    url = ng1.host + device_uri
     # perform the HTTPS API call to get the device information
-    get = requests.get(url, headers=headers, verify=False, cookies=cookies)
-
-    if get.status_code == 200:
-        # success
-        print('[INFO] get_device_interfaces for', device_name, 'Successful')
+    get = ng1.client.get(url, headers=ng1.headers, cookies=ng1.cookies)
 
-        # return the json object that contains the device information
-        return get.json()
+    print('[INFO] get_device_interfaces for', device_name, 'Successful')
 
-    else:
-        print('[ERROR] get_device_interfaces for', device_name, 'Failed')
-        print('URL:', url)
-        print('Response Code:', get.status_code)
-        print('Response Body:', get.text)
+    # return the json object that contains the device information
+    return get.json()
 
-        return False
-
-def get_device_interface_locations(ng1_host, device_name, interface_id, headers, cookies):
+def get_device_interface_locations(ng1, device_name, interface_id):
     device_uri = "/ng1api/ncm/devices/" + device_name + "/interfaces/" + interface_id + "/locations"
-    url = ng1_host + device_uri
+    url = ng1.host + device_uri
     # perform the HTTPS API call to get the device information
-    get = requests.get(url, headers=headers, verify=False, cookies=cookies)
-
-    if get.status_code == 200:
-        # success
-        print('[INFO] get_device_interface_locations for', device_name, 'Interface', interface_id, 'Successful')
+    get = ng1.client.get(url, headers=ng1.headers, cookies=ng1.cookies)
 
-        # return the json object that contains the device information
-        return get.json()
-
-    else:
-        print('[ERROR] get_device_interface_locations for ', device_name, 'Interface', interface_id, 'Failed')
-        print('URL:', url)
-        print('Response Code:', get.status_code)
-        print('Response Body:', get.text)
+    print('[INFO] get_device_interface_locations for', device_name, 'Interface', interface_id, 'Successful')
 
-        return False
+    # return the json object that contains the device information
+    return get.json()
 
-def get_applications(ng1_host, headers, cookies):
+def get_applications(ng1):
     uri = "/ng1api/ncm/applications/"
-    url = ng1_host + uri
+    url = ng1.host + uri
 
     # perform the HTTPS API call to get the Services information
-    get = requests.get(url, headers=headers, verify=False, cookies=cookies)
-
-    if get.status_code == 200:
-        # success
-        print('[INFO] get_applications Successful')
+    get = ng1.client.get(url, headers=ng1.headers, cookies=ng1.cookies)
 
-        # return the json object that contains the Services information
-        return get.json()
+    print('[INFO] get_applications Successful')
 
-    else:
-        print('[FAIL] get_applications Failed')
-        print('URL:', url)
-        print('Response Code:', get.status_code)
-        print('Response Body:', get.text)
+    # return the json object that contains the Services information
+    return get.json()
 
-        return False
-
-def get_app_detail(ng1_host, headers, cookies, app_name):
+def get_app_detail(ng1, app_name):
     uri = "/ng1api/ncm/applications/"
-    url = ng1_host + uri + app_name
+    url = ng1.host + uri + app_name
 
     # perform the HTTPS API call to get the Service information
-    get = requests.get(url, headers=headers, verify=False, cookies=cookies)
-
-    if get.status_code == 200:
-        # success
-        print('[INFO] get_app_detail Successful')
+    get = ng1.client.get(url, headers=ng1.headers, cookies=ng1.cookies)
 
-        # return the json object that contains the Service information
-        return get.json()
+    print('[INFO] get_app_detail Successful')
 
-    else:
-        print('[FAIL] get_app_detail Failed')
-        print('URL:', url)
-        print('Response Code:', get.status_code)
-        print('Response Body:', get.text)
-
-        return False
+    # return the json object that contains the Service information
+    return get.json()
 
-def get_messages(ng1_host, headers, cookies, app_name):
+def get_messages(ng1, app_name):
     uri = "/ng1api/ncm/applications/" + app_name + "/messages"
-    url = ng1_host + uri
+    url = ng1.host + uri
 
     # perform the HTTPS API call to get the App Messages information
-    get = requests.get(url, headers=headers, verify=False, cookies=cookies)
+    get = ng1.client.get(url, headers=ng1.headers, cookies=ng1.cookies)
 
-    if get.status_code == 200:
-        # success
-        print('[INFO] get_messages Successful')
+    print('[INFO] get_messages Successful')
 
-        # return the json object that contains the Services information
-        return get.json()
-
-    else:
-        print('[FAIL] get_messages Failed')
-        print('URL:', url)
-        print('Response Code:', get.status_code)
-        print('Response Body:', get.text)
-
-        return False
+    # return the json object that contains the Services information
+    return get.json()
 
-def get_message_detail(ng1_host, headers, cookies, app_name, message_name):
+def get_message_detail(ng1, app_name, message_name):
     uri = "/ng1api/ncm/applications/" + app_name + "/messages/" + message_name
-    url = ng1_host + uri
+    url = ng1.host + uri
 
     # perform the HTTPS API call to get the app message information
-    get = requests.get(url, headers=headers, verify=False, cookies=cookies)
+    get = ng1.client.get(url, headers=ng1.headers, cookies=ng1.cookies)
 
-    if get.status_code == 200:
-        # success
-        print('[INFO] get_message_detail Successful')
+    print('[INFO] get_message_detail Successful')
 
-        # return the json object that contains the Service information
-        return get.json()
+    # return the json object that contains the Service information
+    return get.json()
 
-    else:
-        print('[FAIL] get_message_detail Failed')
-        print('URL:', url)
-        print('Response Code:', get.status_code)
-        print('Response Body:', get.text)
+def get_service_alert_profiles(ng1):
+    uri = "/ng1api/ncm/servicealertprofiles/"
+    url = ng1.host + uri
 
-        return False
+    # perform the HTTPS API call to get the list of all service alert profiles
+    get = ng1.client.get(url, headers=ng1.headers, cookies=ng1.cookies)
+
+    print('[INFO] get_service_alert_profiles Successful')
+
+    # return the json object that contains the list of service alert profiles
+    return get.json()
 
-def get_service_alert_profile(ng1_host, headers, cookies, profile_name):
+def get_service_alert_profile(ng1, profile_name):
     uri = "/ng1api/ncm/servicealertprofiles/" + profile_name
-    url = ng1_host + uri
+    url = ng1.host + uri
 
     # perform the HTTPS API call to get the service alert profiles information
-    get = requests.get(url, headers=headers, verify=False, cookies=cookies)
+    get = ng1.client.get(url, headers=ng1.headers, cookies=ng1.cookies)
 
-    if get.status_code == 200:
-        # success
-        print(f'[INFO] get_service_alert_profile for {profile_name} Successful')
+    print(f'[INFO] get_service_alert_profile for {profile_name} Successful')
 
-        # return the json object that contains the Services information
-        return get.json()
+    # return the json object that contains the Services information
+    return get.json()
 
-    else:
-        print(f'[FAIL] get_service_alert_profile for {profile_name} Failed')
-        print('URL:', url)
-        print('Response Code:', get.status_code)
-        print('Response Body:', get.text)
-
-        return False
 
 # ---------- Code Driver section below ----------------------------------------
 
-now = datetime.now()
-date_time = now.strftime("%Y_%m_%d_%H%M%S")
-
-# Create the logging function.
-# Use this option to log to stdout and stderr using systemd. You must also import os.
-# logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"))
-# Use this option to log to a file in the same directory as the .py python program is running
-logging.basicConfig(filename="ng1_add_cisco_iot_customer.log", format='%(asctime)s %(message)s', filemode='a+')
-# Creating a logger object.
-logger = logging.getLogger()
-# Set the logging level to the lowest setting so that all logging messages get logged.
-logger.setLevel(logging.INFO) # Allowable options include DEBUG, INFO, WARNING, ERROR, and CRITICAL.
-logger.info(f"*** Start of logs {date_time} ***")
+# The version of the inventory cache file layout. Caches saved with a different version are rebuilt.
+inventory_cache_version = 3
+# The version of the service cache file layout. Caches saved with a different version are not used.
+service_cache_version = 1
 
 # Hardcoding the filenames for encrypted credentials and the key file needed to decrypt the credentials.
 cred_filename = 'CredFile.ini'
-os_type = sys.platform
-if os_type == 'linux':
+if sys.platform == 'linux':
     ng1key_file = '.ng1key.key'
 else:
     ng1key_file = 'ng1key.key'
 
-
-# Retrieve the decrypted credentials that we will use to open a session to nG1.
-try:
-    with open(ng1key_file, 'r') as ng1key_in:
-        ng1key = ng1key_in.read().encode()
-        fng1 = Fernet(ng1key)
-except:
-    print(f'[CRITICAL] Unable to open ng1key_file: {ng1key_file}. Exiting...')
-    sys.exit()
-try:
-    with open(cred_filename, 'r') as cred_in:
-        lines = cred_in.readlines()
-        ng1token = lines[2].partition('=')[2].rstrip("\n")
-        #Check to see if we are expected to use an API Token or Username:Password
-        if len(ng1token) > 1:
-            use_token = True
-            ng1token_pl = fng1.decrypt(ng1token.encode()).decode()
-        else:
-            use_token = False
-            ng1username = lines[3].partition('=')[2].rstrip("\n")
-            ng1password = lines[4].partition('=')[2].rstrip("\n")
-            ng1password_pl = fng1.decrypt(ng1password.encode()).decode()
-        ng1destination = lines[5].partition('=')[2].rstrip("\n")
-        ng1destPort = lines[6].partition('=')[2].rstrip("\n")
-except:
-    print(f'[CRITICAL] Unable to open cred_filename: {cred_filename}. Exiting...')
-    sys.exit()
-
-# You can use your username and password (plain text) in the authorization header (basic authentication).
-# In this case cookies must be set to 'Null'.
-# If you are using the authentication Token, then credentials = 'Null'.
-# credentials = 'jgiles', 'netscout1'.
-# cookies = 'Null'.
-
-# You can use an authentication token named NSSESSIONID obtained from the User Management module in nGeniusONE (open the user and click Generate New Key).
-# If we are using the token rather than credentials, we will set credentials to 'Null'.
-if use_token == True:
-    credentials = 'Null'
-
-    cookies = {
-        'NSSESSIONID': ng1token_pl, # In this case we will use the token read from the cred_filename file.
-        }
-        # This user token is for jgiles user on the San Jose Lab nG1.
-        #cookies = {
-        #    'NSSESSIONID': 'cqDYQ7FFMtuonYyFHmBztqVtSIcM4S+jzV6iOyNwBwD/vCu88+gYTjuBvFDGUzPcwcNnhRv8GMNR5PSSYJb1JhQTpQi8VYdsb0Kw7ow1J5c=',
-        #}
-# Otherwise set the credentials to username:password and use that instead of an API token.
-else:
-    cookies = 'Null'
-    credentials = ng1username + ':' + ng1password_pl
-
-# set ng1_host to what was read out of the credentials .ini file.
-if ng1destPort == '80' or ng1destPort == '8080':
-    web_protocol = 'http://'
-elif ng1destPort == '443' or ng1destPort == '8443':
-    web_protocol = 'https://'
-else:
-    print(f'[CRITICAL] nG1 destination port {ng1destPort} is not equal to 80, 8080, 443 or 8443')
-    print('Exiting...')
-    sys.exit()
-ng1_host = web_protocol + ng1destination + ':' + ng1destPort
-
 # specify the headers to use in the API calls.
 headers = {
     'Cache-Control': "no-cache",
@@ -1441,283 +3095,426 @@ headers = {
     'Content-Type': "application/json"
 }
 
-# To use username and password, pass in your credentials and set cookies = 'Null'.
-# To use a token, pass in your cookies and set credentials = 'Null'.
-# print ('cookies = ', cookies, ' and credentials = ', credentials)
-#
-cookies = open_session(ng1_host, headers, cookies, credentials)
+# Settings for the pooled connections to nG1 that every API call shares.
+ng1_pool_size = 10 # The max number of keep-alive connections to hold open to nG1.
+ng1_keep_alive = True # Set to False to close the connection after every API call.
+ng1_max_retries = 3 # The number of retries on connection errors, throttled (429) and 5xx responses.
+ng1_backoff_factor = 0.5 # The most we wait before the first retry in seconds, doubled on each retry.
+ng1_max_backoff = 30 # The most we wait before any one retry in seconds.
+ng1_timeout = (10, 120) # The (connect, read) timeout for each API call in seconds.
+# Open a new nG1 session once the current one is this many seconds old. Keep it below the session timeout...
+# configured on nG1. Set to 0 to keep one session for the whole run. A session that nG1 refuses is re-opened anyway.
+ng1_session_max_age = 1500
+# The number of API calls to run at the same time while discovering devices, interfaces and APNs.
+# Keep this at or below ng1_pool_size so that every worker can reuse a pooled connection. Set to 1 to run serially.
+discovery_workers = 8
+# The number of services to create at the same time. Services are created in two tiers, network services...
+# first and then the application services that use them, but the services within each tier are independent.
+service_workers = 8
+# Settings for the asyncio transport that is used with --async-transport.
+# async_max_concurrency is the max number of API calls in flight at the same time across all endpoints.
+# async_endpoint_rate_limits is the max calls per second for each endpoint. Endpoints not listed are not rate limited.
+async_max_concurrency = 32
+async_endpoint_rate_limits = {'GET /devices/interfaces': 50,
+                              'GET /devices/interfaces/associateapns': 50,
+                              'POST /services': 20,
+                              'POST /domains': 10}
+# The settings of the apps in the app list json file that were hardcoded before apps could declare them.
+# An app's own settings in the app list json file take priority over these.
+legacy_app_settings = {'Web': {'alertProfile': 'Web Group-Baseline', 'protocolOrGroupCode': 'WEB', 'isProtocolGroup': True},
+                       'DNS': {'alertProfile': 'DNS-Baseline'},
+                       'GTPv0': {'alertProfile': 'GTP-Baseline', 'protocolOrGroupCode': 'GTP'}}
+# The acronyms of the datacenters that were hardcoded before the datacenters json file could set them, by the...
+# start of the datacenter name. An acronym set in the datacenters json file takes priority over these.
+legacy_datacenter_acronyms = {'Atl': 'ATL', 'Pho': 'PHX', 'San': 'SJC', 'Tor': 'TOR', 'Van': 'VAN'}
+# The seconds per API call to use when estimating how long a plan will take, if no calls to nG1 have been timed yet.
+plan_default_request_seconds = 0.25
+# The number of the latest calls to each API endpoint whose latency is kept for the p50 and p95 in the run report.
+metrics_latency_samples = 1000
+# Settings for --daemon. The daemon API only listens on 127.0.0.1.
+daemon_port = 8765 # The default port for the daemon API.
+daemon_job_workers = 2 # The number of jobs to provision at the same time.
+daemon_refresh_seconds = 900 # How often to refresh the alert profiles and domain tree. Set to 0 to never refresh.
+# How often to refresh the devices, interfaces and APNs that changed. Set to 0 to never refresh.
+daemon_inventory_refresh_seconds = 300
+# Every device is re-checked, whether its fingerprint changed or not, once in this many inventory refreshes,...
+# to pick up interface status and APN association changes. Set to 0 to only re-check devices that changed.
+daemon_inventory_sweep_refreshes = 12
 
 # Hardcoding the name of the master datacenter to gateways mapping json file.
 current_datacenters_filename = 'CiscoIOT-DataCenters.json'
 # Hardcoding the name of the master customer applications list json file.
 app_list_filename = 'CiscoIOT-AppList.json'
-
-# We need the IDs of the alert profiles that we want to associate to the new services we will create.
-# I am hardcoding this section for now.
-profile_name = 'ThroughPut-Baseline'
-service_alert_profile = get_service_alert_profile(ng1_host, headers, cookies, profile_name)
-if service_alert_profile == False:
-    print('Exiting...')
-    sys.exit()
-ThroughPut_Baseline_profile_id = service_alert_profile['Id']
-profile_name = 'GTP-Baseline'
-service_alert_profile = get_service_alert_profile(ng1_host, headers, cookies, profile_name)
-if service_alert_profile == False:
-    print('Exiting...')
-    sys.exit()
-GTP_Baseline_profile_id = service_alert_profile['Id']
-profile_name = 'Web Group-Baseline'
-service_alert_profile = get_service_alert_profile(ng1_host, headers, cookies, profile_name)
-if service_alert_profile == False:
-    print('Exiting...')
-    sys.exit()
-Web_Group_Baseline_profile_id = service_alert_profile['Id']
-profile_name = 'DNS-Baseline'
-service_alert_profile = get_service_alert_profile(ng1_host, headers, cookies, profile_name)
-if service_alert_profile == False:
-    print('Exiting...')
-    sys.exit()
-DNS_Baseline_profile_id = service_alert_profile['Id']
-
-# Build a device list for active Infinistreams/vStreams in the system.
-# For each, include a list of active interfaces.
-# For each interface, include a list of APNs associated to that interface
-device_list, datacenter_list = build_device_list(current_datacenters_filename)
-
+# Hardcoding the name of the file that caches the device, interface and APN inventory between runs.
+inventory_cache_filename = 'CiscoIOT-Inventory_cache.json'
+# Hardcoding the name of the file that caches the name and id of every service in nG1 between runs.
+service_cache_filename = 'CiscoIOT-Service_cache.json'
+# Hardcoding the name of the journal of what has been created, used to resume a run that stopped part way through.
+journal_filename = 'CiscoIOT-Journal.jsonl'
 customers_filename = 'CiscoIOT-Customers' # Hardcoding the stem of the customer definition filename
 current_customers_filename = customers_filename + '_current.json' # The name of the master customer definition json file.
 new_customers_filename = customers_filename + '_new.json' # The name of the new customer definition json file we will create.
 old_customers_filename = customers_filename + '_old.json' # The name of the backup customer definition json file we will create.
 
-# Get info on all existing customers
-customer_configs, customer_list = get_existing_customers_from_file(current_customers_filename)
-
-# Fetch the existing domain tree data so that we know what domains already exist.
-domain_tree_data = get_domains(ng1_host, headers, cookies)
-# Search the existing domain tree to see if all the customers listed in the current_customers_filename match...
-# what is currently configured in the dashboard domain tree. Print out any domains that are missing.
-# Also search the customers listed in the current_customers_filename to see if there is a match in the...
-# currently configured domain tree. Print out any customer names that are missing from the domain tree.
-customer_domains_missing = validate_cust_domains_exist(customer_configs, domain_tree_data)
-if customer_domains_missing != []: # There are missing customer domains.
-    print(f'[Warning] There are customers in the {current_customers_filename} that are not in the current domain tree')
-    print(f'[Warning] Customers in {current_customers_filename} with no domains are: {customer_domains_missing}')
-    while True:
-        user_input = input('Continue? y or n: ')
-        if user_input.lower() == 'n':
-            sys.exit()
-        elif user_input.lower() == 'y':
-            break
-        else:
-            print("Invalid input. Please enter 'y' or 'n'")
-            continue
-else:
-    print(f'[INFO] Customers in {current_customers_filename} all have verified domains in the system')
-# Initialize an empty apn list that we will use later to verify user input.
-apn_list = []
-# Get info on all APN locations system-wide.
-apn_configs = get_apns(ng1_host, headers, cookies)
+def parse_arguments(date_time):
+    parser = argparse.ArgumentParser(description='Add a new Cisco IOT customer configuration to nGeniusONE')
+    parser.add_argument('--refresh-inventory', action='store_true',
+                        help='ignore the inventory cache and rediscover all devices, interfaces and APNs')
+    parser.add_argument('--inventory-ttl', type=int, default=3600,
+                        help='seconds the inventory cache is used as is before changed devices are refreshed (default: 3600)')
+    parser.add_argument('--manifest', default=None,
+                        help='add every customer in this json or csv manifest file instead of presenting the customer menu')
+    parser.add_argument('--reconcile', action='store_true',
+                        help='create only the services and domains that are missing for the customers already in the customers file')
+    parser.add_argument('--async-transport', action='store_true',
+                        help='send the discovery and service create calls through the asyncio transport with per-endpoint rate limits')
+    parser.add_argument('--report', default=f'CiscoIOT-RunReport_{date_time}.json', metavar='REPORT_FILE',
+                        help='json file to write the timing of each phase and the latency of each API endpoint to')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue the last run from the journal, without creating again what it had already created')
+    parser.add_argument('--plan', nargs='?', default=None, const=f'CiscoIOT-Plan_{date_time}.json', metavar='PLAN_FILE',
+                        help='write the services, domains and API calls the customers need to a json file without changing nG1')
+    parser.add_argument('--daemon', action='store_true',
+                        help='keep the session and inventory loaded and add the customers submitted to a local HTTP API')
+    parser.add_argument('--daemon-port', type=int, default=daemon_port,
+                        help=f'the port on 127.0.0.1 for the --daemon API (default: {daemon_port})')
+    args = parser.parse_args()
+    if args.resume == True and (args.manifest != None or args.plan != None or args.reconcile == True):
+        parser.error('--resume continues the last run as it was, it cannot be used with --manifest, --plan or --reconcile')
+    if args.reconcile == True and (args.manifest != None or args.plan != None):
+        parser.error('--reconcile works on the customers already in the customers file and changes nG1, it cannot be used with --manifest or --plan')
+    if args.daemon == True and (args.manifest != None or args.plan != None or args.reconcile == True or args.resume == True):
+        parser.error('--daemon takes its customers from its API, it cannot be used with --manifest, --plan, --reconcile or --resume')
+    return args
+
+def setup_logging(date_time):
+    # Create the logging function.
+    # Use this option to log to stdout and stderr using systemd. You must also import os.
+    # logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"))
+    # Use this option to log to a file in the same directory as the .py python program is running
+    logging.basicConfig(filename="ng1_add_cisco_iot_customer.log", format='%(asctime)s %(message)s', filemode='a+')
+    # Set the logging level to the lowest setting so that all logging messages get logged.
+    logger.setLevel(logging.INFO) # Allowable options include DEBUG, INFO, WARNING, ERROR, and CRITICAL.
+    logger.info(f"*** Start of logs {date_time} ***")
+
+def read_credentials(cred_filename, ng1key_file):
+    # Retrieve the decrypted credentials that we will use to open a session to nG1.
+    # Returns the ng1_host and the cookies and credentials to pass to open_session.
+    try:
+        with open(ng1key_file, 'r') as ng1key_in:
+            ng1key = ng1key_in.read().encode()
+            fng1 = Fernet(ng1key)
+    except:
+        print(f'[CRITICAL] Unable to open ng1key_file: {ng1key_file}. Exiting...')
+        sys.exit()
+    try:
+        with open(cred_filename, 'r') as cred_in:
+            lines = cred_in.readlines()
+            ng1token = lines[2].partition('=')[2].rstrip("\n")
+            #Check to see if we are expected to use an API Token or Username:Password
+            if len(ng1token) > 1:
+                use_token = True
+                ng1token_pl = fng1.decrypt(ng1token.encode()).decode()
+            else:
+                use_token = False
+                ng1username = lines[3].partition('=')[2].rstrip("\n")
+                ng1password = lines[4].partition('=')[2].rstrip("\n")
+                ng1password_pl = fng1.decrypt(ng1password.encode()).decode()
+            ng1destination = lines[5].partition('=')[2].rstrip("\n")
+            ng1destPort = lines[6].partition('=')[2].rstrip("\n")
+    except:
+        print(f'[CRITICAL] Unable to open cred_filename: {cred_filename}. Exiting...')
+        sys.exit()
 
-if apn_configs != False:
-    #print(f'apn_configs["apns"] are: {apn_configs["apns"]}')
-    if apn_configs["apns"] == []: # get_apns was successful, but there were no apns in the system.
-        print('[CRITICAL] There are no APNs configured in this system. Exiting...')
+    # You can use your username and password (plain text) in the authorization header (basic authentication).
+    # In this case cookies must be set to 'Null'.
+    # If you are using the authentication Token, then credentials = 'Null'.
+    # credentials = 'jgiles', 'netscout1'.
+    # cookies = 'Null'.
+
+    # You can use an authentication token named NSSESSIONID obtained from the User Management module in nGeniusONE (open the user and click Generate New Key).
+    # If we are using the token rather than credentials, we will set credentials to 'Null'.
+    if use_token == True:
+        credentials = 'Null'
+
+        cookies = {
+            'NSSESSIONID': ng1token_pl, # In this case we will use the token read from the cred_filename file.
+            }
+            # This user token is for jgiles user on the San Jose Lab nG1.
+            #cookies = {
+            #    'NSSESSIONID': 'cqDYQ7FFMtuonYyFHmBztqVtSIcM4S+jzV6iOyNwBwD/vCu88+gYTjuBvFDGUzPcwcNnhRv8GMNR5PSSYJb1JhQTpQi8VYdsb0Kw7ow1J5c=',
+            #}
+    # Otherwise set the credentials to username:password and use that instead of an API token.
+    else:
+        cookies = 'Null'
+        credentials = ng1username + ':' + ng1password_pl
+
+    # set ng1_host to what was read out of the credentials .ini file.
+    if ng1destPort == '80' or ng1destPort == '8080':
+        web_protocol = 'http://'
+    elif ng1destPort == '443' or ng1destPort == '8443':
+        web_protocol = 'https://'
+    else:
+        print(f'[CRITICAL] nG1 destination port {ng1destPort} is not equal to 80, 8080, 443 or 8443')
+        print('Exiting...')
         sys.exit()
+    ng1_host = web_protocol + ng1destination + ':' + ng1destPort
+
+    return ng1_host, cookies, credentials
+
+def create_ng1_context(ng1_host, use_async_transport, metrics):
+    # Create the single nG1 client that all of the API helper functions send their requests through,...
+    # and the Ng1Context that passes it to them. No session is opened yet.
+    pool_size = ng1_pool_size
+    if use_async_transport == True:
+        # Hold a pooled connection open for every call the asyncio transport can have in flight.
+        pool_size = max(pool_size, async_max_concurrency)
+    ng1_client = Ng1Client(pool_size, ng1_keep_alive, ng1_max_retries, ng1_backoff_factor, ng1_timeout, metrics, ng1_max_backoff)
+    if use_async_transport == True:
+        ng1_transport = AsyncNg1Transport(async_max_concurrency, async_endpoint_rate_limits)
     else:
-        for apn in apn_configs["apns"]:
-            apn_name = apn["name"]
-            apn_list.append(apn_name)
-else:
-    print('[CRITICAL] Unable to fetch APNs. Exiting....')
-    sys.exit()
-
-# Get the new customer profile from the user by presenting a menu.
-# Note that customer profiles do not actually include the list of datacenters the user selected.
-# So we need to return that as separate list called dc_entry_list.
-while True:
-    profile, dc_entry_list = customer_menu(ng1_host, headers, cookies, apn_list, datacenter_list, customer_list, device_list)
-    if profile != False: # We made it through the menu Successfully.
-        # print(f"Profile is : {profile}") # Display the customer attributes that the user entered.
-        break
-    # If the user does not confirm the new customer profile, let them start over
+        ng1_transport = None
+    return Ng1Context(ng1_client, ng1_host, headers, None, ng1_transport, metrics, discovery_workers, service_workers)
+
+def load_alert_profile_ids(ng1, app_data):
+    # We need the IDs of the alert profiles that we want to associate to the new services we will create.
+    # The network services use the ThroughPut-Baseline profile and each app in the app list names its own profile.
+    ng1.alert_profile_ids = resolve_alert_profile_ids(ng1, ['ThroughPut-Baseline'] + get_app_alert_profile_names(app_data),
+                                                      ng1.discovery_workers)
+
+def load_service_registry(ng1, service_cache_filename, inventory_ttl, refresh_inventory, read_only):
+    # Give the context a service registry.
+    # A run that creates services always lists the services in nG1, because a service deleted or recreated since...
+    # the service cache was saved would otherwise be skipped and its stale id used as a member.
+    # A read only run, such as --plan, uses the service cache if it is fresh enough.
+    ng1.service_registry = ServiceRegistry(ng1.host)
+    if read_only == False or refresh_inventory == True or ng1.service_registry.load(service_cache_filename, inventory_ttl) == False:
+        ng1.service_registry.seed(ng1)
+
+def main():
+    now = datetime.now()
+    date_time = now.strftime("%Y_%m_%d_%H%M%S")
+    args = parse_arguments(date_time)
+    setup_logging(date_time)
+
+    # Record the wall time of each phase of the run and the latency of every API call.
+    # The summary is printed and the report is written however the run ends.
+    run_metrics = RunMetrics(metrics_latency_samples)
+    atexit.register(run_metrics.finish, args.report)
+    run_metrics.start_phase('startup')
+
+    ng1_host, cookies, credentials = read_credentials(cred_filename, ng1key_file)
+    ng1 = create_ng1_context(ng1_host, args.async_transport, run_metrics)
+
+    # A failed nG1 API call raises an Ng1Error. Show the ones that stop the run as a short message.
+    sys.excepthook = functools.partial(report_ng1_error, ng1)
+    # Exit normally on SIGTERM or SIGHUP, for example from kill or a closed terminal, so that the nG1 session...
+    # is closed. Ctrl+C raises KeyboardInterrupt, which already does the same.
+    signal.signal(signal.SIGTERM, functools.partial(exit_on_signal, ng1))
+    if hasattr(signal, 'SIGHUP'): # There is no SIGHUP on Windows.
+        signal.signal(signal.SIGHUP, functools.partial(exit_on_signal, ng1))
+
+    # To use username and password, pass in your credentials and set cookies = 'Null'.
+    # To use a token, pass in your cookies and set credentials = 'Null'.
+    # print ('cookies = ', cookies, ' and credentials = ', credentials)
+    #
+    run_metrics.start_phase('auth')
+    ng1_session = Ng1Session(ng1, cookies, credentials, ng1_session_max_age)
+    ng1_session.open()
+    # Close the session however the program ends. This runs before the run report is written.
+    atexit.register(ng1_session.close)
+
+    journal_state = read_journal(journal_filename)
+    if args.resume == True and (journal_state == False or journal_state['run_done'] == True):
+        print(f'[CRITICAL] There is no unfinished run in the journal {journal_filename} to resume. Exiting...')
+        sys.exit()
+
+    # Get info on all customer applications from a json file and put it into the app_data dictionary.
+    app_data = get_customer_apps_from_file(app_list_filename)
+
+    run_metrics.start_phase('alert profile lookup')
+    load_alert_profile_ids(ng1, app_data)
+
+    # Build a device list for active Infinistreams/vStreams in the system.
+    # For each, include a list of active interfaces.
+    # For each interface, include a list of APNs associated to that interface
+    # Also build the list of datacenters and the list of all APNs system-wide.
+    # These are loaded from the inventory cache file if it is fresh enough.
+    run_metrics.start_phase('inventory')
+    device_list, datacenter_acronyms, ng1.apn_catalogue, device_fingerprints = load_inventory(ng1, current_datacenters_filename, inventory_cache_filename,
+                                                                                          args.inventory_ttl, args.refresh_inventory,
+                                                                                          ng1.discovery_workers)
+    # Index the device list so that we can look up interfaces by datacenter, gateway and APN...
+    # and look up the datacenters and gateways where each APN is associated.
+    inventory = Inventory(device_list, datacenter_acronyms)
+
+    # Get info on all existing customers
+    run_metrics.start_phase('existing customers and domains')
+    customer_configs, customer_list = get_existing_customers_from_file(current_customers_filename)
+
+    # Fetch the existing domain tree data so that we know what domains already exist.
+    domain_tree_data = get_domains(ng1)
+    # Search the existing domain tree to see if all the customers listed in the current_customers_filename match...
+    # what is currently configured in the dashboard domain tree. Print out any domains that are missing.
+    # Also search the customers listed in the current_customers_filename to see if there is a match in the...
+    # currently configured domain tree. Print out any customer names that are missing from the domain tree.
+    customer_domains_missing = validate_cust_domains_exist(customer_configs, domain_tree_data)
+    # Index the existing domain tree so that we can find domain id numbers without downloading the tree again.
+    domain_index = build_domain_index(domain_tree_data)
+
+    if args.reconcile == True:
+        # Bring nG1 back in line with every customer in the current customers file, for example after...
+        # nG1 has been restored or upgraded. Only the services and domains that are missing are created.
+        # Fetch every existing service once, rather than trying to create each one to find out if it exists.
+        services_data = get_services(ng1)
+        service_ids = {}
+        for service in services_data['serviceDetail']:
+            service_ids[service['serviceName']] = service['id']
+        total_services_created = 0
+        total_domains_created = 0
+        for profile in customer_configs['Customers']:
+            dc_entry_list = get_customer_datacenters(profile, datacenter_acronyms)
+            print(f"[INFO] Reconciling customer: {profile['name']}")
+            services_created, domains_created = reconcile_customer(ng1, profile, dc_entry_list, inventory, app_data, service_ids, domain_index)
+            print(f"[INFO] Customer {profile['name']}: {services_created} missing services and {domains_created} missing domains created")
+            total_services_created += services_created
+            total_domains_created += domains_created
+        print(f"[INFO] Reconciled {len(customer_configs['Customers'])} customers: {total_services_created} services and {total_domains_created} domains created")
+        run_metrics.start_phase('close')
+        ng1_session.close()
+        ng1.client.print_connection_summary()
+        ng1.close()
+        sys.exit()
+
+    if customer_domains_missing != []: # There are missing customer domains.
+        print(f'[Warning] There are customers in the {current_customers_filename} that are not in the current domain tree')
+        print(f'[Warning] Customers in {current_customers_filename} with no domains are: {customer_domains_missing}')
+        # There is no one to ask when running a manifest, resuming or running as a daemon, so just warn.
+        while args.manifest == None and args.resume == False and args.daemon == False:
+            user_input = input('Continue? y or n: ')
+            if user_input.lower() == 'n':
+                sys.exit()
+            elif user_input.lower() == 'y':
+                break
+            else:
+                print("Invalid input. Please enter 'y' or 'n'")
+                continue
     else:
-        print('New customer profile discarded, starting over...')
-        print('')
-        continue
-
-# Fetch the APN id number that matches with each APN in the customer profile.
-apn_ids = build_apn_ids_dict(profile)
-
-# Initialize an empty dictionary to hold the name:id key, value pairs for each network service we create.
-# We will use this later to add members to the dashboard domains that we create.
-net_service_ids = {}
-# Create a network service for each interface (gateway) that the user specified.
-# Add the network service ids for each network service created to our net_service_ids dictionary.
-net_service_ids = create_gateway_net_services(ng1_host, headers, cookies, apn_ids, apn_name, device_list, profile, net_service_ids, dc_entry_list, ThroughPut_Baseline_profile_id)
-
-# Create network services that include all GGSNs (interfaces) for each APN on every valid datacenter.
-# Add the network service ids for each network service created to our net_service_ids dictionary.
-net_service_ids = create_all_ggsns_net_service(ng1_host, headers, cookies, apn_ids, device_list, profile, net_service_ids, dc_entry_list, ThroughPut_Baseline_profile_id)
-
-# Get info on all customer applications from a json file and put it into the app_data dictionary.
-app_data = get_customer_apps_from_file(app_list_filename)
-
-# Now create the application services for all apps defined in the app_data for each APN the user entered.
-# The app_service_ids list that is returned will become members of domains as we create them.
-# Therefore we need the id numbers to do that assignment.
-# Use the network services we already created as members for the app service definitions.
-app_service_ids = create_app_services(ng1_host, headers, cookies, apn_ids, app_data, net_service_ids, dc_entry_list, GTP_Baseline_profile_id)
-
-domain_name = 'Cisco IOT'
-# This is a domain layer that is common to all customers. If it exists, don't overwrite it.
-skip, existing_parent_domain_id = domain_exists(domain_name, domain_tree_data)
-
-if skip == False: # The domain does not yet exist, create it
-    # Create the domain.
-    # Initialize an empty list of domain member ids for use when we add domains that have members.
-    domain_member_ids = {}
-    parent_domain_id = 1 # This is the parentID of the default 'Enterprise' domain at the top.
-    parent_domain_id = build_domain_tree(ng1_host, headers, cookies, domain_name, parent_domain_id, domain_member_ids)
-
-domain_name = 'APNs'
-# This is a domain layer that is common to all customers. If it exists, don't overwrite it.
-skip, existing_parent_domain_id = domain_exists(domain_name, domain_tree_data)
-if skip == False: # The domain does not yet exist, create it
-    # Create the APN domain.
-    # Initialize an empty list of domain member ids for use when we add domains that have members.
-    domain_member_ids = {}
-    parent_domain_id = build_domain_tree(ng1_host, headers, cookies, domain_name, parent_domain_id, domain_member_ids)
-else:
-    # The domain already exists, set the parent_domain_id to the existing domain.
-    parent_domain_id = existing_parent_domain_id
+        print(f'[INFO] Customers in {current_customers_filename} all have verified domains in the system')
+
+    if args.daemon == True:
+        # Keep everything loaded so far in memory and add the customers submitted to the daemon API until stopped.
+        run_metrics.start_phase('service registry')
+        load_service_registry(ng1, service_cache_filename, args.inventory_ttl, args.refresh_inventory, False)
+        run_metrics.start_phase('daemon')
+        inventory_refresher = InventoryRefresher(ng1, device_list, datacenter_acronyms, device_fingerprints, current_datacenters_filename,
+                                                 inventory_cache_filename, daemon_inventory_sweep_refreshes)
+        provisioning_daemon = ProvisioningDaemon(ng1, app_data, inventory_refresher, domain_index, customer_configs, customer_list,
+                                                 (new_customers_filename, current_customers_filename, old_customers_filename),
+                                                 service_cache_filename, daemon_job_workers, daemon_refresh_seconds,
+                                                 daemon_inventory_refresh_seconds)
+        provisioning_daemon.serve(args.daemon_port)
+        return
+
+    # Build the batch of new customer profiles to add. Each entry is a (profile, dc_entry_list) tuple.
+    # Note that customer profiles do not actually include the list of datacenters the user selected.
+    # So we need to keep that as separate list called dc_entry_list.
+    if args.resume == True:
+        # Pick up the batch of customers from the journal of the run we are resuming.
+        customer_batch = [(run_customer['profile'], run_customer['datacenters']) for run_customer in journal_state['run']['customers']]
+        print(f"[INFO] Resuming the run started {journal_state['run']['started']}: {len(journal_state['customers_done'])} of "
+              f"{len(customer_batch)} customers were finished, {len(journal_state['service_ids'])} services and "
+              f"{len(journal_state['domain_ids'])} domains were created")
+    elif args.manifest != None:
+        # Validate every customer in the manifest before we make any changes to nG1.
+        manifest_customers = read_customer_manifest(args.manifest)
+        customer_batch, manifest_errors = build_manifest_profiles(ng1, manifest_customers, customer_list, inventory, datacenter_acronyms)
+        if manifest_errors != []:
+            for manifest_error in manifest_errors:
+                print(f'[CRITICAL] {manifest_error}')
+            print(f'[CRITICAL] The customer manifest {args.manifest} is not valid. No nG1 modifications will be made. Exiting...')
+            sys.exit()
+        if customer_batch == []:
+            print(f'[CRITICAL] There are no customers in the customer manifest {args.manifest}. Exiting...')
+            sys.exit()
+        print(f'[INFO] Customer manifest {args.manifest} validated: {len(customer_batch)} new customers to add')
+    else:
+        # Get the new customer profile from the user by presenting a menu.
+        run_metrics.start_phase('customer menu')
+        while True:
+            profile, dc_entry_list = customer_menu(ng1, ng1.apn_catalogue, customer_list, inventory)
+            if profile != False: # We made it through the menu Successfully.
+                # print(f"Profile is : {profile}") # Display the customer attributes that the user entered.
+                break
+            # If the user does not confirm the new customer profile, let them start over
+            else:
+                print('New customer profile discarded, starting over...')
+                print('')
+                continue
+        customer_batch = [(profile, dc_entry_list)]
+
+    # Services that already exist, for example because another customer shares the same APN, are not created again.
+    run_metrics.start_phase('service registry')
+    load_service_registry(ng1, service_cache_filename, args.inventory_ttl, args.refresh_inventory, args.plan != None)
+
+    if args.plan != None:
+        # Write out what we would create and how long it would take, then exit without making any changes.
+        run_metrics.start_phase('plan')
+        plan = build_plan(ng1, customer_batch, inventory, app_data, domain_index)
+        write_config_to_json(args.plan, plan)
+        plan_totals = plan['totals']
+        print(f"[INFO] Plan: {plan_totals['customers']} customers, {plan_totals['network_services']} network services, "
+              f"{plan_totals['application_services']} application services and {plan_totals['domains']} domains to create")
+        print(f"[INFO] Plan: {plan_totals['total_api_calls']} API calls, estimated to take {plan_totals['estimated_seconds']} seconds")
+        print('[INFO] No nG1 modifications were made')
+        run_metrics.start_phase('close')
+        ng1.close()
+        sys.exit()
 
-if profile['type'] == 'Connected Cars':
-    domain_name = 'Connected Car APNs'
-else:
-    domain_name = 'IOT APNs'
-# This is a domain layer that is common to all customers. If it exists, don't overwrite it
-skip, existing_parent_domain_id = domain_exists(domain_name, domain_tree_data)
-if skip == False: # The domain does not yet exist, create it
-    # Create the customer type domain.
-    # Initialize an empty list of domain member ids for use when we add domains that have members.
-    domain_member_ids = {}
-    parent_domain_id = build_domain_tree(ng1_host, headers, cookies, domain_name, parent_domain_id, domain_member_ids)
-else:
-    # The domain already eists, set the parent_domain_id to the existing domain.
-    parent_domain_id = existing_parent_domain_id
-
-domain_name = profile['name'] # Set the domain name to be the customer name as entered in the menu
-
-# Create the customer named domain. Note it is allowed that the customer named domain can be...
-# the same as APN named domains below it. We have already checked in customer menu for duplicate...
-# entries of the customer name. So this should create a unique customer name at this domain level.
-# The members for this customer domain will be all of the network interfaces for each APN.
-domain_member_ids = {} # Reset the list of domain members
-# If there is only one APN, then add all datacenter interfaces for this one APN as members...
-# of the customer domain. Otherwise, these will be added to the APN named domains.
-if len(apn_ids) == 1: # There is only one user entered APN name.
-    for network_service_name in net_service_ids:
-        for apn_name in apn_ids:
-            if apn_name.replace(" ","_") + '-All-GGSNs' in network_service_name:
-                domain_member_ids[network_service_name] = net_service_ids[network_service_name]
-# Create the customer domain using the customer name entered in the menu.
-# Make it a child domain of either IOT APNs or Connected Car APNs.
-customer_parent_domain_id  = build_domain_tree(ng1_host, headers, cookies, domain_name, parent_domain_id, domain_member_ids)
-
-# If there are more than one APN entered, we need to create domains for each named APN.
-for apn_name in apn_ids:
-    if len(apn_ids) > 1: # There are more than one user entered APN name
-        domain_name = apn_name
-        domain_member_ids = {} # Reset the list of domain members
-        # Add the All GGSNs network services as members to this domain, but only include those that...
-        # contain the APN name in this for loop.
-        for network_service_name in net_service_ids:
-            if apn_name.replace(" ","_") + '-All-GGSNs' in network_service_name:
-                domain_member_ids[network_service_name] = net_service_ids[network_service_name]
-        # Create the APN named domain including the All GGSNs network services as domain members.
-        apn_parent_domain_id = build_domain_tree(ng1_host, headers, cookies, domain_name, customer_parent_domain_id, domain_member_ids)
-    else: # There is only one user entered APN name.
-        apn_parent_domain_id = customer_parent_domain_id
-
-    # Create a child domain 'Control' under the customer name domain or under each APN if more than one.
-    domain_member_ids = {} # Reset the list of domain members
-    domain_name = 'Control'
-    control_parent_domain_id = build_domain_tree(ng1_host, headers, cookies, domain_name, apn_parent_domain_id, domain_member_ids)
-
-    # Create a child domain under 'Control' for each datacenter name that the user entered.
-    for datacenter in dc_entry_list:
-        domain_name = datacenter
-        domain_member_ids = {} # Reset the list of domain members
-        # Build the domain for this datacenter name that will contain the GTPvx domains. Place it as a child of 'Control'.
-        dc_parent_domain_id = build_domain_tree(ng1_host, headers, cookies, domain_name, control_parent_domain_id, domain_member_ids)
-        dc_acronym = translate_dc_name_to_acronym(datacenter)
-
-        #Add the GTPvx domains including the associated application services.
-        # These domains will have members, so we will build up a list to pass to build_domain_tree.
-        domain_member_ids = {} # Reset the list of domain members
-        # Look for any application service name that includes both the GTP app name, the APN name and the datacenter acronym.
-        for application_service_name in app_service_ids:
-            if 'GTPv0' in application_service_name and dc_acronym in application_service_name and apn_name.replace(" ","_") in application_service_name:
-                domain_member_ids[application_service_name] = app_service_ids[application_service_name]
-
-        domain_name = 'GTPv0' # Hardcoding the domain name based on the same list of apps for all customers.
-        parent_domain_id = build_domain_tree(ng1_host, headers, cookies, domain_name, dc_parent_domain_id, domain_member_ids)
-
-        domain_member_ids = {} # Reset the list of members.
-        # Look for any application service name that includes both the GTP app name, the APN name and the datacenter acronym.
-        for application_service_name in app_service_ids:
-            if 'GTPv1' in application_service_name and dc_acronym in application_service_name and apn_name.replace(" ","_") in application_service_name:
-                domain_member_ids[application_service_name] = app_service_ids[application_service_name]
-
-        domain_name = 'GTPv1' # Hardcoding the domain name based on the same list of apps for all customers.
-        parent_domain_id = build_domain_tree(ng1_host, headers, cookies, domain_name, dc_parent_domain_id, domain_member_ids)
-
-        domain_member_ids = {} # Reset the list of members.
-        # Look for any application service name that includes both the GTP app name, the APN name and the datacenter acronym.
-        for application_service_name in app_service_ids:
-            if 'GTPv2' in application_service_name and dc_acronym in application_service_name and apn_name.replace(" ","_") in application_service_name:
-                domain_member_ids[application_service_name] = app_service_ids[application_service_name]
-
-        domain_name = 'GTPv2' # Hardcoding the domain name based on the same list of apps for all customers.
-        parent_domain_id = build_domain_tree(ng1_host, headers, cookies, domain_name, dc_parent_domain_id, domain_member_ids)
-
-    domain_member_ids = {} # Reset the list of members
-    for datacenter in dc_entry_list:
-        dc_acronym = translate_dc_name_to_acronym(datacenter)
-        # Add the User domain as a child to the customer domain if only one APN.
-        # If more than one APN, the User domain is a child to each APN named domain.
-
-        # Look for any application service name that includes both the Web app name, the APN name and the datacenter acronym.
-        for application_service_name in app_service_ids:
-            if 'Web' in application_service_name and dc_acronym in application_service_name and apn_name.replace(" ","_") in application_service_name:
-                domain_member_ids[application_service_name] = app_service_ids[application_service_name]
-
-    domain_name = 'User' # Hardcoding the domain name based on the same list of Control, User and DNS for all customers.
-    user_parent_domain_id = build_domain_tree(ng1_host, headers, cookies, domain_name, apn_parent_domain_id, domain_member_ids)
-
-    domain_member_ids = {} # Reset the list of members
-    for datacenter in dc_entry_list:
-        dc_acronym = translate_dc_name_to_acronym(datacenter)
-        # Add the DNS domain as a child to the customer domain if only one APN.
-        # If more than one APN, the User domain is a child to each APN named domain.
-
-        # Look for any application service name that includes both the DNS app name, the APN name and the datacenter acronym.
-        for application_service_name in app_service_ids:
-            if 'DNS' in application_service_name and dc_acronym in application_service_name and apn_name.replace(" ","_") in application_service_name:
-                domain_member_ids[application_service_name] = app_service_ids[application_service_name]
-
-    domain_name = 'DNS' # Hardcoding the domain name based on the same list of Control, User and DNS for all customers.
-    dns_parent_domain_id = build_domain_tree(ng1_host, headers, cookies, domain_name, apn_parent_domain_id, domain_member_ids)
-
-# Add the new customer profile to the current customer config profile dictionary.
-customer_configs['Customers'].append(profile)
-# Name the file that we want to write the new customer config profile dictionary to.
-config_filename = new_customers_filename
-# Save the new customer config profile dictionary to the new customer new_customers_filename file
-save_cust_config_to_file(customer_configs, new_customers_filename, current_customers_filename, old_customers_filename)
-
-#FOR TESTING: Delete everything
-#domain_name = 'Cisco IOT'
-#delete_domain(ng1_host, domain_name, headers, cookies)
-
-close_session(ng1_host, headers, cookies)
+    # Journal everything we create so that this run can be resumed if it stops part way through.
+    journal = Journal(journal_filename)
+    if args.resume == True:
+        journal.open(append=True)
+        known_service_ids = journal_state['service_ids']
+        known_domain_ids = journal_state['domain_ids']
+    else:
+        if journal_state != False and journal_state['run_done'] == False:
+            print(f"[WARNING] Starting a new run. The unfinished run started {journal_state['run']['started']} can no longer be resumed")
+        journal.open(append=False)
+        journal.record({'type': 'run', 'started': datetime.now().isoformat(timespec='seconds'),
+                        'customers': [{'profile': profile, 'datacenters': dc_entry_list} for profile, dc_entry_list in customer_batch]})
+        known_service_ids = None
+        known_domain_ids = None
+    ng1.journal = journal
+
+    for profile, dc_entry_list in customer_batch:
+        if args.resume == True and profile['name'] in journal_state['customers_done']:
+            print(f"[INFO] The nG1 configuration for customer: {profile['name']} was finished before the run was resumed")
+        else:
+            print(f"[INFO] Creating the nG1 configuration for customer: {profile['name']}")
+            provision_customer(ng1, profile, dc_entry_list, inventory, app_data, domain_index, known_service_ids, known_domain_ids)
+            journal.record({'type': 'customer_done', 'name': profile['name']})
+        # Add the new customer profile to the current customer config profile dictionary.
+        # A resumed run may have stopped after it saved the customer file, so do not add a customer twice.
+        if profile['name'] not in customer_list:
+            customer_configs['Customers'].append(profile)
+    # Save the new customer config profile dictionary to the new customer new_customers_filename file
+    run_metrics.start_phase('save')
+    save_cust_config_to_file(customer_configs, new_customers_filename, current_customers_filename, old_customers_filename)
+    ng1.service_registry.save(service_cache_filename)
+    journal.record({'type': 'run_done'})
+    journal.close()
+    ng1.journal = None
+
+    #FOR TESTING: Delete everything
+    #domain_name = 'Cisco IOT'
+    #delete_domain(ng1, domain_name)
+
+    run_metrics.start_phase('close')
+    ng1_session.close()
+    # Show how many connections were opened to nG1 versus reused during this run.
+    ng1.client.print_connection_summary()
+    ng1.close()
+
+if __name__ == '__main__':
+    main()
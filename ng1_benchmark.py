@@ -0,0 +1,185 @@
+import argparse
+import hashlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from datetime import datetime
+
+# An end to end benchmark of cisco_IOT_1.py against the local nG1 stub in ng1_stub_server.py.
+# For each estate size, a fresh stub is started with that many devices and APNs. Then cisco_IOT_1.py is run with...
+# a manifest of one new customer on every APN in every datacenter. That covers the session, the alert profile...
+# lookups, a full inventory discovery, the datacenter and gateway validation, the service creation and the...
+# domain tree.
+# The wall time, the API calls made to each endpoint and the peak memory of each run are printed...
+# in a table and written to a json file, so that versions of the script can be compared.
+# The peak memory is measured with os.wait4, which is only available on Unix. On Windows it is left out.
+
+package_directory = os.path.dirname(os.path.abspath(__file__))
+
+def get_stub_json(port, path):
+    with urllib.request.urlopen(f'http://127.0.0.1:{port}{path}', timeout=30) as response:
+        return json.loads(response.read())
+
+def start_stub(port, run_directory, devices, apns, datacenters, latency_ms, stub_args):
+    # Start the stub and wait until it is answering. The stub writes the config files into run_directory.
+    stub_command = [sys.executable, os.path.join(package_directory, 'ng1_stub_server.py'), '--port', str(port),
+                    '--devices', str(devices), '--apns', str(apns), '--datacenters', str(datacenters),
+                    '--latency-ms', str(latency_ms), '--write-configs', run_directory] + stub_args
+    stub_log = open(os.path.join(run_directory, 'stub.log'), 'w')
+    stub_process = subprocess.Popen(stub_command, stdout=stub_log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if stub_process.poll() != None:
+            print(f'[CRITICAL] The nG1 stub exited. See {stub_log.name}. Exiting...')
+            sys.exit()
+        try:
+            get_stub_json(port, '/stub/stats')
+            return stub_process, stub_log
+        except OSError:
+            time.sleep(0.1)
+    stub_process.kill()
+    stub_log.close()
+    print('[CRITICAL] The nG1 stub did not start within 30 seconds. Exiting...')
+    sys.exit()
+
+def stop_stub(stub_process, stub_log):
+    stub_process.terminate()
+    try:
+        stub_process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        stub_process.kill()
+        stub_process.wait()
+    stub_log.close()
+
+def write_manifest(run_directory, apns):
+    # One new customer on every APN in the estate, in every datacenter and on every gateway.
+    manifest_filename = os.path.join(run_directory, 'benchmark_manifest.json')
+    manifest = {'Customers': [{'name': 'Benchmark', 'type': 'IOT',
+                               'APNs': [{'name': f'Onstar{apn_number:02d}', 'datacenters': 'all', 'gateways': 'all'}
+                                        for apn_number in range(1, apns + 1)]}]}
+    with open(manifest_filename, 'w') as f:
+        json.dump(manifest, f)
+    return manifest_filename
+
+def run_script(script, run_directory, script_args):
+    # Run the script in run_directory and return its exit code, wall time in seconds and peak memory in MB.
+    # The peak memory is None where os.wait4 is not available, such as on Windows.
+    script_output = open(os.path.join(run_directory, 'script.log'), 'w')
+    start_time = time.perf_counter()
+    script_process = subprocess.Popen([sys.executable, script] + script_args, cwd=run_directory,
+                                      stdout=script_output, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+    if not hasattr(os, 'wait4'):
+        script_process.wait()
+        wall_seconds = time.perf_counter() - start_time
+        script_output.close()
+        return script_process.returncode, wall_seconds, None
+    # wait4 returns the resource usage of just this child process, including its peak memory.
+    pid, wait_status, resource_usage = os.wait4(script_process.pid, 0)
+    wall_seconds = time.perf_counter() - start_time
+    script_process.returncode = os.waitstatus_to_exitcode(wait_status)
+    script_output.close()
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    if sys.platform == 'darwin':
+        peak_memory_mb = resource_usage.ru_maxrss / (1024 * 1024)
+    else:
+        peak_memory_mb = resource_usage.ru_maxrss / 1024
+    return script_process.returncode, wall_seconds, peak_memory_mb
+
+def run_completed(run_directory):
+    # cisco_IOT_1.py exits with code 0 when it stops on a [CRITICAL] error too, so the exit code does not say...
+    # whether the customer was added. A run that added it ends its journal with a run_done entry.
+    journal_filename = os.path.join(run_directory, 'CiscoIOT-Journal.jsonl')
+    if not os.path.isfile(journal_filename):
+        return False
+    with open(journal_filename) as f:
+        for line in f:
+            try:
+                if json.loads(line).get('type') == 'run_done':
+                    return True
+            except ValueError: # A line cut short by a run that was killed.
+                continue
+    return False
+
+def run_scenario(script, port, devices, apns, datacenters, latency_ms, stub_args, script_args, keep_directory):
+    run_directory = tempfile.mkdtemp(prefix=f'ng1_bench_{devices}d_{apns}a_')
+    stub_process, stub_log = start_stub(port, run_directory, devices, apns, datacenters, latency_ms, stub_args)
+    try:
+        manifest_filename = write_manifest(run_directory, apns)
+        exit_code, wall_seconds, peak_memory_mb = run_script(script, run_directory, ['--manifest', manifest_filename] + script_args)
+        api_calls = get_stub_json(port, '/stub/stats')
+        created = get_stub_json(port, '/stub/dump')
+    finally:
+        stop_stub(stub_process, stub_log)
+
+    result = {'devices': devices,
+              'apns': apns,
+              'datacenters': datacenters,
+              'latency_ms': latency_ms,
+              'exit_code': exit_code,
+              'completed': exit_code == 0 and run_completed(run_directory),
+              'wall_seconds': round(wall_seconds, 3),
+              'peak_memory_mb': round(peak_memory_mb, 1) if peak_memory_mb != None else None,
+              'total_api_calls': sum(api_calls.values()),
+              'api_calls': api_calls,
+              'services_created': len(created['services']),
+              'domains_created': len(created['domains']) - 1, # Not counting the 'Enterprise' domain.
+              'run_directory': run_directory}
+    if keep_directory == False and result['completed'] == True:
+        for filename in os.listdir(run_directory):
+            os.remove(os.path.join(run_directory, filename))
+        os.rmdir(run_directory)
+        result['run_directory'] = None
+    return result
+
+def print_results_table(results):
+    print(f"{'devices':>8} {'APNs':>5} {'DCs':>4} {'done':>5} {'seconds':>9} {'memory MB':>10} {'API calls':>10} {'services':>9} {'domains':>8}")
+    for result in results:
+        peak_memory = f"{result['peak_memory_mb']:.1f}" if result['peak_memory_mb'] != None else '-'
+        print(f"{result['devices']:>8} {result['apns']:>5} {result['datacenters']:>4} {'yes' if result['completed'] else 'no':>5} "
+              f"{result['wall_seconds']:>9.2f} {peak_memory:>10} {result['total_api_calls']:>10} "
+              f"{result['services_created']:>9} {result['domains_created']:>8}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark cisco_IOT_1.py against the local nG1 stub at several estate sizes')
+    parser.add_argument('--devices', default='10,100,1000', help='comma separated numbers of devices to test (default: 10,100,1000)')
+    parser.add_argument('--apns', default='1,5,20', help='comma separated numbers of APNs to test (default: 1,5,20)')
+    parser.add_argument('--datacenters', type=int, default=5, help='number of datacenters (default: 5)')
+    parser.add_argument('--latency-ms', type=float, default=0, help='milliseconds the stub adds to every API call (default: 0)')
+    parser.add_argument('--port', type=int, default=8080, choices=[80, 8080], help='port for the stub, cisco_IOT_1.py uses http on 80 or 8080 (default: 8080)')
+    parser.add_argument('--script', default=os.path.join(package_directory, 'cisco_IOT_1.py'), help='the version of cisco_IOT_1.py to benchmark')
+    parser.add_argument('--stub-args', default='', help='extra arguments for ng1_stub_server.py, for example "--post-returns-id"')
+    parser.add_argument('--script-args', default='', help='extra arguments for cisco_IOT_1.py, for example "--async-transport"')
+    parser.add_argument('--output', default=f"ng1_benchmark_{datetime.now().strftime('%Y_%m_%d_%H%M%S')}.json",
+                        help='json file to write the results to')
+    parser.add_argument('--keep', action='store_true', help='keep the run directory with the logs of every run')
+    args = parser.parse_args()
+
+    with open(args.script, 'rb') as f:
+        script_sha1 = hashlib.sha1(f.read()).hexdigest()
+    report = {'script': os.path.abspath(args.script),
+              'script_sha1': script_sha1,
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'started': datetime.now().isoformat(timespec='seconds'),
+              'stub_args': args.stub_args,
+              'script_args': args.script_args,
+              'results': []}
+    for devices in [int(devices) for devices in args.devices.split(',')]:
+        for apns in [int(apns) for apns in args.apns.split(',')]:
+            print(f'[INFO] Benchmarking {devices} devices, {apns} APNs and {args.datacenters} datacenters')
+            result = run_scenario(args.script, args.port, devices, apns, args.datacenters, args.latency_ms,
+                                  args.stub_args.split(), args.script_args.split(), args.keep)
+            if result['completed'] == False:
+                print(f"[ERROR] The run did not complete. Its timing is not comparable. See the logs in {result['run_directory']}")
+            report['results'].append(result)
+            # Write the report after every run so that a long benchmark still leaves results if it is stopped.
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+
+    print_results_table(report['results'])
+    print(f'[INFO] Benchmark results written to {args.output}')
@@ -0,0 +1,410 @@
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+from cryptography.fernet import Fernet
+
+# A local stand-in for the nGeniusONE REST API, for load testing cisco_IOT_1.py without a live nG1.
+# It serves the endpoints that cisco_IOT_1.py calls with the same JSON shapes that it parses, over a synthetic...
+# estate of devices, interfaces and APNs whose size is set on the command line.
+# Latency and errors can be injected into every API call.
+# Everything is kept in memory and is lost when the server stops.
+#
+# Two extra endpoints are for test tools rather than the script:
+# GET /stub/stats returns the number of calls made to each endpoint.
+# GET /stub/sessions returns the number of sessions that were opened and not closed.
+# GET /stub/dump returns every service and domain created, with member ids replaced by names so that two runs...
+# can be compared even though the id numbers differ.
+# POST /stub/change changes the estate while it is running, to test inventory refreshes. The body is...
+# {"device": name, "status": status} to change a device's status, or {"device": name, "interface": number,...
+# "interface_status": status} and/or {"device": name, "interface": number, "apns": [APN names]} to change an interface.
+#
+# To point cisco_IOT_1.py at the stub, run it with --write-configs set to the directory you will run...
+# cisco_IOT_1.py from. That writes a CredFile.ini, .ng1key.key, CiscoIOT-DataCenters.json and...
+# CiscoIOT-AppList.json to match the synthetic estate.
+
+# The datacenters that cisco_IOT_1.py knows the 3 letter acronyms for.
+datacenters = [('Atlanta', 'ATL'), ('Phoenix', 'PHX'), ('San Jose', 'SJC'), ('Toronto', 'TOR'), ('Vancouver', 'VAN')]
+# The service alert profiles that cisco_IOT_1.py looks up by name.
+alert_profile_names = ['ThroughPut-Baseline', 'GTP-Baseline', 'Web Group-Baseline', 'DNS-Baseline']
+
+class Estate():
+    # The synthetic nG1 estate and every service and domain created in it.
+
+    def __init__(self, devices=10, interfaces=4, apns=5, datacenter_count=5, apns_per_interface=2, post_returns_id=False, seed=1):
+        # devices is spread round robin across the first datacenter_count datacenters. Each device has...
+        # interfaces active interfaces (gateways) and each interface has apns_per_interface of the apns APNs...
+        # associated to it, picked at random using seed.
+        # If post_returns_id is True, creating a service or domain returns its definition with its new id.
+        rnd = random.Random(seed)
+        self.lock = threading.Lock()
+        self.post_returns_id = post_returns_id
+        self.datacenters = datacenters[:datacenter_count]
+        self.apns = {}
+        for apn_number in range(1, apns + 1):
+            apn_name = f'Onstar{apn_number:02d}'
+            self.apns[apn_name] = {'name': apn_name, 'id': 100 + apn_number}
+        apn_names = list(self.apns)
+        self.devices = {}
+        self.interfaces = {}
+        self.associations = {} # (device name, interface number) : list of APN names.
+        gateway_number = 0
+        for device_number in range(devices):
+            datacenter_name, dc_acronym = self.datacenters[device_number % len(self.datacenters)]
+            # Devices are named starting with the acronym of their datacenter, as cisco_IOT_1.py expects.
+            device_name = f'{dc_acronym.lower()}-is{device_number:04d}'
+            self.devices[device_name] = {'deviceName': device_name,
+                                         'deviceIPAddress': f'10.{device_number // 250}.{device_number % 250}.1',
+                                         'deviceType': 'InfiniStream',
+                                         'status': 'Active'}
+            self.interfaces[device_name] = []
+            for interface_number in range(1, interfaces + 1):
+                gateway_number += 1
+                # The interface alias is the gateway name, which includes the datacenter acronym.
+                self.interfaces[device_name].append({'interfaceName': f'if{interface_number}',
+                                                     'interfaceNumber': interface_number,
+                                                     'alias': f'{dc_acronym}-GGSN{gateway_number:04d}',
+                                                     'status': 'ACT'})
+                self.associations[(device_name, str(interface_number))] = rnd.sample(apn_names, min(apns_per_interface, len(apn_names)))
+        self.alert_profiles = {}
+        for profile_number, profile_name in enumerate(alert_profile_names):
+            self.alert_profiles[profile_name] = {'Id': 10 + profile_number, 'name': profile_name}
+        self.services = {} # Service name : service definition.
+        self.domains = {1: {'serviceName': 'Enterprise', 'id': 1, 'parent': ''}} # Domain id : domain definition.
+        self.next_id = 1000
+        self.sessions = {} # Session id : time the session was opened.
+
+    def new_id(self):
+        with self.lock:
+            self.next_id += 1
+            return self.next_id
+
+    def change(self, change):
+        # Apply a POST /stub/change. Returns False if the device or interface does not exist.
+        with self.lock:
+            device_name = change.get('device')
+            if device_name not in self.devices:
+                return False
+            if 'status' in change:
+                self.devices[device_name]['status'] = change['status']
+            if 'interface' in change:
+                interface_number = int(change['interface'])
+                device_interfaces = [device_interface for device_interface in self.interfaces[device_name]
+                                     if device_interface['interfaceNumber'] == interface_number]
+                if device_interfaces == []:
+                    return False
+                if 'interface_status' in change:
+                    device_interfaces[0]['status'] = change['interface_status']
+                if 'apns' in change:
+                    self.associations[(device_name, str(interface_number))] = list(change['apns'])
+            return True
+
+    def dump(self):
+        # Return every service and domain, with ids replaced by names so that runs can be compared.
+        with self.lock:
+            services = json.loads(json.dumps(self.services))
+            domains = json.loads(json.dumps(self.domains))
+        service_names = {}
+        for service_name in services:
+            service_names[services[service_name]['id']] = service_name
+        for service in services.values():
+            del service['id']
+            for service_member in service.get('serviceMembers', []):
+                if 'networkDomainID' in service_member:
+                    service_member['networkDomainID'] = service_names.get(service_member['networkDomainID'])
+        domain_list = []
+        for domain in domains.values():
+            # Build the path of domain names from 'Enterprise' down to this domain.
+            domain_path = [domain['serviceName']]
+            parent_domain = domain
+            while parent_domain.get('parent') not in ('', None):
+                parent_domain = domains[str(parent_domain['parent'])]
+                domain_path.append(parent_domain['serviceName'])
+            member_names = sorted(str(service_names.get(member['id'], member['id'])) for member in domain.get('members', []))
+            domain_list.append(['/'.join(reversed(domain_path)), member_names])
+        return {'services': services, 'domains': sorted(domain_list)}
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keep connections alive, as nG1 does.
+    # Buffer each response so that the headers and body go out in one write. Otherwise the client's delayed ACK...
+    # of the headers adds about 40ms to every response on a kept alive connection.
+    wbufsize = -1
+    estate = None
+    latency = 0.0 # Seconds added to every API call.
+    latency_jitter = 0.0 # Up to this many seconds more are added at random to every API call.
+    error_rate = 0.0 # The fraction of API calls that fail with a 503 response.
+    session_timeout = 0.0 # Seconds after which a session is refused with a 401 response. 0 means never.
+    stats = defaultdict(int) # Endpoint : number of calls.
+    stats_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass # Do not log every request to stderr.
+
+    def reply(self, status_code, body=None, session_id=None):
+        if body == None:
+            data = b''
+        elif isinstance(body, str):
+            data = body.encode()
+        else:
+            data = json.dumps(body).encode()
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if session_id != None:
+            self.send_header('Set-Cookie', f'NSSESSIONID={session_id}; Path=/')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        content_length = int(self.headers.get('Content-Length') or 0)
+        if content_length == 0:
+            return None
+        return json.loads(self.rfile.read(content_length) or b'null')
+
+    def get_session_id(self):
+        # Return the NSSESSIONID cookie sent with this request, or None.
+        for cookie in (self.headers.get('Cookie') or '').split(';'):
+            cookie_name, _, cookie_value = cookie.strip().partition('=')
+            if cookie_name == 'NSSESSIONID':
+                return cookie_value
+        return None
+
+    def session_is_valid(self):
+        # Sessions are only checked if a session timeout is set.
+        if self.session_timeout <= 0:
+            return True
+        estate = self.estate
+        with estate.lock:
+            session_opened_time = estate.sessions.get(self.get_session_id())
+        return session_opened_time != None and time.monotonic() - session_opened_time < self.session_timeout
+
+    def count(self, endpoint):
+        with self.stats_lock:
+            self.stats[endpoint] += 1
+
+    def do_GET(self):
+        self.handle_api_call('GET')
+
+    def do_POST(self):
+        self.handle_api_call('POST')
+
+    def do_DELETE(self):
+        self.handle_api_call('DELETE')
+
+    def handle_api_call(self, method):
+        path = unquote(urlparse(self.path).path)
+        path_parts = [path_part for path_part in path.split('/') if path_part != '']
+        body = self.read_body() if method == 'POST' else None
+        estate = self.estate
+
+        if path_parts[:1] == ['stub']:
+            if path_parts[1:] == ['stats']:
+                with self.stats_lock:
+                    return self.reply(200, dict(self.stats))
+            if path_parts[1:] == ['dump']:
+                return self.reply(200, estate.dump())
+            if path_parts[1:] == ['sessions']:
+                with estate.lock:
+                    return self.reply(200, {'open_sessions': len(estate.sessions)})
+            if path_parts[1:] == ['change'] and method == 'POST':
+                if estate.change(body) == False:
+                    return self.reply(404, 'Not found device or interface')
+                return self.reply(200, '')
+            return self.reply(404, 'Not found')
+
+        if self.latency > 0 or self.latency_jitter > 0:
+            time.sleep(self.latency + random.uniform(0, self.latency_jitter))
+
+        # /ng1api/rest-sessions opens a session and /ng1api/rest-sessions/close closes it.
+        if path_parts[:2] == ['ng1api', 'rest-sessions']:
+            if path_parts[2:] == ['close']:
+                self.count('POST /rest-sessions/close')
+                with estate.lock:
+                    estate.sessions.pop(self.get_session_id(), None)
+                return self.reply(200, '')
+            self.count('POST /rest-sessions')
+            session_id = uuid.uuid4().hex
+            with estate.lock:
+                estate.sessions[session_id] = time.monotonic()
+            return self.reply(200, '', session_id=session_id)
+
+        if self.session_is_valid() == False:
+            self.count('401')
+            return self.reply(401, 'Session is not valid')
+
+        if random.random() < self.error_rate:
+            return self.reply(503, 'Service Unavailable')
+
+        # Everything else is /ng1api/ncm/<resource>/...
+        resource_parts = path_parts[2:]
+        if path_parts[:2] != ['ng1api', 'ncm'] or resource_parts == []:
+            return self.reply(404, 'Not found')
+        resource = resource_parts[0]
+
+        if resource == 'devices':
+            if len(resource_parts) == 1:
+                self.count('GET /devices')
+                return self.reply(200, {'deviceConfigurations': list(estate.devices.values())})
+            device_name = resource_parts[1]
+            if len(resource_parts) == 3 and resource_parts[2] == 'interfaces':
+                self.count('GET /devices/{name}/interfaces')
+                return self.reply(200, {'interfaceConfigurations': estate.interfaces.get(device_name, [])})
+            if len(resource_parts) == 5 and resource_parts[4] == 'associateapns':
+                self.count('GET /devices/{name}/interfaces/{number}/associateapns')
+                apn_names = estate.associations.get((device_name, resource_parts[3]), [])
+                if apn_names == []:
+                    return self.reply(200, {}) # nG1 returns an empty object when no APNs are associated.
+                return self.reply(200, {'apnAssociations': apn_names})
+
+        if resource == 'apns':
+            if len(resource_parts) == 1:
+                self.count('GET /apns')
+                return self.reply(200, {'apns': list(estate.apns.values())})
+            self.count('GET /apns/{name}')
+            if resource_parts[1] in estate.apns:
+                return self.reply(200, estate.apns[resource_parts[1]])
+            return self.reply(404, f'APN {resource_parts[1]} not found')
+
+        if resource == 'servicealertprofiles':
+            if len(resource_parts) == 1:
+                self.count('GET /servicealertprofiles')
+                return self.reply(200, {'serviceAlertProfiles': list(estate.alert_profiles.values())})
+            self.count('GET /servicealertprofiles/{name}')
+            if resource_parts[1] in estate.alert_profiles:
+                return self.reply(200, estate.alert_profiles[resource_parts[1]])
+            return self.reply(404, f'Service alert profile {resource_parts[1]} not found')
+
+        if resource == 'services':
+            if method == 'POST':
+                self.count('POST /services')
+                service_detail = body['serviceDetail'][0]
+                service_name = service_detail['serviceName']
+                with estate.lock:
+                    if service_name in estate.services:
+                        return self.reply(400, f'Service {service_name} already exists')
+                    estate.next_id += 1
+                    service_detail = dict(service_detail, id=estate.next_id)
+                    estate.services[service_name] = service_detail
+                if estate.post_returns_id == True:
+                    return self.reply(200, {'serviceDetail': [service_detail]})
+                return self.reply(200, '')
+            if len(resource_parts) == 1:
+                self.count('GET /services')
+                with estate.lock:
+                    service_list = [{'id': service['id'], 'serviceName': service['serviceName'], 'serviceType': service.get('serviceType')}
+                                    for service in estate.services.values()]
+                return self.reply(200, {'serviceDetail': service_list})
+            self.count('GET /services/{name}')
+            with estate.lock:
+                service_detail = estate.services.get(resource_parts[1])
+            if service_detail != None:
+                return self.reply(200, {'serviceDetail': [service_detail]})
+            return self.reply(404, f'Service {resource_parts[1]} not found')
+
+        if resource == 'domains':
+            if method == 'POST':
+                self.count('POST /domains')
+                domain_detail = body['domainDetail'][0]
+                domain_id = estate.new_id()
+                with estate.lock:
+                    estate.domains[domain_id] = {'serviceName': domain_detail['domainName'],
+                                                 'id': domain_id,
+                                                 'parent': int(domain_detail['parentID']),
+                                                 'members': domain_detail.get('domainMembers', [])}
+                if estate.post_returns_id == True:
+                    return self.reply(200, {'domainDetail': [dict(domain_detail, id=domain_id)]})
+                return self.reply(200, '')
+            if method == 'DELETE':
+                self.count('DELETE /domains/{name}')
+                return self.reply(200, '')
+            if len(resource_parts) == 1:
+                self.count('GET /domains')
+                with estate.lock:
+                    domain_list = [{'serviceName': domain['serviceName'], 'id': domain['id'], 'parent': domain['parent']}
+                                   for domain in estate.domains.values()]
+                return self.reply(200, {'domain': domain_list})
+            self.count('GET /domains/{name}')
+            # Every domain with this name is returned, as domain names repeat under each customer.
+            with estate.lock:
+                domain_list = [{'domainName': domain['serviceName'], 'id': domain['id'], 'parentID': domain['parent']}
+                               for domain in estate.domains.values() if domain['serviceName'] == resource_parts[1]]
+            if domain_list != []:
+                return self.reply(200, {'domainDetail': domain_list})
+            return self.reply(404, f'Domain {resource_parts[1]} not found')
+
+        return self.reply(404, 'Not found')
+
+def write_configs(estate, directory, port, username, password):
+    # Write the files cisco_IOT_1.py reads at startup, to match the estate and point at this server.
+    with open(os.path.join(directory, 'CiscoIOT-DataCenters.json'), 'w') as f:
+        json.dump({'Data Centers': [{'name': datacenter_name} for datacenter_name, dc_acronym in estate.datacenters]}, f)
+    with open(os.path.join(directory, 'CiscoIOT-AppList.json'), 'w') as f:
+        json.dump({'Applications': [
+            {'name': 'GTPv0', 'type': 'single', 'protocolOrGroupCode': 'GTP', 'alertProfile': 'GTP-Baseline',
+             'serviceDefMonitorType': 'ADM_MONITOR_ENT_ADM'},
+            {'name': 'GTPv1', 'type': 'single', 'message': 'GTPv1:16', 'alertProfile': 'GTP-Baseline',
+             'serviceDefMonitorType': 'ADM_MONITOR_ENT_ADM'},
+            {'name': 'GTPv2', 'type': 'single', 'message': 'GTPv2:32', 'alertProfile': 'GTP-Baseline',
+             'serviceDefMonitorType': 'ADM_MONITOR_ENT_ADM'},
+            {'name': 'Web', 'type': 'single', 'protocolOrGroupCode': 'WEB', 'isProtocolGroup': True, 'alertProfile': 'Web Group-Baseline',
+             'serviceDefMonitorType': 'ADM_MONITOR_ENT_ADM'},
+            {'name': 'DNS', 'type': 'multi_member', 'member_list': ['DNS', 'DNS-TCP'], 'alertProfile': 'DNS-Baseline',
+             'serviceDefMonitorType': 'ADM_MONITOR_ENT_ADM'},
+        ]}, f)
+    # The credentials file and key file are in the same layout that cred_script_nG1.py writes.
+    ng1key = Fernet.generate_key()
+    with open(os.path.join(directory, '.ng1key.key'), 'w') as f:
+        f.write(ng1key.decode())
+    ng1password = Fernet(ng1key).encrypt(password.encode()).decode()
+    with open(os.path.join(directory, 'CredFile.ini'), 'w') as f:
+        f.write(f'#Credential file:\nExpiry=-1\nng1token=\nng1username={username}\nng1password={ng1password}\n'
+                f'ng1destination=127.0.0.1\nng1port={port}\n')
+    print(f'[INFO] Wrote the credential, datacenter and application files for this stub to {directory}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a local stand-in for the nGeniusONE REST API')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen on, cisco_IOT_1.py uses http on 80 or 8080 (default: 8080)')
+    parser.add_argument('--devices', type=int, default=10, help='number of InfiniStream devices (default: 10)')
+    parser.add_argument('--interfaces', type=int, default=4, help='number of active interfaces on each device (default: 4)')
+    parser.add_argument('--apns', type=int, default=5, help='number of APNs (default: 5)')
+    parser.add_argument('--apns-per-interface', type=int, default=2, help='number of APNs associated to each interface (default: 2)')
+    parser.add_argument('--datacenters', type=int, default=5, choices=range(1, len(datacenters) + 1),
+                        help=f'number of datacenters, up to {len(datacenters)} (default: 5)')
+    parser.add_argument('--seed', type=int, default=1, help='seed for the random APN associations (default: 1)')
+    parser.add_argument('--latency-ms', type=float, default=0, help='milliseconds added to every API call (default: 0)')
+    parser.add_argument('--latency-jitter-ms', type=float, default=0, help='up to this many milliseconds more are added at random (default: 0)')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of API calls that fail with a 503 response (default: 0)')
+    parser.add_argument('--session-timeout', type=float, default=0,
+                        help='seconds after which a session is refused with a 401 response, 0 for never (default: 0)')
+    parser.add_argument('--post-returns-id', action='store_true', help='return the new id when a service or domain is created')
+    parser.add_argument('--write-configs', default=None, metavar='DIRECTORY',
+                        help='write CredFile.ini, .ng1key.key and the datacenter and application json files to this directory')
+    parser.add_argument('--username', default='admin', help='username to put in the credentials file (default: admin)')
+    parser.add_argument('--password', default='secret', help='password to put in the credentials file (default: secret)')
+    args = parser.parse_args()
+
+    StubHandler.estate = Estate(args.devices, args.interfaces, args.apns, args.datacenters, args.apns_per_interface,
+                                args.post_returns_id, args.seed)
+    StubHandler.latency = args.latency_ms / 1000
+    StubHandler.latency_jitter = args.latency_jitter_ms / 1000
+    StubHandler.error_rate = args.error_rate
+    StubHandler.session_timeout = args.session_timeout
+    if args.write_configs != None:
+        write_configs(StubHandler.estate, args.write_configs, args.port, args.username, args.password)
+
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), StubHandler)
+    server.daemon_threads = True
+    print(f'[INFO] nG1 stub listening on http://127.0.0.1:{args.port} with {args.devices} devices, '
+          f'{args.devices * args.interfaces} interfaces and {args.apns} APNs')
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('[INFO] nG1 stub stopped')